@@ -1,7 +1,6 @@
 from nodes import MAX_RESOLUTION
 from impact.utils import *
 import impact.core as core
-from impact.core import SEG
 from impact.segs_nodes import SEGSPaste
 
 
@@ -64,18 +63,16 @@ class SEGSDetailerForAnimateDiff:
             model = nodes_differential_diffusion.DifferentialDiffusion().apply(model)[0]
 
         for seg in segs[1]:
-            cropped_image_frames = None
+            seg_mask = seg.cropped_mask  # decode the packed mask once
+            cropped_image_frames = TensorBatchBuilder(len(image_frames))
 
             for image in image_frames:
                 image = image.unsqueeze(0)
                 cropped_image = seg.cropped_image if seg.cropped_image is not None else crop_tensor4(image, seg.crop_region)
                 cropped_image = to_tensor(cropped_image)
-                if cropped_image_frames is None:
-                    cropped_image_frames = cropped_image
-                else:
-                    cropped_image_frames = torch.concat((cropped_image_frames, cropped_image), dim=0)
+                cropped_image_frames.concat(cropped_image)
 
-            cropped_image_frames = cropped_image_frames.cpu().numpy()
+            cropped_image_frames = cropped_image_frames.tensor.cpu().numpy()
 
             # It is assumed that AnimateDiff does not support conditioning masks based on test results, but it will be added for future consideration.
             cropped_positive = [
@@ -96,7 +93,7 @@ class SEGSDetailerForAnimateDiff:
 
             enhanced_image_tensor, cnet_images = core.enhance_detail_for_animatediff(cropped_image_frames, model, clip, vae, guide_size, guide_size_for, max_size,
                                                                                      seg.bbox, seed, steps, cfg, sampler_name, scheduler,
-                                                                                     cropped_positive, cropped_negative, denoise, seg.cropped_mask,
+                                                                                     cropped_positive, cropped_negative, denoise, seg_mask,
                                                                                      refiner_ratio=refiner_ratio, refiner_model=refiner_model,
                                                                                      refiner_clip=refiner_clip, refiner_positive=refiner_positive,
                                                                                      refiner_negative=refiner_negative, control_net_wrapper=seg.control_net_wrapper,
@@ -109,7 +106,7 @@ class SEGSDetailerForAnimateDiff:
             else:
                 new_cropped_image = enhanced_image_tensor.cpu().numpy()
 
-            new_seg = SEG(new_cropped_image, seg.cropped_mask, seg.confidence, seg.crop_region, seg.bbox, seg.label, None)
+            new_seg = seg._replace(cropped_image=new_cropped_image, control_net_wrapper=None)  # keeps the packed mask
             new_segs.append(new_seg)
 
         return (segs[0], new_segs), cnet_image_list
@@ -8,10 +8,37 @@ import latent_preview
 # I don't know why but... 'from .' and 'from impact' refer to different core modules.
 # This separates global variables of the core module and breaks the preview bridge.
 from impact import core
+from impact import config
 # <--
 import random
 
 
+def bridge_thumbnail(images, max_size):
+    h, w = images.shape[1:3]
+    if max_size <= 0 or max(h, w) <= max_size:
+        return images
+
+    scale = max_size / max(h, w)
+    size = max(1, round(h * scale)), max(1, round(w * scale))
+    thumbnail = torch.nn.functional.interpolate(images.permute(0, 3, 1, 2), size=size, mode='bilinear', antialias=True)
+    return thumbnail.permute(0, 2, 3, 1).clamp(0, 1)
+
+
+def save_bridge_images(images, filename_prefix, prompt=None, extra_pnginfo=None):
+    """
+    Save the images of the PreviewBridge nodes to the temp directory according to `preview_bridge_storage`.
+
+    png: full resolution image
+    thumbnail: downscaled image for the UI only. The full resolution pixels are kept in `core.preview_bridge_cache`.
+    """
+    if config.get_config()['preview_bridge_storage'] == 'thumbnail':
+        images = bridge_thumbnail(images, config.get_config()['preview_bridge_thumbnail_size'])
+
+    saver = nodes.PreviewImage()
+    saver.compress_level = config.get_config()['preview_bridge_png_compress_level']
+    return saver.save_images(images, filename_prefix=filename_prefix, prompt=prompt, extra_pnginfo=extra_pnginfo)['ui']['images']
+
+
 class PreviewBridge:
     @classmethod
     def INPUT_TYPES(s):
@@ -45,13 +72,15 @@ class PreviewBridge:
     @staticmethod
     def load_image(pb_id):
         is_fail = False
-        if pb_id not in core.preview_bridge_image_id_map:
+        entry = core.preview_bridge_image_id_map.get(pb_id)
+        if entry is None:
+            # unknown or evicted id
             is_fail = True
+        else:
+            image_path, ui_item = entry
 
-        image_path, ui_item = core.preview_bridge_image_id_map[pb_id]
-
-        if not os.path.isfile(image_path):
-            is_fail = True
+            if not os.path.isfile(image_path):
+                is_fail = True
 
         if not is_fail:
             i = Image.open(image_path)
@@ -78,16 +107,42 @@ class PreviewBridge:
 
     def doit(self, images, image, unique_id, block=False, restore_mask="never", prompt=None, extra_pnginfo=None):
         need_refresh = False
+        fingerprint = None
+
+        # one locked lookup each, the entries may be evicted concurrently
+        cache = core.preview_bridge_cache.get(unique_id)
+        id_entry = core.preview_bridge_image_id_map.get(image)
 
-        if unique_id not in core.preview_bridge_cache:
+        if cache is None:
             need_refresh = True
 
-        elif core.preview_bridge_cache[unique_id][0] is not images:
+        elif id_entry is None:
+            # the image id is evicted
             need_refresh = True
 
+        elif cache[0] is not images:
+            # re-executed upstream: refresh only if the content is changed
+            fingerprint = tensor_fingerprint(images)
+            if cache[4] != fingerprint:
+                need_refresh = True
+            else:
+                cache = (images, *cache[1:])
+                core.preview_bridge_cache[unique_id] = cache
+
         if not need_refresh:
-            pixels, mask, path_item = PreviewBridge.load_image(image)
-            image = [path_item]
+            _, saved_images, saved_path, saved_mask, _ = cache
+
+            if id_entry[0] == saved_path:
+                # unchanged pb_id: reuse the tensors instead of decoding the saved file
+                pixels, mask = images, saved_mask
+                image = saved_images
+            else:
+                pixels, mask, path_item = PreviewBridge.load_image(image)
+                if pixels.shape[1:3] != images.shape[1:3]:
+                    # the mask is drawn on a thumbnail
+                    pixels = images
+                    mask = resize_mask(mask, images.shape[1:3])
+                image = [path_item]
         else:
             if restore_mask != "never":
                 mask = core.preview_bridge_last_mask_cache.get(unique_id)
@@ -97,23 +152,24 @@ class PreviewBridge:
                 mask = None
 
             if mask is None:
-                mask = torch.zeros((64, 64), dtype=torch.float32, device="cpu")
-                res = nodes.PreviewImage().save_images(images, filename_prefix="PreviewBridge/PB-", prompt=prompt, extra_pnginfo=extra_pnginfo)
+                mask = torch.zeros((1, 64, 64), dtype=torch.float32, device="cpu")
+                image2 = save_bridge_images(images, "PreviewBridge/PB-", prompt=prompt, extra_pnginfo=extra_pnginfo)
             else:
                 masked_images = tensor_convert_rgba(images)
                 resized_mask = resize_mask(mask, (images.shape[1], images.shape[2])).unsqueeze(3)
                 resized_mask = 1 - resized_mask
                 tensor_putalpha(masked_images, resized_mask)
-                res = nodes.PreviewImage().save_images(masked_images, filename_prefix="PreviewBridge/PB-", prompt=prompt, extra_pnginfo=extra_pnginfo)
+                image2 = save_bridge_images(masked_images, "PreviewBridge/PB-", prompt=prompt, extra_pnginfo=extra_pnginfo)
 
-            image2 = res['ui']['images']
             pixels = images
 
             path = os.path.join(folder_paths.get_temp_directory(), 'PreviewBridge', image2[0]['filename'])
-            core.set_previewbridge_image(unique_id, path, image2[0])
+            core.set_previewbridge_image(unique_id, path, image2[0], read_mask=False)
             core.preview_bridge_image_id_map[image] = (path, image2[0])
             core.preview_bridge_image_name_map[unique_id, path] = (image, image2[0])
-            core.preview_bridge_cache[unique_id] = (images, image2)
+            if fingerprint is None:
+                fingerprint = tensor_fingerprint(images)
+            core.preview_bridge_cache[unique_id] = (images, image2, path, mask, fingerprint)
 
             image = image2
 
@@ -204,6 +260,14 @@ def decode_latent(latent, preview_method, vae_opt=None):
     return to_tensor(resized_image).unsqueeze(0)
 
 
+def latent_fingerprint(latent):
+    noise_mask = latent.get('noise_mask')
+    batch_index = latent.get('batch_index')
+    return (tensor_fingerprint(latent['samples']),
+            None if noise_mask is None else tensor_fingerprint(noise_mask),
+            None if batch_index is None else tuple(batch_index))
+
+
 class PreviewBridgeLatent:
     @classmethod
     def INPUT_TYPES(s):
@@ -245,13 +309,15 @@ class PreviewBridgeLatent:
     @staticmethod
     def load_image(pb_id):
         is_fail = False
-        if pb_id not in core.preview_bridge_image_id_map:
+        entry = core.preview_bridge_image_id_map.get(pb_id)
+        if entry is None:
+            # unknown or evicted id
             is_fail = True
+        else:
+            image_path, ui_item = entry
 
-        image_path, ui_item = core.preview_bridge_image_id_map[pb_id]
-
-        if not os.path.isfile(image_path):
-            is_fail = True
+            if not os.path.isfile(image_path):
+                is_fail = True
 
         if not is_fail:
             i = Image.open(image_path)
@@ -291,17 +357,46 @@ class PreviewBridgeLatent:
             raise Exception("The version of latent is not compatible with preview_method.<BR>SD3, SD1/SD2, SDXL, SC-Prior, SC-B and FLUX.1 are not compatible with each other.")
 
         need_refresh = False
+        fingerprint = None
+
+        # one locked lookup each, the entries may be evicted concurrently
+        cache = core.preview_bridge_cache.get(unique_id)
+        id_entry = core.preview_bridge_image_id_map.get(image)
 
-        if unique_id not in core.preview_bridge_cache:
+        if cache is None:
             need_refresh = True
 
-        elif (core.preview_bridge_cache[unique_id][0] is not latent
-              or (vae_opt is None and core.preview_bridge_cache[unique_id][2] is not None)
-              or (vae_opt is None and core.preview_bridge_cache[unique_id][1] != preview_method)
-              or (vae_opt is not None and core.preview_bridge_cache[unique_id][2] is not vae_opt)):
+        elif ((vae_opt is None and cache[2] is not None)
+              or (vae_opt is None and cache[1] != preview_method)
+              or (vae_opt is not None and cache[2] is not vae_opt)
+              or id_entry is None):
             need_refresh = True
 
-        if not need_refresh:
+        elif cache[0] is not latent:
+            # re-executed upstream: refresh only if the content is changed
+            fingerprint = latent_fingerprint(latent)
+            if cache[6] != fingerprint:
+                need_refresh = True
+            else:
+                cache = (latent, *cache[1:])
+                core.preview_bridge_cache[unique_id] = cache
+
+        if not need_refresh and id_entry[0] == cache[4]:
+            # unchanged pb_id: reuse the mask instead of decoding the saved file
+            mask = cache[5]
+            res_image = cache[3]
+            is_empty_mask = torch.all(mask == 1)
+
+            if not is_empty_mask:
+                res_latent = latent.copy()
+                res_latent['noise_mask'] = mask
+            elif 'noise_mask' in latent:
+                res_latent = latent.copy()
+                del res_latent['noise_mask']
+            else:
+                res_latent = latent
+
+        elif not need_refresh:
             pixels, mask, path_item = PreviewBridge.load_image(image)
 
             if mask is None:
@@ -332,9 +427,13 @@ class PreviewBridgeLatent:
                 resized_mask = resize_mask(inverted_mask, (decoded_image.shape[1], decoded_image.shape[2]))
                 result_pil = apply_mask_alpha_to_pil(decoded_pil, resized_mask)
 
+                if config.get_config()['preview_bridge_storage'] == 'thumbnail' and config.get_config()['preview_bridge_thumbnail_size'] > 0:
+                    thumbnail_size = config.get_config()['preview_bridge_thumbnail_size']
+                    result_pil.thumbnail((thumbnail_size, thumbnail_size), resample=LANCZOS)
+
                 full_output_folder, filename, counter, _, _ = folder_paths.get_save_image_path("PreviewBridge/PBL-"+self.prefix_append, folder_paths.get_temp_directory(), result_pil.size[0], result_pil.size[1])
                 file = f"{filename}_{counter}.png"
-                result_pil.save(os.path.join(full_output_folder, file), compress_level=4)
+                result_pil.save(os.path.join(full_output_folder, file), compress_level=config.get_config()['preview_bridge_png_compress_level'])
                 res_image = [{
                                 'filename': file,
                                 'subfolder': 'PreviewBridge',
@@ -352,23 +451,23 @@ class PreviewBridgeLatent:
 
                 if mask is None:
                     mask = torch.ones(latent['samples'].shape[2:], dtype=torch.float32, device="cpu").unsqueeze(0)
-                    res = nodes.PreviewImage().save_images(decoded_image, filename_prefix="PreviewBridge/PBL-", prompt=prompt, extra_pnginfo=extra_pnginfo)
+                    res_image = save_bridge_images(decoded_image, "PreviewBridge/PBL-", prompt=prompt, extra_pnginfo=extra_pnginfo)
                 else:
                     masked_images = tensor_convert_rgba(decoded_image)
                     resized_mask = resize_mask(mask, (decoded_image.shape[1], decoded_image.shape[2])).unsqueeze(3)
                     resized_mask = 1 - resized_mask
                     tensor_putalpha(masked_images, resized_mask)
-                    res = nodes.PreviewImage().save_images(masked_images, filename_prefix="PreviewBridge/PBL-", prompt=prompt, extra_pnginfo=extra_pnginfo)
-
-                res_image = res['ui']['images']
+                    res_image = save_bridge_images(masked_images, "PreviewBridge/PBL-", prompt=prompt, extra_pnginfo=extra_pnginfo)
 
             is_empty_mask = torch.all(mask == 1)
 
             path = os.path.join(folder_paths.get_temp_directory(), 'PreviewBridge', res_image[0]['filename'])
-            core.set_previewbridge_image(unique_id, path, res_image[0])
+            core.set_previewbridge_image(unique_id, path, res_image[0], read_mask=False)
             core.preview_bridge_image_id_map[image] = (path, res_image[0])
             core.preview_bridge_image_name_map[unique_id, path] = (image, res_image[0])
-            core.preview_bridge_cache[unique_id] = (latent, preview_method, vae_opt, res_image)
+            if fingerprint is None:
+                fingerprint = latent_fingerprint(latent)
+            core.preview_bridge_cache[unique_id] = (latent, preview_method, vae_opt, res_image, path, mask, fingerprint)
 
             res_latent = latent
 
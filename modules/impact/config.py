@@ -21,6 +21,25 @@ def write_config():
                             'sam_editor_model': get_config()['sam_editor_model'],
                             'custom_wildcards': get_config()['custom_wildcards'],
                             'disable_gpu_opencv': get_config()['disable_gpu_opencv'],
+                            'detailer_bucket_step': str(get_config()['detailer_bucket_step']),
+                            'detailer_bucket_tolerance': str(get_config()['detailer_bucket_tolerance']),
+                            'seg_mask_packing': str(get_config()['seg_mask_packing']),
+                            'sam_embedding_cache_mb': str(get_config()['sam_embedding_cache_mb']),
+                            'onnx_intra_op_threads': str(get_config()['onnx_intra_op_threads']),
+                            'onnx_inter_op_threads': str(get_config()['onnx_inter_op_threads']),
+                            'onnx_graph_optimization_level': get_config()['onnx_graph_optimization_level'],
+                            'onnx_save_optimized_model': str(get_config()['onnx_save_optimized_model']),
+                            'wildcard_lazy_load': str(get_config()['wildcard_lazy_load']),
+                            'wildcard_lazy_cache_files': str(get_config()['wildcard_lazy_cache_files']),
+                            'wildcard_watch_interval': str(get_config()['wildcard_watch_interval']),
+                            'wildcard_snapshot': str(get_config()['wildcard_snapshot']),
+                            'mask_to_segs_engine': get_config()['mask_to_segs_engine'],
+                            'preview_bridge_cache_mb': str(get_config()['preview_bridge_cache_mb']),
+                            'preview_bridge_max_entries': str(get_config()['preview_bridge_max_entries']),
+                            'preview_bridge_storage': get_config()['preview_bridge_storage'],
+                            'preview_bridge_png_compress_level': str(get_config()['preview_bridge_png_compress_level']),
+                            'preview_bridge_thumbnail_size': str(get_config()['preview_bridge_thumbnail_size']),
+                            'mask_morphology_backend': get_config()['mask_morphology_backend'],
                         }
     with open(config_path, 'w') as configfile:
         config.write(configfile)
@@ -42,7 +61,26 @@ def read_config():
                     'sam_editor_cpu': default_conf['sam_editor_cpu'].lower() == 'true' if 'sam_editor_cpu' in default_conf else False,
                     'sam_editor_model': default_conf['sam_editor_model'].lower() if 'sam_editor_model' else 'sam_vit_b_01ec64.pth',
                     'custom_wildcards': default_conf['custom_wildcards'] if 'custom_wildcards' in default_conf else os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "custom_wildcards")),
-                    'disable_gpu_opencv': default_conf['disable_gpu_opencv'].lower() == 'true' if 'disable_gpu_opencv' in default_conf else True
+                    'disable_gpu_opencv': default_conf['disable_gpu_opencv'].lower() == 'true' if 'disable_gpu_opencv' in default_conf else True,
+                    'detailer_bucket_step': int(default_conf['detailer_bucket_step']) if 'detailer_bucket_step' in default_conf else 0,
+                    'detailer_bucket_tolerance': float(default_conf['detailer_bucket_tolerance']) if 'detailer_bucket_tolerance' in default_conf else 0.1,
+                    'seg_mask_packing': default_conf['seg_mask_packing'].lower() == 'true' if 'seg_mask_packing' in default_conf else False,
+                    'sam_embedding_cache_mb': int(default_conf['sam_embedding_cache_mb']) if 'sam_embedding_cache_mb' in default_conf else 256,
+                    'onnx_intra_op_threads': int(default_conf['onnx_intra_op_threads']) if 'onnx_intra_op_threads' in default_conf else 0,
+                    'onnx_inter_op_threads': int(default_conf['onnx_inter_op_threads']) if 'onnx_inter_op_threads' in default_conf else 0,
+                    'onnx_graph_optimization_level': default_conf['onnx_graph_optimization_level'].lower() if 'onnx_graph_optimization_level' in default_conf else 'all',
+                    'onnx_save_optimized_model': default_conf['onnx_save_optimized_model'].lower() == 'true' if 'onnx_save_optimized_model' in default_conf else False,
+                    'wildcard_lazy_load': default_conf['wildcard_lazy_load'].lower() == 'true' if 'wildcard_lazy_load' in default_conf else False,
+                    'wildcard_lazy_cache_files': int(default_conf['wildcard_lazy_cache_files']) if 'wildcard_lazy_cache_files' in default_conf else 64,
+                    'wildcard_watch_interval': float(default_conf['wildcard_watch_interval']) if 'wildcard_watch_interval' in default_conf else 0,
+                    'wildcard_snapshot': default_conf['wildcard_snapshot'].lower() == 'true' if 'wildcard_snapshot' in default_conf else True,
+                    'mask_to_segs_engine': default_conf['mask_to_segs_engine'].lower() if 'mask_to_segs_engine' in default_conf else 'components',
+                    'preview_bridge_cache_mb': int(default_conf['preview_bridge_cache_mb']) if 'preview_bridge_cache_mb' in default_conf else 1024,
+                    'preview_bridge_max_entries': int(default_conf['preview_bridge_max_entries']) if 'preview_bridge_max_entries' in default_conf else 1000,
+                    'preview_bridge_storage': default_conf['preview_bridge_storage'].lower() if 'preview_bridge_storage' in default_conf else 'png',
+                    'preview_bridge_png_compress_level': int(default_conf['preview_bridge_png_compress_level']) if 'preview_bridge_png_compress_level' in default_conf else 1,
+                    'preview_bridge_thumbnail_size': int(default_conf['preview_bridge_thumbnail_size']) if 'preview_bridge_thumbnail_size' in default_conf else 1024,
+                    'mask_morphology_backend': default_conf['mask_morphology_backend'].lower() if 'mask_morphology_backend' in default_conf else 'auto',
                }
 
     except Exception:
@@ -52,7 +90,26 @@ def read_config():
             'sam_editor_cpu': False,
             'sam_editor_model': 'sam_vit_b_01ec64.pth',
             'custom_wildcards': os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "custom_wildcards")),
-            'disable_gpu_opencv': True
+            'disable_gpu_opencv': True,
+            'detailer_bucket_step': 0,
+            'detailer_bucket_tolerance': 0.1,
+            'seg_mask_packing': False,
+            'sam_embedding_cache_mb': 256,
+            'onnx_intra_op_threads': 0,
+            'onnx_inter_op_threads': 0,
+            'onnx_graph_optimization_level': 'all',
+            'onnx_save_optimized_model': False,
+            'wildcard_lazy_load': False,
+            'wildcard_lazy_cache_files': 64,
+            'wildcard_watch_interval': 0,
+            'wildcard_snapshot': True,
+            'mask_to_segs_engine': 'components',
+            'preview_bridge_cache_mb': 1024,
+            'preview_bridge_max_entries': 1000,
+            'preview_bridge_storage': 'png',
+            'preview_bridge_png_compress_level': 1,
+            'preview_bridge_thumbnail_size': 1024,
+            'mask_morphology_backend': 'auto',
         }
 
 
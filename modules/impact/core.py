@@ -8,7 +8,7 @@ from segment_anything import SamPredictor
 
 from comfy_extras.nodes_custom_sampler import Noise_RandomNoise
 from impact.utils import *
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import numpy as np
 from skimage.measure import label
 from PIL import ImageOps
@@ -24,8 +24,13 @@ import time
 from comfy import model_management
 from impact import utils
 from impact import impact_sampling
+from impact import config
+from impact import mask_algebra
 from concurrent.futures import ThreadPoolExecutor
 import inspect
+import hashlib
+import threading
+import weakref
 
 
 try:
@@ -39,12 +44,74 @@ SEG = namedtuple("SEG",
                  ['cropped_image', 'cropped_mask', 'confidence', 'crop_region', 'bbox', 'label', 'control_net_wrapper'],
                  defaults=[None])
 
+
+class PackedSEG(SEG):
+    """SEG which stores `cropped_mask` as `PackedMask`. `cropped_mask` is decoded on access."""
+
+    __slots__ = ()
+
+    @property
+    def cropped_mask(self):
+        mask = tuple.__getitem__(self, 1)
+        if isinstance(mask, PackedMask):
+            return mask.decode()
+        return mask
+
+    @property
+    def packed_mask(self):
+        mask = tuple.__getitem__(self, 1)
+        return mask if isinstance(mask, PackedMask) else None
+
+
+def get_packed_mask(seg):
+    """PackedMask of the seg without decoding, or None if the seg has a dense mask"""
+    return seg.packed_mask if isinstance(seg, PackedSEG) else None
+
+
+def pack_seg(seg):
+    """Convert into `PackedSEG` if `seg_mask_packing` is enabled and the mask is binary."""
+    if not config.get_config()['seg_mask_packing'] or isinstance(seg, PackedSEG):
+        return seg
+
+    packed = PackedMask.pack(seg.cropped_mask)
+    if not isinstance(packed, PackedMask):
+        return seg
+
+    return PackedSEG(seg.cropped_image, packed, seg.confidence, seg.crop_region, seg.bbox, seg.label, seg.control_net_wrapper)
+
 pb_id_cnt = time.time()
-preview_bridge_image_id_map = {}
-preview_bridge_image_name_map = {}
 
-preview_bridge_cache = {}
-preview_bridge_last_mask_cache = {}
+# node ids of the current prompt (set by `gc_preview_bridge_cache` of impact_server).
+# Their entries are pinned, so that only the stale nodes are evicted by the LRU.
+preview_bridge_prompt_nodes = frozenset()
+
+
+def is_prompt_node_key(key):
+    """key: node id (caches), "$<node id>-<count>" (pb_id) or (node id, file)"""
+    if isinstance(key, tuple):
+        node_id = key[0]
+    elif isinstance(key, str) and key.startswith('$'):
+        node_id = key[1:].rsplit('-', 1)[0]
+    else:
+        node_id = key
+
+    return str(node_id) in preview_bridge_prompt_nodes
+
+
+# NOTE: bounded by `preview_bridge_cache_mb` and `preview_bridge_max_entries` to prevent the growth of the long-running server.
+preview_bridge_image_id_map = LRUCache('preview_bridge_image_id_map', max_entries=config.get_config()['preview_bridge_max_entries'],
+                                       is_pinned=is_prompt_node_key)
+preview_bridge_image_name_map = LRUCache('preview_bridge_image_name_map', max_entries=config.get_config()['preview_bridge_max_entries'],
+                                         is_pinned=is_prompt_node_key)
+
+preview_bridge_cache = LRUCache('preview_bridge_cache', max_bytes=config.get_config()['preview_bridge_cache_mb'] * 1024 * 1024,
+                                max_entries=config.get_config()['preview_bridge_max_entries'], is_pinned=is_prompt_node_key)
+preview_bridge_last_mask_cache = LRUCache('preview_bridge_last_mask_cache', max_bytes=config.get_config()['preview_bridge_cache_mb'] * 1024 * 1024,
+                                          max_entries=config.get_config()['preview_bridge_max_entries'], is_pinned=is_prompt_node_key)
+
+
+def get_preview_bridge_cache_stats():
+    return {x.name: x.stats() for x in [preview_bridge_cache, preview_bridge_last_mask_cache, preview_bridge_image_id_map, preview_bridge_image_name_map]}
 
 current_prompt = None
 
@@ -59,18 +126,17 @@ def is_execution_model_version_supported():
         return False
 
 
-def set_previewbridge_image(node_id, file, item):
+def set_previewbridge_image(node_id, file, item, read_mask=True):
     global pb_id_cnt
 
-    if file in preview_bridge_image_name_map:
-        pb_id = preview_bridge_image_name_map[node_id, file]
-        if pb_id.startswith(f"${node_id}"):
-            return pb_id
+    entry = preview_bridge_image_name_map.get((node_id, file))
+    if entry is not None and entry[0].startswith(f"${node_id}") and preview_bridge_image_id_map.get(entry[0]) is not None:
+        return entry[0]
 
     pb_id = f"${node_id}-{pb_id_cnt}"
     preview_bridge_image_id_map[pb_id] = (file, item)
     preview_bridge_image_name_map[node_id, file] = (pb_id, item)
-    if os.path.isfile(file):
+    if read_mask and os.path.isfile(file):
         i = Image.open(file)
         i = ImageOps.exif_transpose(i)
         if 'A' in i.getbands():
@@ -237,45 +303,20 @@ def gen_negative_hints(w, h, x1, y1, x2, y2):
     return npoints, nplabs
 
 
-def enhance_detail(image, model, clip, vae, guide_size, guide_size_for_bbox, max_size, bbox, seed, steps, cfg,
-                   sampler_name,
-                   scheduler, positive, negative, denoise, noise_mask, force_inpaint,
-                   wildcard_opt=None, wildcard_opt_concat_mode=None,
-                   detailer_hook=None,
-                   refiner_ratio=None, refiner_model=None, refiner_clip=None, refiner_positive=None,
-                   refiner_negative=None, control_net_wrapper=None, cycle=1,
-                   inpaint_model=False, noise_mask_feather=0, scheduler_func=None):
-
-    if noise_mask is not None:
-        noise_mask = utils.tensor_gaussian_blur_mask(noise_mask, noise_mask_feather)
-        noise_mask = noise_mask.squeeze(3)
-
-        if noise_mask_feather > 0 and 'denoise_mask_function' not in model.model_options:
-            model = nodes_differential_diffusion.DifferentialDiffusion().apply(model)[0]
-
-    if wildcard_opt is not None and wildcard_opt != "":
-        model, _, wildcard_positive = wildcards.process_with_loras(wildcard_opt, model, clip)
-
-        if wildcard_opt_concat_mode == "concat":
-            positive = nodes.ConditioningConcat().concat(positive, wildcard_positive)[0]
-        else:
-            positive = wildcard_positive
-            positive = [positive[0].copy()]
-            if 'pooled_output' in wildcard_positive[0][1]:
-                positive[0][1]['pooled_output'] = wildcard_positive[0][1]['pooled_output']
-            elif 'pooled_output' in positive[0][1]:
-                del positive[0][1]['pooled_output']
-
-    h = image.shape[1]
-    w = image.shape[2]
+def calculate_detail_size(w, h, bbox, guide_size, guide_size_for_bbox, max_size, force_inpaint, model, verbose=True):
+    """
+    Calculate the upscaled size of a cropped region for detailing.
 
+    :return: (upscale, new_w, new_h) or None if the segment has to be skipped
+    """
     bbox_h = bbox[3] - bbox[1]
     bbox_w = bbox[2] - bbox[0]
 
     # Skip processing if the detected bbox is already larger than the guide_size
     if not force_inpaint and bbox_h >= guide_size and bbox_w >= guide_size:
-        print(f"Detailer: segment skip (enough big)")
-        return None, None
+        if verbose:
+            print(f"Detailer: segment skip (enough big)")
+        return None
 
     if guide_size_for_bbox:  # == "bbox"
         # Scale up based on the smaller dimension between width and height.
@@ -298,26 +339,249 @@ def enhance_detail(image, model, clip, vae, guide_size, guide_size_for_bbox, max
 
     if not force_inpaint:
         if upscale <= 1.0:
-            print(f"Detailer: segment skip [determined upscale factor={upscale}]")
-            return None, None
+            if verbose:
+                print(f"Detailer: segment skip [determined upscale factor={upscale}]")
+            return None
 
         if new_w == 0 or new_h == 0:
-            print(f"Detailer: segment skip [zero size={new_w, new_h}]")
-            return None, None
+            if verbose:
+                print(f"Detailer: segment skip [zero size={new_w, new_h}]")
+            return None
     else:
         if upscale <= 1.0 or new_w == 0 or new_h == 0:
-            print(f"Detailer: force inpaint")
+            if verbose:
+                print(f"Detailer: force inpaint")
             upscale = 1.0
             new_w = w
             new_h = h
 
+    return upscale, new_w, new_h
+
+
+LATENT_ALIGNMENT = 8
+
+
+def align_to_latent(length):
+    """Round `length` up to a multiple of the latent downscale factor."""
+    return -(-length // LATENT_ALIGNMENT) * LATENT_ALIGNMENT
+
+
+def snap_to_bucket(length, bucket_step, bucket_tolerance):
+    """
+    Length of the sampling canvas for `length` pixels.
+
+    `length` is padded up to the next multiple of `bucket_step` if the padding is within `bucket_tolerance` (ratio),
+    and the result is aligned to the latent size. (the image is padded, not stretched, so the aspect ratio is kept)
+    If the bucketing is disabled (`bucket_step` is 0), `length` is returned as is, so the crop is sampled at its upscaled size.
+    """
+    if bucket_step <= 0:
+        return length
+
+    snapped = -(-length // bucket_step) * bucket_step
+    if snapped - length <= length * bucket_tolerance:
+        length = snapped
+
+    return align_to_latent(length)
+
+
+def get_canvas_size(w, h, bucket_step=None, bucket_tolerance=None):
+    """Sampling canvas size of an image of (w, h). (see `snap_to_bucket`)"""
+    bucket_step, bucket_tolerance = get_detail_bucket_config(bucket_step, bucket_tolerance)
+    return snap_to_bucket(w, bucket_step, bucket_tolerance), snap_to_bucket(h, bucket_step, bucket_tolerance)
+
+
+class DetailSizePlan:
+    """
+    Execution plan of the detailing sizes.
+
+    `upscales[i]` and `sizes[i]` are the upscale factor and the upscaled size of the i-th item,
+    `planned_sizes[i]` is the size of the sampling canvas the upscaled image is padded to. (see `snap_to_bucket`)
+    They are None for the skipped items.
+    """
+
+    def __init__(self, crop_sizes, upscales, sizes, planned_sizes, bucket_step=0, bucket_tolerance=0.0):
+        self.crop_sizes = crop_sizes
+        self.upscales = upscales
+        self.sizes = sizes
+        self.planned_sizes = planned_sizes
+        self.bucket_step = bucket_step
+        self.bucket_tolerance = bucket_tolerance
+
+    def __len__(self):
+        return len(self.planned_sizes)
+
+    def get_size(self, idx):
+        return self.planned_sizes[idx]
+
+    def canvas_size(self, w, h):
+        return get_canvas_size(w, h, self.bucket_step, self.bucket_tolerance)
+
+    def groups(self, indices=None):
+        """Group the item indices by their planned size. (skipped items are excluded)"""
+        if indices is None:
+            indices = range(len(self.planned_sizes))
+
+        res = {}
+        for idx in indices:
+            size = self.planned_sizes[idx]
+            if size is not None:
+                res.setdefault(size, []).append(idx)
+
+        return res
+
+    def area_overhead(self):
+        """Ratio of the additional pixel area of the planned sizes compared to the per-seg sizes."""
+        area = sum(w * h for w, h in (x for x in self.sizes if x is not None))
+        planned_area = sum(w * h for w, h in (x for x in self.planned_sizes if x is not None))
+
+        if area == 0:
+            return 0.0
+
+        return planned_area / area - 1.0
+
+    def summary(self):
+        n = len([x for x in self.planned_sizes if x is not None])
+        unique_sizes = len(set(x for x in self.sizes if x is not None))
+        return f"{n} segment(s), {unique_sizes} size(s) -> {len(self.groups())} bucket(s), area overhead {self.area_overhead() * 100:+.1f}%"
+
+
+def plan_detail_sizes(items, guide_size, guide_size_for_bbox, max_size, force_inpaint, model, bucket_step=None, bucket_tolerance=None, verbose=True):
+    """
+    Plan the detailing sizes of the cropped regions.
+
+    :param items: list of (w, h, bbox) for each cropped region
+    :return: DetailSizePlan
+    """
+    bucket_step, bucket_tolerance = get_detail_bucket_config(bucket_step, bucket_tolerance)
+    plan = DetailSizePlan([], [], [], [], bucket_step, bucket_tolerance)
+
+    for w, h, bbox in items:
+        plan.crop_sizes.append((w, h))
+
+        upscale_size = calculate_detail_size(w, h, bbox, guide_size, guide_size_for_bbox, max_size, force_inpaint, model, verbose=verbose)
+        if upscale_size is None:
+            plan.upscales.append(None)
+            plan.sizes.append(None)
+            plan.planned_sizes.append(None)
+            continue
+
+        upscale, new_w, new_h = upscale_size
+        plan.upscales.append(upscale)
+        plan.sizes.append((new_w, new_h))
+        plan.planned_sizes.append(plan.canvas_size(new_w, new_h))
+
+    return plan
+
+
+def plan_segs_detail_sizes(segs, guide_size, guide_size_for_bbox, max_size, force_inpaint, model, bucket_step=None, bucket_tolerance=None):
+    """`plan_detail_sizes` for SEG list."""
+    items = [(seg.crop_region[2] - seg.crop_region[0], seg.crop_region[3] - seg.crop_region[1], seg.bbox) for seg in segs]
+    return plan_detail_sizes(items, guide_size, guide_size_for_bbox, max_size, force_inpaint, model, bucket_step, bucket_tolerance)
+
+
+def plan_segs_canvas_sizes(segs, bucket_step=None, bucket_tolerance=None):
+    """Plan of the SEGs which are sampled at their crop size. (no upscaling, e.g. SEGSUpscaler)"""
+    bucket_step, bucket_tolerance = get_detail_bucket_config(bucket_step, bucket_tolerance)
+    plan = DetailSizePlan([], [], [], [], bucket_step, bucket_tolerance)
+
+    for seg in segs:
+        size = (seg.crop_region[2] - seg.crop_region[0], seg.crop_region[3] - seg.crop_region[1])
+        plan.crop_sizes.append(size)
+        plan.upscales.append(1.0)
+        plan.sizes.append(size)
+        plan.planned_sizes.append(plan.canvas_size(*size))
+
+    return plan
+
+
+def pad_to_canvas(image, canvas_w, canvas_h, noise_mask=None):
+    """
+    Pad the upscaled image (and its noise mask) on the right and the bottom up to the canvas size.
+    The image is padded by replicating the border, the mask is resized to the image and padded with zeros,
+    so that the padding is not denoised.
+    """
+    w = image.shape[2]
+    h = image.shape[1]
+    if (w, h) == (canvas_w, canvas_h):
+        return image, noise_mask
+
+    image = torch.nn.functional.pad(image.movedim(-1, 1), (0, canvas_w - w, 0, canvas_h - h), mode='replicate').movedim(1, -1)
+
+    if noise_mask is not None:
+        noise_mask = noise_mask.reshape((-1, 1, noise_mask.shape[-2], noise_mask.shape[-1]))
+        noise_mask = torch.nn.functional.interpolate(noise_mask, size=(h, w), mode="bilinear")
+        noise_mask = torch.nn.functional.pad(noise_mask, (0, canvas_w - w, 0, canvas_h - h)).squeeze(1)
+
+    return image, noise_mask
+
+
+def get_detail_bucket_config(bucket_step=None, bucket_tolerance=None):
+    """Fill the unspecified bucketing options from `impact-pack.ini`."""
+    conf = config.get_config()
+    if bucket_step is None:
+        bucket_step = conf['detailer_bucket_step']
+    if bucket_tolerance is None:
+        bucket_tolerance = conf['detailer_bucket_tolerance']
+    return bucket_step, bucket_tolerance
+
+
+def enhance_detail(image, model, clip, vae, guide_size, guide_size_for_bbox, max_size, bbox, seed, steps, cfg,
+                   sampler_name,
+                   scheduler, positive, negative, denoise, noise_mask, force_inpaint,
+                   wildcard_opt=None, wildcard_opt_concat_mode=None,
+                   detailer_hook=None,
+                   refiner_ratio=None, refiner_model=None, refiner_clip=None, refiner_positive=None,
+                   refiner_negative=None, control_net_wrapper=None, cycle=1,
+                   inpaint_model=False, noise_mask_feather=0, scheduler_func=None,
+                   size_plan=None, plan_index=0):
+
+    if noise_mask is not None:
+        noise_mask = utils.tensor_gaussian_blur_mask(noise_mask, noise_mask_feather)
+        noise_mask = noise_mask.squeeze(3)
+
+        if noise_mask_feather > 0 and 'denoise_mask_function' not in model.model_options:
+            model = nodes_differential_diffusion.DifferentialDiffusion().apply(model)[0]
+
+    if wildcard_opt is not None and wildcard_opt != "":
+        model, _, wildcard_positive = wildcards.process_with_loras(wildcard_opt, model, clip)
+
+        if wildcard_opt_concat_mode == "concat":
+            positive = nodes.ConditioningConcat().concat(positive, wildcard_positive)[0]
+        else:
+            positive = wildcard_positive
+            positive = [positive[0].copy()]
+            if 'pooled_output' in wildcard_positive[0][1]:
+                positive[0][1]['pooled_output'] = wildcard_positive[0][1]['pooled_output']
+            elif 'pooled_output' in positive[0][1]:
+                del positive[0][1]['pooled_output']
+
+    h = image.shape[1]
+    w = image.shape[2]
+
+    if size_plan is None:
+        size_plan = plan_detail_sizes([(w, h, bbox)], guide_size, guide_size_for_bbox, max_size, force_inpaint, model)
+        plan_index = 0
+
+    if size_plan.get_size(plan_index) is None:
+        return None, None
+
+    upscale = size_plan.upscales[plan_index]
+    new_w, new_h = size_plan.sizes[plan_index]
+    canvas_w, canvas_h = size_plan.get_size(plan_index)
+
     if detailer_hook is not None:
-        new_w, new_h = detailer_hook.touch_scaled_size(new_w, new_h)
+        touched_size = detailer_hook.touch_scaled_size(new_w, new_h)
+        if touched_size != (new_w, new_h):
+            new_w, new_h = touched_size
+            canvas_w, canvas_h = size_plan.canvas_size(new_w, new_h)
 
-    print(f"Detailer: segment upscale for ({bbox_w, bbox_h}) | crop region {w, h} x {upscale} -> {new_w, new_h}")
+    bbox_h = bbox[3] - bbox[1]
+    bbox_w = bbox[2] - bbox[0]
+    print(f"Detailer: segment upscale for ({bbox_w, bbox_h}) | crop region {w, h} x {upscale} -> {new_w, new_h} (canvas {canvas_w, canvas_h})")
 
     # upscale
     upscaled_image = tensor_resize(image, new_w, new_h)
+    upscaled_image, noise_mask = pad_to_canvas(upscaled_image, canvas_w, canvas_h, noise_mask)
 
     cnet_pils = None
     if control_net_wrapper is not None:
@@ -379,8 +643,8 @@ def enhance_detail(image, model, clip, vae, guide_size, guide_size_for_bbox, max
     if detailer_hook is not None:
         refined_image = detailer_hook.post_decode(refined_image)
 
-    # downscale
-    refined_image = tensor_resize(refined_image, w, h)
+    # crop the canvas padding and downscale
+    refined_image = tensor_resize(refined_image[:, :new_h, :new_w, :], w, h)
 
     # prevent mixing of device
     refined_image = refined_image.cpu()
@@ -390,6 +654,121 @@ def enhance_detail(image, model, clip, vae, guide_size, guide_size_for_bbox, max
     return refined_image, cnet_pils
 
 
+def is_batchable_segment(seg, positive, negative, wildcard_item, detailer_hook, inpaint_model):
+    """
+    Check whether a segment can be detailed as a part of a latent batch.
+    Per-seg state (hooks, controlnets, wildcards, regional conditioning masks) forces the per-seg path.
+    """
+    if detailer_hook is not None or inpaint_model or seg.control_net_wrapper is not None:
+        return False
+
+    if wildcard_item:
+        return False
+
+    for cond in [positive] if isinstance(negative, str) else [positive, negative]:
+        for _, details in cond:
+            if 'mask' in details:
+                return False
+
+    return True
+
+
+def is_overlapped_region(region1, region2):
+    return region1[0] < region2[2] and region2[0] < region1[2] and region1[1] < region2[3] and region2[1] < region1[3]
+
+
+def enhance_detail_batch(images, model, clip, vae, guide_size, guide_size_for_bbox, max_size, bboxes, seeds, steps, cfg,
+                         sampler_name, scheduler, positive, negative, denoise, noise_masks, force_inpaint,
+                         refiner_ratio=None, refiner_model=None, refiner_clip=None, refiner_positive=None,
+                         refiner_negative=None, cycle=1, noise_mask_feather=0, scheduler_func=None, batch_size=4,
+                         size_plan=None, plan_indices=None):
+    """
+    Batched version of `enhance_detail` for the segments which share the same conditioning.
+
+    The segments are grouped by their sampling canvas size (see `plan_detail_sizes`), and each group is encoded, sampled and decoded as one latent batch.
+    The noise and the noise mask are prepared per item, so deterministic samplers produce the same result as `enhance_detail`.
+
+    :param size_plan: DetailSizePlan of the segments, `plan_indices[i]` is the index of `images[i]` in the plan
+    :return: list of refined images (None for the skipped segment) in the order of `images`
+    """
+
+    if noise_masks is not None and noise_mask_feather > 0 and 'denoise_mask_function' not in model.model_options:
+        model = nodes_differential_diffusion.DifferentialDiffusion().apply(model)[0]
+
+    results = [None] * len(images)
+
+    if size_plan is None:
+        items = [(image.shape[2], image.shape[1], bbox) for image, bbox in zip(images, bboxes)]
+        size_plan = plan_detail_sizes(items, guide_size, guide_size_for_bbox, max_size, force_inpaint, model)
+        plan_indices = list(range(len(images)))
+
+    # plan index -> index of `images`
+    item_of = {plan_idx: idx for idx, plan_idx in enumerate(plan_indices)}
+
+    for idx, bbox in enumerate(bboxes):
+        plan_idx = plan_indices[idx]
+        if size_plan.get_size(plan_idx) is not None:
+            print(f"Detailer: segment upscale for ({bbox[2] - bbox[0], bbox[3] - bbox[1]}) | crop region {size_plan.crop_sizes[plan_idx]} "
+                  f"-> {size_plan.sizes[plan_idx]} (canvas {size_plan.get_size(plan_idx)})")
+
+    for (canvas_w, canvas_h), plan_group in size_plan.groups(plan_indices).items():
+        indices = [item_of[plan_idx] for plan_idx in plan_group]
+        for chunk_start in range(0, len(indices), batch_size):
+            chunk = indices[chunk_start:chunk_start + batch_size]
+            print(f"Detailer: batched sampling of {len(chunk)} segment(s) at {canvas_w, canvas_h}")
+
+            first = images[chunk[0]]
+            upscaled_image = torch.empty((len(chunk), canvas_h, canvas_w, first.shape[3]), dtype=first.dtype, device=first.device)
+            batch_mask = []
+            for i, idx in enumerate(chunk):
+                new_w, new_h = size_plan.sizes[plan_indices[idx]]
+
+                if noise_masks is not None:
+                    noise_mask = utils.tensor_gaussian_blur_mask(noise_masks[idx], noise_mask_feather).squeeze(3)
+                else:
+                    noise_mask = None
+
+                if (new_w, new_h) == (canvas_w, canvas_h):
+                    tensor_resize(images[idx], new_w, new_h, out=upscaled_image[i:i+1])
+                else:
+                    upscaled_image[i:i+1], noise_mask = pad_to_canvas(tensor_resize(images[idx], new_w, new_h), canvas_w, canvas_h, noise_mask)
+
+                batch_mask.append(noise_mask)
+
+            latent_image = to_latent_image(upscaled_image, vae)
+            samples = latent_image['samples']
+
+            if noise_masks is not None:
+                # resize to the latent size in the same way as comfy does, so that the batched mask is identical to the per-seg mask
+                latent_image['noise_mask'] = torch.cat([torch.nn.functional.interpolate(noise_mask.reshape((-1, 1, noise_mask.shape[-2], noise_mask.shape[-1])),
+                                                                                        size=(samples.shape[-2], samples.shape[-1]), mode="bilinear")
+                                                        for noise_mask in batch_mask], dim=0)
+
+            refined_latent = latent_image
+            for i in range(0, cycle):
+                # the initial noise and the noise of the stochastic samplers are drawn per segment from its own seed,
+                # so the result of a segment doesn't depend on the other segments of the batch
+                item_seeds = [seeds[idx] + i for idx in chunk]
+                noise = torch.cat([Noise_RandomNoise(seed).generate_noise({'samples': samples[j:j+1]}) for j, seed in enumerate(item_seeds)], dim=0)
+                refined_latent = impact_sampling.ksampler_wrapper(model, item_seeds[0], steps, cfg, sampler_name, scheduler, positive, negative,
+                                                                  refined_latent, denoise, refiner_ratio, refiner_model, refiner_clip, refiner_positive, refiner_negative,
+                                                                  noise=noise, scheduler_func=scheduler_func, batch_seeds=item_seeds)
+
+            try:
+                refined_images = vae.decode(refined_latent['samples'])
+            except Exception as e:
+                # usually an out-of-memory exception from the decode, so try a tiled approach
+                refined_images = vae.decode_tiled(refined_latent["samples"], tile_x=64, tile_y=64, )
+
+            for j, idx in enumerate(chunk):
+                h = images[idx].shape[1]
+                w = images[idx].shape[2]
+                new_w, new_h = size_plan.sizes[plan_indices[idx]]
+                results[idx] = tensor_resize(refined_images[j:j+1, :new_h, :new_w, :], w, h).cpu()
+
+    return results
+
+
 def enhance_detail_for_animatediff(image_frames, model, clip, vae, guide_size, guide_size_for_bbox, max_size, bbox, seed, steps, cfg,
                                    sampler_name,
                                    scheduler, positive, negative, denoise, noise_mask,
@@ -576,11 +955,148 @@ def sam_predict(predictor, points, plabs, bbox, threshold):
     return total_masks
 
 
+def sam_predict_batch(predictor, points_list, plabs_list, bboxes, threshold, chunk_size=16):
+    """
+    Batched `sam_predict` for multiple boxes. Every box is decoded in one `predict_torch` call per chunk.
+    The boxes are grouped by the number of hint points, so the prompts don't need the padding.
+
+    :return: list of the selected masks of each box (same order as `bboxes`)
+    """
+    results = [[] for _ in bboxes]
+
+    groups = {}
+    for idx, points in enumerate(points_list):
+        groups.setdefault(len(points) if points else 0, []).append(idx)
+
+    device = predictor.device
+    for n_points, indices in groups.items():
+        for chunk_start in range(0, len(indices), chunk_size):
+            chunk = indices[chunk_start:chunk_start + chunk_size]
+
+            boxes = torch.tensor([bboxes[idx] for idx in chunk], dtype=torch.float, device=device)
+            boxes = predictor.transform.apply_boxes_torch(boxes, predictor.original_size)
+
+            if n_points > 0:
+                point_coords = torch.tensor([points_list[idx] for idx in chunk], dtype=torch.float, device=device)
+                point_coords = predictor.transform.apply_coords_torch(point_coords, predictor.original_size)
+                point_labels = torch.tensor([plabs_list[idx] for idx in chunk], dtype=torch.int, device=device)
+            else:
+                point_coords = None
+                point_labels = None
+
+            masks, scores, _ = predictor.predict_torch(point_coords=point_coords, point_labels=point_labels, boxes=boxes, multimask_output=True)
+
+            # same selection as `sam_predict`: every mask above the threshold, otherwise the best mask (only if score > 0)
+            max_scores, max_indices = scores.max(dim=1)
+            selected = scores >= threshold
+            fallback = ~selected.any(dim=1) & (max_scores > 0)
+            selected[fallback, max_indices[fallback]] = True
+
+            masks = masks.cpu().numpy()
+            selected = selected.cpu().numpy()
+            for i, idx in enumerate(chunk):
+                results[idx] = list(masks[i][selected[i]])
+
+    return results
+
+
+class SAMEmbeddingCache:
+    """
+    LRU cache of the SAM image embeddings (the result of `SamPredictor.set_image`).
+
+    The key is the content hash of the image and the identity of the SAM model.
+    The embeddings are kept in the CPU memory within `max_bytes`.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def image_hash(image):
+        image = np.ascontiguousarray(image)
+        h = hashlib.blake2b(digest_size=16)
+        h.update(str((image.shape, image.dtype.str)).encode())
+        h.update(memoryview(image).cast('B'))
+        return h.hexdigest()
+
+    def get(self, model, image_hash):
+        key = (id(model), image_hash)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            model_ref, features, original_size, input_size = entry
+            if model_ref() is not model:
+                # `id` is reused by the other model
+                self._remove(key)
+                return None
+
+            self.entries.move_to_end(key)
+            return features, original_size, input_size
+
+    def put(self, model, image_hash, features, original_size, input_size):
+        nbytes = features.element_size() * features.nelement()
+        if nbytes > self.max_bytes:
+            return
+
+        key = (id(model), image_hash)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = (weakref.ref(model), features.cpu(), original_size, input_size)
+            self.total_bytes += nbytes
+
+            while self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        features = self.entries.pop(key)[1]
+        self.total_bytes -= features.element_size() * features.nelement()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+
+sam_embedding_cache = SAMEmbeddingCache(config.get_config()['sam_embedding_cache_mb'] * 1024 * 1024)
+
+
+def sam_set_image(predictor, model, image, image_hash=None):
+    """`predictor.set_image(image, "RGB")` with `sam_embedding_cache`"""
+    if sam_embedding_cache.max_bytes <= 0:
+        predictor.set_image(image, "RGB")
+        return
+
+    if image_hash is None:
+        image_hash = SAMEmbeddingCache.image_hash(image)
+
+    cached = sam_embedding_cache.get(model, image_hash)
+    if cached is not None:
+        features, original_size, input_size = cached
+        predictor.reset_image()
+        predictor.features = features.to(predictor.device)
+        predictor.original_size = original_size
+        predictor.input_size = input_size
+        predictor.is_image_set = True
+        return
+
+    predictor.set_image(image, "RGB")
+    sam_embedding_cache.put(model, image_hash, predictor.features, predictor.original_size, predictor.input_size)
+
+
 class SAMWrapper:
     def __init__(self, model, is_auto_mode, safe_to_gpu=None):
         self.model = model
         self.safe_to_gpu = safe_to_gpu if safe_to_gpu is not None else SafeToGPU_stub()
         self.is_auto_mode = is_auto_mode
+        self.last_image_ref = None  # weakref, the wrapper must not keep the image alive
+        self.last_image_hash = None
 
     def prepare_device(self):
         if self.is_auto_mode:
@@ -591,12 +1107,29 @@ class SAMWrapper:
         if self.is_auto_mode:
             self.model.to(device="cpu")
 
-    def predict(self, image, points, plabs, bbox, threshold):
+    def get_predictor(self, image):
+        # `make_sam_mask` passes the same image for every segment: skip the hashing
+        if self.last_image_ref is None or self.last_image_ref() is not image:
+            try:
+                self.last_image_ref = weakref.ref(image)
+            except TypeError:
+                self.last_image_ref = None
+            self.last_image_hash = SAMEmbeddingCache.image_hash(image) if sam_embedding_cache.max_bytes > 0 else None
+
         predictor = SamPredictor(self.model)
-        predictor.set_image(image, "RGB")
+        sam_set_image(predictor, self.model, image, self.last_image_hash)
+        return predictor
+
+    def predict(self, image, points, plabs, bbox, threshold):
+        predictor = self.get_predictor(image)
 
         return sam_predict(predictor, points, plabs, bbox, threshold)
 
+    def predict_batch(self, image, points_list, plabs_list, bboxes, threshold):
+        predictor = self.get_predictor(image)
+
+        return sam_predict_batch(predictor, points_list, plabs_list, bboxes, threshold)
+
 
 class ESAMWrapper:
     def __init__(self, model, device):
@@ -619,6 +1152,16 @@ class ESAMWrapper:
         detected_masks = self.func_inference.inference_sam_with_boxes(image=image, xyxy=[bbox], model=self.model, device=self.device)
         return [detected_masks.squeeze(0)]
 
+    def predict_batch(self, image, points_list, plabs_list, bboxes, threshold):
+        if self.device == 'CPU':
+            self.device = 'cpu'
+        else:
+            self.device = 'cuda'
+
+        # ESAM uses only the boxes
+        detected_masks = self.func_inference.inference_sam_with_boxes(image=image, xyxy=bboxes, model=self.model, device=self.device)
+        return [[mask] for mask in detected_masks]
+
 
 def make_sam_mask(sam, segs, image, detection_hint, dilation,
                   threshold, bbox_expansion, mask_hint_threshold, mask_hint_use_negative):
@@ -657,72 +1200,8 @@ def make_sam_mask(sam, segs, image, detection_hint, dilation,
             total_masks += detected_masks
 
         else:
-            for i in range(len(segs)):
-                bbox = segs[i].bbox
-                center = center_of_bbox(bbox)
-
-                x1 = max(bbox[0] - bbox_expansion, 0)
-                y1 = max(bbox[1] - bbox_expansion, 0)
-                x2 = min(bbox[2] + bbox_expansion, image.shape[1])
-                y2 = min(bbox[3] + bbox_expansion, image.shape[0])
-
-                dilated_bbox = [x1, y1, x2, y2]
-
-                points = []
-                plabs = []
-                if detection_hint == "center-1":
-                    points.append(center)
-                    plabs = [1]  # 1 = foreground point, 0 = background point
-
-                elif detection_hint == "horizontal-2":
-                    gap = (x2 - x1) / 3
-                    points.append((x1 + gap, center[1]))
-                    points.append((x1 + gap * 2, center[1]))
-                    plabs = [1, 1]
-
-                elif detection_hint == "vertical-2":
-                    gap = (y2 - y1) / 3
-                    points.append((center[0], y1 + gap))
-                    points.append((center[0], y1 + gap * 2))
-                    plabs = [1, 1]
-
-                elif detection_hint == "rect-4":
-                    x_gap = (x2 - x1) / 3
-                    y_gap = (y2 - y1) / 3
-                    points.append((x1 + x_gap, center[1]))
-                    points.append((x1 + x_gap * 2, center[1]))
-                    points.append((center[0], y1 + y_gap))
-                    points.append((center[0], y1 + y_gap * 2))
-                    plabs = [1, 1, 1, 1]
-
-                elif detection_hint == "diamond-4":
-                    x_gap = (x2 - x1) / 3
-                    y_gap = (y2 - y1) / 3
-                    points.append((x1 + x_gap, y1 + y_gap))
-                    points.append((x1 + x_gap * 2, y1 + y_gap))
-                    points.append((x1 + x_gap, y1 + y_gap * 2))
-                    points.append((x1 + x_gap * 2, y1 + y_gap * 2))
-                    plabs = [1, 1, 1, 1]
-
-                elif detection_hint == "mask-point-bbox":
-                    center = center_of_bbox(segs[i].bbox)
-                    points.append(center)
-                    plabs = [1]
-
-                elif detection_hint == "mask-area":
-                    points, plabs = gen_detection_hints_from_mask_area(segs[i].crop_region[0], segs[i].crop_region[1],
-                                                                       segs[i].cropped_mask,
-                                                                       mask_hint_threshold, use_small_negative)
-
-                if mask_hint_use_negative == "Outter":
-                    npoints, nplabs = gen_negative_hints(image.shape[0], image.shape[1],
-                                                         segs[i].crop_region[0], segs[i].crop_region[1],
-                                                         segs[i].crop_region[2], segs[i].crop_region[3])
-
-                    points += npoints
-                    plabs += nplabs
-
-                detected_masks = sam_obj.predict(image, points, plabs, dilated_bbox, threshold)
+            for detected_masks in predict_sam_for_segs(sam_obj, image, segs, detection_hint, threshold, bbox_expansion,
+                                                       mask_hint_threshold, use_small_negative, mask_hint_use_negative):
                 total_masks += detected_masks
 
         # merge every collected masks
@@ -839,6 +1318,10 @@ def merge_and_stack_masks(stacked_masks, group_size):
 
 
 def segs_scale_match(segs, target_shape):
+    from impact.segs_array import SEGSArray
+    if isinstance(segs, SEGSArray):
+        return segs.scale_match(target_shape)
+
     h = segs[0][0]
     w = segs[0][1]
 
@@ -878,7 +1361,7 @@ def segs_scale_match(segs, target_shape):
             cropped_image = cropped_image.numpy()
 
         new_seg = SEG(cropped_image, cropped_mask, seg.confidence, crop_region, bbox, seg.label, seg.control_net_wrapper)
-        new_segs.append(new_seg)
+        new_segs.append(pack_seg(new_seg))
 
     return (th, tw), new_segs
 
@@ -890,6 +1373,45 @@ def every_three_pick_last(stacked_masks):
     return selected_masks
 
 
+def predict_sam_for_segs(sam_obj, image, segs, detection_hint, threshold, bbox_expansion,
+                         mask_hint_threshold, use_small_negative, mask_hint_use_negative):
+    """
+    SAM prediction for each seg with the expanded bbox and the detection hints.
+    All boxes are predicted in one batch if the wrapper supports `predict_batch`.
+
+    :return: list of the detected masks for each seg
+    """
+    points_list = []
+    plabs_list = []
+    bboxes = []
+
+    for seg in segs:
+        bbox = seg.bbox
+        center = center_of_bbox(bbox)
+        x1 = max(bbox[0] - bbox_expansion, 0)
+        y1 = max(bbox[1] - bbox_expansion, 0)
+        x2 = min(bbox[2] + bbox_expansion, image.shape[1])
+        y2 = min(bbox[3] + bbox_expansion, image.shape[0])
+
+        dilated_bbox = [x1, y1, x2, y2]
+
+        points, plabs = generate_detection_hints(image, seg, center, detection_hint, dilated_bbox,
+                                                 mask_hint_threshold, use_small_negative,
+                                                 mask_hint_use_negative)
+
+        points_list.append(points)
+        plabs_list.append(plabs)
+        bboxes.append(dilated_bbox)
+
+    if len(bboxes) == 0:
+        return []
+
+    if hasattr(sam_obj, 'predict_batch'):
+        return sam_obj.predict_batch(image, points_list, plabs_list, bboxes, threshold)
+
+    return [sam_obj.predict(image, points, plabs, bbox, threshold) for points, plabs, bbox in zip(points_list, plabs_list, bboxes)]
+
+
 def make_sam_mask_segmented(sam, segs, image, detection_hint, dilation,
                             threshold, bbox_expansion, mask_hint_threshold, mask_hint_use_negative):
 
@@ -927,22 +1449,8 @@ def make_sam_mask_segmented(sam, segs, image, detection_hint, dilation,
             total_masks += detected_masks
 
         else:
-            for i in range(len(segs)):
-                bbox = segs[i].bbox
-                center = center_of_bbox(bbox)
-                x1 = max(bbox[0] - bbox_expansion, 0)
-                y1 = max(bbox[1] - bbox_expansion, 0)
-                x2 = min(bbox[2] + bbox_expansion, image.shape[1])
-                y2 = min(bbox[3] + bbox_expansion, image.shape[0])
-
-                dilated_bbox = [x1, y1, x2, y2]
-
-                points, plabs = generate_detection_hints(image, segs[i], center, detection_hint, dilated_bbox,
-                                                         mask_hint_threshold, use_small_negative,
-                                                         mask_hint_use_negative)
-
-                detected_masks = sam_obj.predict(image, points, plabs, dilated_bbox, threshold)
-
+            for detected_masks in predict_sam_for_segs(sam_obj, image, segs, detection_hint, threshold, bbox_expansion,
+                                                       mask_hint_threshold, use_small_negative, mask_hint_use_negative):
                 total_masks += detected_masks
 
         # merge every collected masks
@@ -980,19 +1488,26 @@ def segs_bitwise_and_mask(segs, mask):
 
     items = []
 
-    mask = (mask.cpu().numpy() * 255).astype(np.uint8)
+    is_binary = is_binary_mask(mask)
+    mask = mask.cpu()
 
     for seg in segs[1]:
-        cropped_mask = (seg.cropped_mask * 255).astype(np.uint8)
         crop_region = seg.crop_region
-
         cropped_mask2 = mask[crop_region[1]:crop_region[3], crop_region[0]:crop_region[2]]
 
-        new_mask = np.bitwise_and(cropped_mask.astype(np.uint8), cropped_mask2)
-        new_mask = new_mask.astype(np.float32) / 255.0
+        packed_mask = get_packed_mask(seg)
+        if packed_mask is not None and is_binary:
+            new_mask = packed_mask & PackedMask.pack_bool(cropped_mask2.numpy() > 0)
+            item = PackedSEG(seg.cropped_image, new_mask, seg.confidence, seg.crop_region, seg.bbox, seg.label, None)
+            items.append(item)
+            continue
+        elif packed_mask is not None:
+            new_mask = mask_algebra.mask_and(packed_mask.to_bool(), cropped_mask2)
+        else:
+            new_mask = mask_algebra.mask_and(seg.cropped_mask, cropped_mask2)
 
-        item = SEG(seg.cropped_image, new_mask, seg.confidence, seg.crop_region, seg.bbox, seg.label, None)
-        items.append(item)
+        item = SEG(seg.cropped_image, new_mask.float().numpy(), seg.confidence, seg.crop_region, seg.bbox, seg.label, None)
+        items.append(pack_seg(item))
 
     return segs[0], items
 
@@ -1006,19 +1521,26 @@ def segs_bitwise_subtract_mask(segs, mask):
 
     items = []
 
-    mask = (mask.cpu().numpy() * 255).astype(np.uint8)
+    is_binary = is_binary_mask(mask)
+    mask = mask.cpu()
 
     for seg in segs[1]:
-        cropped_mask = (seg.cropped_mask * 255).astype(np.uint8)
         crop_region = seg.crop_region
-
         cropped_mask2 = mask[crop_region[1]:crop_region[3], crop_region[0]:crop_region[2]]
 
-        new_mask = cv2.subtract(cropped_mask.astype(np.uint8), cropped_mask2)
-        new_mask = new_mask.astype(np.float32) / 255.0
+        packed_mask = get_packed_mask(seg)
+        if packed_mask is not None and is_binary:
+            new_mask = packed_mask.subtract(PackedMask.pack_bool(cropped_mask2.numpy() > 0))
+            item = PackedSEG(seg.cropped_image, new_mask, seg.confidence, seg.crop_region, seg.bbox, seg.label, None)
+            items.append(item)
+            continue
+        elif packed_mask is not None:
+            new_mask = mask_algebra.mask_subtract(packed_mask.to_bool(), cropped_mask2)
+        else:
+            new_mask = mask_algebra.mask_subtract(seg.cropped_mask, cropped_mask2)
 
-        item = SEG(seg.cropped_image, new_mask, seg.confidence, seg.crop_region, seg.bbox, seg.label, None)
-        items.append(item)
+        item = SEG(seg.cropped_image, new_mask.float().numpy(), seg.confidence, seg.crop_region, seg.bbox, seg.label, None)
+        items.append(pack_seg(item))
 
     return segs[0], items
 
@@ -1030,19 +1552,15 @@ def apply_mask_to_each_seg(segs, masks):
 
     items = []
 
-    masks = masks.squeeze(1)
+    masks = masks.squeeze(1).cpu()
 
     for seg, mask in zip(segs[1], masks):
-        cropped_mask = (seg.cropped_mask * 255).astype(np.uint8)
         crop_region = seg.crop_region
+        cropped_mask2 = mask[crop_region[1]:crop_region[3], crop_region[0]:crop_region[2]]
 
-        cropped_mask2 = (mask.cpu().numpy() * 255).astype(np.uint8)
-        cropped_mask2 = cropped_mask2[crop_region[1]:crop_region[3], crop_region[0]:crop_region[2]]
-
-        new_mask = np.bitwise_and(cropped_mask.astype(np.uint8), cropped_mask2)
-        new_mask = new_mask.astype(np.float32) / 255.0
+        new_mask = mask_algebra.mask_and(seg.cropped_mask, cropped_mask2)
 
-        item = SEG(seg.cropped_image, new_mask, seg.confidence, seg.crop_region, seg.bbox, seg.label, None)
+        item = SEG(seg.cropped_image, new_mask.float().numpy(), seg.confidence, seg.crop_region, seg.bbox, seg.label, None)
         items.append(item)
 
     return segs[0], items
@@ -1052,9 +1570,10 @@ def dilate_segs(segs, factor):
     if factor == 0:
         return segs
 
+    new_masks = dilate_mask_list([make_2d_mask(seg.cropped_mask) for seg in segs[1]], factor)
+
     new_segs = []
-    for seg in segs[1]:
-        new_mask = dilate_mask(seg.cropped_mask, factor)
+    for seg, new_mask in zip(segs[1], new_masks):
         new_seg = SEG(seg.cropped_image, new_mask, seg.confidence, seg.crop_region, seg.bbox, seg.label, seg.control_net_wrapper)
         new_segs.append(new_seg)
 
@@ -1067,52 +1586,72 @@ class ONNXDetector:
     def __init__(self, onnx_model):
         self.onnx_model = onnx_model
 
-    def detect(self, image, threshold, dilation, crop_factor, drop_size=1, detailer_hook=None):
+    @staticmethod
+    def make_segs(h, w, labels, scores, boxes, threshold, dilation, crop_factor, drop_size=1, detailer_hook=None):
         drop_size = max(drop_size, 1)
-        try:
-            import impact.onnx as onnx
 
-            h = image.shape[1]
-            w = image.shape[2]
+        # collect feasible item
+        result = []
 
-            labels, scores, boxes = onnx.onnx_inference(image, self.onnx_model)
+        for i in range(len(labels)):
+            if scores[i] > threshold:
+                item_bbox = boxes[i]
+                x1, y1, x2, y2 = item_bbox
 
-            # collect feasible item
-            result = []
+                if x2 - x1 > drop_size and y2 - y1 > drop_size:  # minimum dimension must be (2,2) to avoid squeeze issue
+                    crop_region = make_crop_region(w, h, item_bbox, crop_factor)
 
-            for i in range(len(labels)):
-                if scores[i] > threshold:
-                    item_bbox = boxes[i]
-                    x1, y1, x2, y2 = item_bbox
+                    if detailer_hook is not None:
+                        crop_region = item_bbox.post_crop_region(w, h, item_bbox, crop_region)
 
-                    if x2 - x1 > drop_size and y2 - y1 > drop_size:  # minimum dimension must be (2,2) to avoid squeeze issue
-                        crop_region = make_crop_region(w, h, item_bbox, crop_factor)
+                    crop_x1, crop_y1, crop_x2, crop_y2, = crop_region
 
-                        if detailer_hook is not None:
-                            crop_region = item_bbox.post_crop_region(w, h, item_bbox, crop_region)
+                    # prepare cropped mask
+                    cropped_mask = np.zeros((crop_y2 - crop_y1, crop_x2 - crop_x1))
+                    cropped_mask[y1 - crop_y1:y2 - crop_y1, x1 - crop_x1:x2 - crop_x1] = 1
+                    cropped_mask = dilate_mask(cropped_mask, dilation)
 
-                        crop_x1, crop_y1, crop_x2, crop_y2, = crop_region
+                    # make items. just convert the integer label to a string
+                    item = SEG(None, cropped_mask, scores[i], crop_region, item_bbox, str(labels[i]), None)
+                    result.append(pack_seg(item))
 
-                        # prepare cropped mask
-                        cropped_mask = np.zeros((crop_y2 - crop_y1, crop_x2 - crop_x1))
-                        cropped_mask[y1 - crop_y1:y2 - crop_y1, x1 - crop_x1:x2 - crop_x1] = 1
-                        cropped_mask = dilate_mask(cropped_mask, dilation)
+        shape = h, w
+        segs = shape, result
 
-                        # make items. just convert the integer label to a string
-                        item = SEG(None, cropped_mask, scores[i], crop_region, item_bbox, str(labels[i]), None)
-                        result.append(item)
+        if detailer_hook is not None and hasattr(detailer_hook, "post_detection"):
+            segs = detailer_hook.post_detection(segs)
 
-            shape = h, w
-            segs = shape, result
+        return segs
+
+    def detect(self, image, threshold, dilation, crop_factor, drop_size=1, detailer_hook=None):
+        try:
+            import impact.onnx as onnx
 
-            if detailer_hook is not None and hasattr(detailer_hook, "post_detection"):
-                segs = detailer_hook.post_detection(segs)
+            h = image.shape[1]
+            w = image.shape[2]
 
-            return segs
+            labels, scores, boxes = onnx.onnx_inference(image, self.onnx_model)
+
+            return ONNXDetector.make_segs(h, w, labels, scores, boxes, threshold, dilation, crop_factor, drop_size, detailer_hook)
         except Exception as e:
             print(f"ONNXDetector: unable to execute.\n{e}")
             pass
 
+    def detect_batch(self, images, threshold, dilation, crop_factor, drop_size=1, detailer_hook=None):
+        """SEGS of each image. The frames are inferred together if the model has a dynamic batch axis."""
+        h = images.shape[1]
+        w = images.shape[2]
+
+        try:
+            import impact.onnx as onnx
+
+            return [ONNXDetector.make_segs(h, w, labels, scores, boxes, threshold, dilation, crop_factor, drop_size, detailer_hook)
+                    for labels, scores, boxes in onnx.onnx_inference_batch(images, self.onnx_model)]
+        except Exception as e:
+            print(f"ONNXDetector: unable to execute.\n{e}")
+            # empty SEGS for every frame, so that the callers can index the result per frame
+            return [((h, w), []) for _ in range(len(images))]
+
     def detect_combined(self, image, threshold, dilation):
         return segs_to_combined_mask(self.detect(image, threshold, dilation, 1))
 
@@ -1120,6 +1659,130 @@ class ONNXDetector:
         pass
 
 
+def detect_batch(detector, images, threshold, dilation, crop_factor, drop_size=1, detailer_hook=None):
+    """
+    SEGS of each image of the batch.
+    The detector which implements `detect_batch` infers the frames together. Otherwise, `detect` is called for each frame.
+    """
+    if hasattr(detector, 'detect_batch'):
+        return detector.detect_batch(images, threshold, dilation, crop_factor, drop_size, detailer_hook)
+
+    return [detector.detect(image.unsqueeze(0), threshold, dilation, crop_factor, drop_size, detailer_hook) for image in images]
+
+
+def frame_to_gray(image):
+    """(h, w, c) IMAGE frame -> (h, w) uint8 grayscale ndarray"""
+    gray = image[..., 0] * 0.299 + image[..., 1] * 0.587 + image[..., 2] * 0.114
+    return (gray.clamp(0, 1) * 255).to(torch.uint8).cpu().numpy()
+
+
+def select_keyframes(grays, interval, change_threshold):
+    """
+    Indices of the keyframes for the tracking mode.
+    A frame is a keyframe if `interval` frames are passed since the last keyframe,
+    or the mean absolute difference of the thumbnails from the last keyframe exceeds `change_threshold`. (0~1)
+    """
+    keyframes = []
+    last_key = None
+    last_thumb = None
+    for i, gray in enumerate(grays):
+        thumb = cv2.resize(gray, (64, 64), interpolation=cv2.INTER_AREA).astype(np.float32) / 255.0
+
+        if last_key is None or i - last_key >= interval or np.abs(thumb - last_thumb).mean() > change_threshold:
+            keyframes.append(i)
+            last_key = i
+            last_thumb = thumb
+
+    return keyframes
+
+
+def track_bbox(key_gray, bbox, gray, offset, search_ratio=0.5, template_size=64):
+    """
+    Find the offset of `bbox` of the keyframe at the frame `gray` by the template matching.
+    The search window is around the previous position (`bbox` + `offset`).
+    The template is downscaled to `template_size` to keep the cost independent of the resolution.
+
+    :return: (offset, score)
+    """
+    x1, y1, x2, y2 = (int(v) for v in bbox[:4])
+    bw = x2 - x1
+    bh = y2 - y1
+    if bw <= 0 or bh <= 0:
+        return offset, 0.0
+
+    h, w = gray.shape
+    mx = int(bw * search_ratio) + 4
+    my = int(bh * search_ratio) + 4
+    px1 = x1 + offset[0]
+    py1 = y1 + offset[1]
+    sx1 = max(0, px1 - mx)
+    sy1 = max(0, py1 - my)
+    sx2 = min(w, px1 + bw + mx)
+    sy2 = min(h, py1 + bh + my)
+
+    template = key_gray[y1:y2, x1:x2]
+    window = gray[sy1:sy2, sx1:sx2]
+
+    scale = min(1.0, template_size / max(bw, bh))
+    if scale < 1.0:
+        template = cv2.resize(template, (max(1, round(bw * scale)), max(1, round(bh * scale))), interpolation=cv2.INTER_AREA)
+        window = cv2.resize(window, (max(1, round((sx2 - sx1) * scale)), max(1, round((sy2 - sy1) * scale))), interpolation=cv2.INTER_AREA)
+
+    if window.shape[0] < template.shape[0] or window.shape[1] < template.shape[1]:
+        return offset, 0.0
+
+    res = cv2.matchTemplate(window, template, cv2.TM_CCOEFF_NORMED)
+    _, score, _, loc = cv2.minMaxLoc(res)
+
+    new_offset = sx1 + round(loc[0] / scale) - x1, sy1 + round(loc[1] / scale) - y1
+    return new_offset, float(score)
+
+
+def shift_seg(seg, offset, image):
+    """
+    Move the seg by `offset`. The offset is clamped so that the crop region stays in the image,
+    so `cropped_mask` is reused as is.
+    """
+    h, w = image.shape[1:3]
+    cx1, cy1, cx2, cy2 = (int(v) for v in seg.crop_region[:4])
+
+    dx = min(max(offset[0], -cx1), w - cx2)
+    dy = min(max(offset[1], -cy1), h - cy2)
+
+    crop_region = cx1 + dx, cy1 + dy, cx2 + dx, cy2 + dy
+    bbox = tuple(int(v) + d for v, d in zip(seg.bbox[:4], (dx, dy, dx, dy)))
+    cropped_image = crop_image(image, crop_region) if seg.cropped_image is not None else None
+
+    return SEG(cropped_image, seg.cropped_mask, seg.confidence, crop_region, bbox, seg.label, seg.control_net_wrapper)
+
+
+def track_segs(key_segs, key_gray, frames, grays, min_score=0.3):
+    """
+    Propagate the SEGS of the keyframe to the following frames.
+
+    :param frames: IMAGE frames after the keyframe
+    :param grays: grayscale of `frames`
+    :return: SEGS of each frame, or None for the frames where the tracking of any seg is lost
+    """
+    offsets = [(0, 0)] * len(key_segs[1])
+    res = []
+
+    for image, gray in zip(frames, grays):
+        lost = False
+        for j, seg in enumerate(key_segs[1]):
+            offsets[j], score = track_bbox(key_gray, seg.bbox, gray, offsets[j])
+            if score < min_score:
+                lost = True
+
+        if lost:
+            res.append(None)
+        else:
+            image = image.unsqueeze(0)
+            res.append((key_segs[0], [shift_seg(seg, offset, image) for seg, offset in zip(key_segs[1], offsets)]))
+
+    return res
+
+
 def batch_mask_to_segs(mask, combined, crop_factor, bbox_fill, drop_size=1, label='A', crop_min_size=None, detailer_hook=None):
     combined_mask = mask.max(dim=0).values
 
@@ -1130,11 +1793,74 @@ def batch_mask_to_segs(mask, combined, crop_factor, bbox_fill, drop_size=1, labe
         x1, y1, x2, y2 = seg.crop_region
         cropped_mask = mask[:, y1:y2, x1:x2]
         item = SEG(None, cropped_mask, 1.0, seg.crop_region, seg.bbox, label, None)
-        new_segs.append(item)
+        new_segs.append(pack_seg(item))
 
     return segs[0], new_segs
 
 
+def mask_outer_components(mask_uint8):
+    """
+    Single pass equivalent of the filled outer contours of `cv2.findContours(RETR_TREE)`.
+
+    The foreground is labeled with 8-connectivity and the background with 4-connectivity (same as the contour tracing).
+    The holes and the blobs inside the holes are merged into the blob which encloses them.
+
+    :return: (filled_labels, stats, labels)
+             filled_labels: (h, w) int32 label image of the filled outer components (0 = outside)
+             stats: stats of `cv2.connectedComponentsWithStats`. (bbox of the outer component)
+             labels: the labels of the outer components in the order of `cv2.findContours`
+    """
+    fg_count, fg_labels, stats, _ = cv2.connectedComponentsWithStats((mask_uint8 != 0).astype(np.uint8), connectivity=8)
+    bg_count, bg_labels, bg_stats, _ = cv2.connectedComponentsWithStats((mask_uint8 == 0).astype(np.uint8), connectivity=4)
+
+    # background regions touching the image border are outside of every blob
+    outside = np.zeros(bg_count, dtype=bool)
+    for border in (bg_labels[0, :], bg_labels[-1, :], bg_labels[:, 0], bg_labels[:, -1]):
+        outside[border] = True
+    outside[0] = False
+
+    def first_pixel(labels, label_stats, j):
+        # the top-left pixel in the raster order. the pixel above it belongs to the enclosing region.
+        x, y, w = label_stats[j][:3]
+        return x + int(np.argmax(labels[y, x:x+w] == j)), y
+
+    # enclosing blob of each hole
+    hole_parent = np.zeros(bg_count, dtype=np.int64)
+    for j in range(1, bg_count):
+        if not outside[j]:
+            x, y = first_pixel(bg_labels, bg_stats, j)
+            hole_parent[j] = fg_labels[y-1, x]
+
+    # enclosing hole of each blob (0 = top level)
+    blob_parent = np.zeros(fg_count, dtype=np.int64)
+    blob_first_pixels = [None]
+    for j in range(1, fg_count):
+        x, y = first_pixel(fg_labels, stats, j)
+        blob_first_pixels.append((y, x))
+        if y > 0 and not outside[bg_labels[y-1, x]]:
+            blob_parent[j] = bg_labels[y-1, x]
+
+    blob_root = np.arange(fg_count, dtype=np.int32)
+    for j in range(1, fg_count):
+        root = j
+        while blob_parent[root] != 0:
+            root = hole_parent[blob_parent[root]]
+        blob_root[j] = root
+
+    hole_root = np.zeros(bg_count, dtype=np.int32)
+    for j in range(1, bg_count):
+        if not outside[j]:
+            hole_root[j] = blob_root[hole_parent[j]]
+
+    filled_labels = blob_root[fg_labels] + hole_root[bg_labels]
+
+    # NOTE: cv2.findContours returns the outer contours in the reverse raster order of their first pixels
+    labels = [j for j in range(1, fg_count) if blob_parent[j] == 0]
+    labels.sort(key=lambda j: blob_first_pixels[j], reverse=True)
+
+    return filled_labels, stats, labels
+
+
 def mask_to_segs(mask, combined, crop_factor, bbox_fill, drop_size=1, label='A', crop_min_size=None, detailer_hook=None, is_contour=True):
     drop_size = max(drop_size, 1)
     if mask is None:
@@ -1189,7 +1915,41 @@ def mask_to_segs(mask, combined, crop_factor, bbox_fill, drop_size=1, label='A',
 
                     if cropped_mask is not None:
                         item = SEG(None, cropped_mask, 1.0, crop_region, bbox, label, None)
-                        result.append(item)
+                        result.append(pack_seg(item))
+
+        elif config.get_config()['mask_to_segs_engine'] == 'components':
+            mask_i_uint8 = (mask_i * 255.0).astype(np.uint8)
+            filled_labels, stats, labels = mask_outer_components(mask_i_uint8)
+
+            for j in labels:
+                x, y, w, h = (int(v) for v in stats[j][:4])
+                bbox = x, y, x + w, y + h
+                crop_region = make_crop_region(
+                    mask_i.shape[1], mask_i.shape[0], bbox, crop_factor, crop_min_size
+                )
+
+                if detailer_hook is not None:
+                    crop_region = detailer_hook.post_crop_region(mask_i.shape[1], mask_i.shape[0], bbox, crop_region)
+
+                if w > drop_size and h > drop_size:
+                    cx1, cy1, cx2, cy2 = crop_region
+                    separated_mask = filled_labels[cy1:cy2, cx1:cx2] == j
+
+                    if is_contour:
+                        cropped_mask = separated_mask.astype(np.float32)
+                    else:
+                        cropped_mask = mask_i[cy1:cy2, cx1:cx2] * separated_mask.astype(np.float32)
+
+                    if bbox_fill:
+                        bx1 = x - cx1
+                        bx2 = x+w - cx1
+                        by1 = y - cy1
+                        by2 = y+h - cy1
+                        cropped_mask[by1:by2, bx1:bx2] = 1.0
+
+                    cropped_mask = np.clip(cropped_mask, 0, 1.0)
+                    item = SEG(None, cropped_mask, 1.0, crop_region, bbox, label, None)
+                    result.append(pack_seg(item))
 
         else:
             mask_i_uint8 = (mask_i * 255.0).astype(np.uint8)
@@ -1236,7 +1996,7 @@ def mask_to_segs(mask, combined, crop_factor, bbox_fill, drop_size=1, label='A',
                     if cropped_mask is not None:
                         cropped_mask = torch.clip(torch.from_numpy(cropped_mask), 0, 1.0)
                         item = SEG(None, cropped_mask.numpy(), 1.0, crop_region, bbox, label, None)
-                        result.append(item)
+                        result.append(pack_seg(item))
 
     if not result:
         print(f"[mask_to_segs] Empty mask.")
@@ -1320,51 +2080,118 @@ def mediapipe_facemesh_to_segs(image, crop_factor, bbox_fill, crop_min_size, dro
     return (image.shape[1], image.shape[2]), segs
 
 
-def segs_to_combined_mask(segs):
-    shape = segs[0]
-    h = shape[0]
-    w = shape[1]
+def seg_mask_tensor(seg):
+    """`cropped_mask` of the seg as float32 or bool tensor. (bool for the packed mask, without decoding to float)"""
+    packed_mask = get_packed_mask(seg)
+    if packed_mask is not None:
+        return torch.from_numpy(packed_mask.to_bool())
 
-    mask = np.zeros((h, w), dtype=np.uint8)
+    cropped_mask = seg.cropped_mask
+    if isinstance(cropped_mask, np.ndarray):
+        if cropped_mask.dtype == bool:
+            return torch.from_numpy(cropped_mask)
+        return torch.from_numpy(cropped_mask.astype(np.float32, copy=False))
 
+    if cropped_mask.dtype == torch.bool:
+        return cropped_mask.cpu()
+
+    return cropped_mask.to(device='cpu', dtype=torch.float32)
+
+
+def segs_mask_frames(segs):
+    """number of frames of the AnimateDiff SEGS (3-dim cropped_mask), or None if every mask is 2-dim"""
+    frames = None
     for seg in segs[1]:
-        cropped_mask = seg.cropped_mask
-        crop_region = seg.crop_region
-        mask[crop_region[1]:crop_region[3], crop_region[0]:crop_region[2]] |= (cropped_mask * 255).astype(np.uint8)
+        packed_mask = get_packed_mask(seg)
+        shape = packed_mask.shape if packed_mask is not None else seg.cropped_mask.shape
+        if len(shape) == 3:
+            frames = shape[0] if frames is None else max(frames, shape[0])
 
-    return torch.from_numpy(mask.astype(np.float32) / 255.0)
+    return frames
 
 
-def segs_to_masklist(segs):
-    shape = segs[0]
-    h = shape[0]
-    w = shape[1]
+def segs_to_combined_mask(segs, out=None):
+    """
+    Union of the masks of the SEGS as (h, w) float32 tensor. (per element max)
+    For the AnimateDiff SEGS, (frames, h, w) tensor is returned and the 2-dim masks are applied to every frame.
+
+    :param out: preallocated float32 tensor of the result shape
+    """
+    h, w = segs[0][:2]
+
+    frames = segs_mask_frames(segs)
+    shape = (h, w) if frames is None else (frames, h, w)
+
+    if out is None:
+        mask = torch.zeros(shape, dtype=torch.float32)
+    else:
+        if tuple(out.shape) != shape:
+            raise Exception(f"[Impact Pack] segs_to_combined_mask: 'out' shape {tuple(out.shape)} doesn't match {shape}")
+        mask = out.zero_()
 
-    masks = []
     for seg in segs[1]:
-        if isinstance(seg.cropped_mask, np.ndarray):
-            cropped_mask = torch.from_numpy(seg.cropped_mask)
+        x1, y1, x2, y2 = seg.crop_region[:4]
+        region = mask[..., y1:y2, x1:x2]
+        cropped_mask = seg_mask_tensor(seg)
+
+        if cropped_mask.ndim == 3:
+            region = region[:len(cropped_mask)]
+
+        if cropped_mask.dtype == torch.bool:
+            region.masked_fill_(cropped_mask, 1.0)
         else:
-            cropped_mask = seg.cropped_mask
+            torch.maximum(region, cropped_mask, out=region)
 
-        if cropped_mask.ndim == 2:
-            cropped_mask = cropped_mask.unsqueeze(0)
+    return mask
 
-        n = len(cropped_mask)
 
-        mask = torch.zeros((n, h, w), dtype=torch.uint8)
-        crop_region = seg.crop_region
-        mask[:, crop_region[1]:crop_region[3], crop_region[0]:crop_region[2]] |= (cropped_mask * 255).to(torch.uint8)
-        mask = (mask / 255.0).to(torch.float32)
+def segs_to_mask_batch(segs, out=None):
+    """
+    Full frame masks of each seg as (n, h, w) float32 tensor. The AnimateDiff seg has one mask per frame.
+    The masks are written to the batch tensor directly.
 
-        for x in mask:
-            masks.append(x)
+    :param out: preallocated float32 tensor of the result shape
+    """
+    h, w = segs[0][:2]
 
-    if len(masks) == 0:
+    counts = []
+    for seg in segs[1]:
+        packed_mask = get_packed_mask(seg)
+        shape = packed_mask.shape if packed_mask is not None else seg.cropped_mask.shape
+        counts.append(shape[0] if len(shape) == 3 else 1)
+
+    shape = (sum(counts), h, w)
+    if out is None:
+        batch = torch.zeros(shape, dtype=torch.float32)
+    else:
+        if tuple(out.shape) != shape:
+            raise Exception(f"[Impact Pack] segs_to_mask_batch: 'out' shape {tuple(out.shape)} doesn't match {shape}")
+        batch = out.zero_()
+
+    i = 0
+    for seg, n in zip(segs[1], counts):
+        x1, y1, x2, y2 = seg.crop_region[:4]
+        batch[i:i+n, y1:y2, x1:x2] = seg_mask_tensor(seg)
+        i += n
+
+    return batch
+
+
+def segs_to_masklist(segs):
+    """
+    Full frame mask of each seg as list of (h, w) float32 tensors. (one per frame for the AnimateDiff seg)
+
+    NOTE: The masks are views into one shared batch tensor (`segs_to_mask_batch`), not separate tensors.
+          Modifying a returned mask in place writes into that shared storage (and every other view of it),
+          and each mask keeps the whole batch alive. Clone it before the in-place operations or keeping it alone.
+    """
+    h, w = segs[0][:2]
+
+    if len(segs[1]) == 0:
         empty_mask = torch.zeros((h, w), dtype=torch.float32, device="cpu")
-        masks = [empty_mask]
+        return [empty_mask]
 
-    return masks
+    return list(segs_to_mask_batch(segs))
 
 
 def vae_decode(vae, samples, use_tile, hook, tile_size=512, overlap=64):
@@ -323,6 +323,9 @@ class SimpleDetectorForAnimateDiff:
                         "segs_pivot": (["Combined mask", "1st frame mask"],),
                         "sam_model_opt": ("SAM_MODEL", SAM_MODEL_TOOLTIP_OPTIONAL),
                         "segm_detector_opt": ("SEGM_DETECTOR", ),
+                        "detection_mode": (["every frame", "keyframes + tracking"], {"tooltip": "keyframes + tracking: The detection (and SAM/SEGM refinement) runs only on the keyframes. The SEGS of the other frames are propagated from the keyframe by template matching."}),
+                        "keyframe_interval": ("INT", {"default": 8, "min": 1, "max": 1000, "step": 1, "tooltip": "Maximum distance between the keyframes in the tracking mode."}),
+                        "scene_change_threshold": ("FLOAT", {"default": 0.1, "min": 0.0, "max": 1.0, "step": 0.01, "tooltip": "In the tracking mode, a frame becomes a keyframe when its difference from the last keyframe exceeds this value."}),
                  }
                 }
 
@@ -332,30 +335,82 @@ class SimpleDetectorForAnimateDiff:
     CATEGORY = "ImpactPack/Detector"
 
     @staticmethod
-    def detect(bbox_detector, image_frames, bbox_threshold, bbox_dilation, crop_factor, drop_size,
-               sub_threshold, sub_dilation, sub_bbox_expansion, sam_mask_hint_threshold,
-               masking_mode="Pivot SEGS", segs_pivot="Combined mask", sam_model_opt=None, segm_detector_opt=None):
+    def detect_frames(bbox_detector, image_frames, bbox_threshold, bbox_dilation, crop_factor, drop_size,
+                      sub_threshold, sub_dilation, sub_bbox_expansion, sam_mask_hint_threshold, sam_model_opt=None, segm_detector_opt=None):
+        """refined SEGS of each frame"""
+        bbox_segs_by_frames = core.detect_batch(bbox_detector, image_frames, bbox_threshold, bbox_dilation, crop_factor, drop_size)
 
-        h = image_frames.shape[1]
-        w = image_frames.shape[2]
+        segm_segs_by_frames = None
+        if sam_model_opt is None and segm_detector_opt is not None:
+            segm_segs_by_frames = core.detect_batch(segm_detector_opt, image_frames, sub_threshold, sub_dilation, crop_factor, drop_size)
 
-        # gather segs for all frames
         segs_by_frames = []
-        for image in image_frames:
+        for i, image in enumerate(image_frames):
             image = image.unsqueeze(0)
-            segs = bbox_detector.detect(image, bbox_threshold, bbox_dilation, crop_factor, drop_size)
+            segs = bbox_segs_by_frames[i]
 
             if sam_model_opt is not None:
                 mask = core.make_sam_mask(sam_model_opt, segs, image, "center-1", sub_dilation,
                                           sub_threshold, sub_bbox_expansion, sam_mask_hint_threshold, False)
                 segs = core.segs_bitwise_and_mask(segs, mask)
             elif segm_detector_opt is not None:
-                segm_segs = segm_detector_opt.detect(image, sub_threshold, sub_dilation, crop_factor, drop_size)
-                mask = core.segs_to_combined_mask(segm_segs)
+                mask = core.segs_to_combined_mask(segm_segs_by_frames[i])
                 segs = core.segs_bitwise_and_mask(segs, mask)
 
             segs_by_frames.append(segs)
 
+        return segs_by_frames
+
+    @staticmethod
+    def detect_frames_with_tracking(image_frames, keyframe_interval, scene_change_threshold, detect_frames):
+        """
+        Run `detect_frames` only on the keyframes and propagate their SEGS to the other frames.
+        The frames where the tracking is lost are detected too.
+        """
+        grays = [core.frame_to_gray(image) for image in image_frames]
+        keyframes = core.select_keyframes(grays, keyframe_interval, scene_change_threshold)
+
+        segs_by_frames = [None] * len(image_frames)
+        for i, segs in zip(keyframes, detect_frames(image_frames[keyframes])):
+            segs_by_frames[i] = segs
+
+        bounds = keyframes + [len(image_frames)]
+        for k in range(len(keyframes)):
+            start = bounds[k]
+            end = bounds[k+1]
+            if end - start > 1 and segs_by_frames[start] is not None:
+                tracked = core.track_segs(segs_by_frames[start], grays[start], image_frames[start+1:end], grays[start+1:end])
+                segs_by_frames[start+1:end] = tracked
+
+        lost_frames = [i for i, segs in enumerate(segs_by_frames) if segs is None]
+        if len(lost_frames) > 0:
+            for i, segs in zip(lost_frames, detect_frames(image_frames[lost_frames])):
+                segs_by_frames[i] = segs
+
+        print(f"[SimpleDetectorForAnimateDiff] detected frames: {len(keyframes) + len(lost_frames)} / {len(image_frames)}")
+
+        return segs_by_frames
+
+    @staticmethod
+    def detect(bbox_detector, image_frames, bbox_threshold, bbox_dilation, crop_factor, drop_size,
+               sub_threshold, sub_dilation, sub_bbox_expansion, sam_mask_hint_threshold,
+               masking_mode="Pivot SEGS", segs_pivot="Combined mask", sam_model_opt=None, segm_detector_opt=None,
+               detection_mode="every frame", keyframe_interval=8, scene_change_threshold=0.1):
+
+        h = image_frames.shape[1]
+        w = image_frames.shape[2]
+
+        def detect_frames(frames):
+            return SimpleDetectorForAnimateDiff.detect_frames(bbox_detector, frames, bbox_threshold, bbox_dilation, crop_factor, drop_size,
+                                                              sub_threshold, sub_dilation, sub_bbox_expansion, sam_mask_hint_threshold,
+                                                              sam_model_opt, segm_detector_opt)
+
+        # gather segs for all frames
+        if detection_mode == "keyframes + tracking":
+            segs_by_frames = SimpleDetectorForAnimateDiff.detect_frames_with_tracking(image_frames, keyframe_interval, scene_change_threshold, detect_frames)
+        else:
+            segs_by_frames = detect_frames(image_frames)
+
         def get_masked_frames():
             masks_by_frame = []
             for i, segs in enumerate(segs_by_frames):
@@ -431,8 +486,8 @@ class SimpleDetectorForAnimateDiff:
 
             new_segs = []
             for seg in pivot_segs[1]:
-                cropped_mask = torch.zeros(seg.cropped_mask.shape, dtype=torch.float32, device="cpu").unsqueeze(0)
-                pivot_mask = torch.from_numpy(seg.cropped_mask)
+                pivot_mask = torch.as_tensor(seg.cropped_mask)  # decode the packed mask once
+                cropped_mask = torch.zeros(pivot_mask.shape, dtype=torch.float32, device="cpu").unsqueeze(0)
                 x1, y1, x2, y2 = seg.crop_region
                 for mask in masks_by_frame:
                     cropped_mask_at_frame = (mask[y1:y2, x1:x2] * pivot_mask).unsqueeze(0)
@@ -442,7 +497,7 @@ class SimpleDetectorForAnimateDiff:
                     cropped_mask = cropped_mask[1:]
 
                 new_seg = SEG(seg.cropped_image, cropped_mask, seg.confidence, seg.crop_region, seg.bbox, seg.label, seg.control_net_wrapper)
-                new_segs.append(new_seg)
+                new_segs.append(core.pack_seg(new_seg))
 
             return pivot_segs[0], new_segs
 
@@ -458,8 +513,10 @@ class SimpleDetectorForAnimateDiff:
 
     def doit(self, bbox_detector, image_frames, bbox_threshold, bbox_dilation, crop_factor, drop_size,
              sub_threshold, sub_dilation, sub_bbox_expansion, sam_mask_hint_threshold,
-             masking_mode="Pivot SEGS", segs_pivot="Combined mask", sam_model_opt=None, segm_detector_opt=None):
+             masking_mode="Pivot SEGS", segs_pivot="Combined mask", sam_model_opt=None, segm_detector_opt=None,
+             detection_mode="every frame", keyframe_interval=8, scene_change_threshold=0.1):
 
         return SimpleDetectorForAnimateDiff.detect(bbox_detector, image_frames, bbox_threshold, bbox_dilation, crop_factor, drop_size,
                                                    sub_threshold, sub_dilation, sub_bbox_expansion, sam_mask_hint_threshold,
-                                                   masking_mode, segs_pivot, sam_model_opt, segm_detector_opt)
+                                                   masking_mode, segs_pivot, sam_model_opt, segm_detector_opt,
+                                                   detection_mode, keyframe_interval, scene_change_threshold)
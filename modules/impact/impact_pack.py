@@ -39,6 +39,8 @@ except Exception:
 
 warnings.filterwarnings('ignore', category=UserWarning, message='TypedStorage is deprecated')
 
+DETAIL_BATCH_SIZE_INPUT = ("INT", {"default": 1, "min": 1, "max": 64, "step": 1, "tooltip": "When greater than 1, non-overlapping segments with the same upscaled size are sampled together as one latent batch of up to this size.\nSegments with a detailer_hook, controlnet, wildcard or inpaint_model are always processed one by one."})
+
 model_path = folder_paths.models_dir
 
 
@@ -63,6 +65,12 @@ class ONNXDetectorProvider:
 
     def load_onnx(self, model_name):
         model = folder_paths.get_full_path("onnx", model_name)
+
+        # warm up: create the cached session at loading time
+        import impact.onnx as onnx
+        if hasattr(onnx, 'get_session'):
+            onnx.get_session(model)
+
         return (core.ONNXDetector(model), )
 
 
@@ -217,6 +225,7 @@ class DetailerForEach:
                     "inpaint_model": ("BOOLEAN", {"default": False, "label_on": "enabled", "label_off": "disabled"}),
                     "noise_mask_feather": ("INT", {"default": 20, "min": 0, "max": 100, "step": 1}),
                     "scheduler_func_opt": ("SCHEDULER_FUNC",),
+                    "detail_batch_size": DETAIL_BATCH_SIZE_INPUT,
                    }
                 }
 
@@ -229,7 +238,7 @@ class DetailerForEach:
     def do_detail(image, segs, model, clip, vae, guide_size, guide_size_for_bbox, max_size, seed, steps, cfg, sampler_name, scheduler,
                   positive, negative, denoise, feather, noise_mask, force_inpaint, wildcard_opt=None, detailer_hook=None,
                   refiner_ratio=None, refiner_model=None, refiner_clip=None, refiner_positive=None, refiner_negative=None,
-                  cycle=1, inpaint_model=False, noise_mask_feather=0, scheduler_func_opt=None):
+                  cycle=1, inpaint_model=False, noise_mask_feather=0, scheduler_func_opt=None, detail_batch_size=1):
 
         if len(image) > 1:
             raise Exception('[Impact Pack] ERROR: DetailerForEach does not allow image batches.\nPlease refer to https://github.com/ltdrdata/ComfyUI-extension-tutorials/blob/Main/ComfyUI-Impact-Pack/tutorial/batching-detailer.md for more information.')
@@ -265,22 +274,83 @@ class DetailerForEach:
         else:
             ordered_segs = segs[1]
 
+        size_plan = core.plan_segs_detail_sizes(ordered_segs, guide_size, guide_size_for_bbox, max_size, force_inpaint, model)
+        print(f"Detailer: size plan - {size_plan.summary()}")
+
         if noise_mask_feather > 0 and 'denoise_mask_function' not in model.model_options:
             model = nodes_differential_diffusion.DifferentialDiffusion().apply(model)[0]
 
+        def paste_enhanced(seg, mask, orig_cropped_image, enhanced_image, cnet_pils):
+            nonlocal image
+
+            if cnet_pils is not None:
+                cnet_pil_list.extend(cnet_pils)
+
+            if not (enhanced_image is None):
+                # don't latent composite-> converting to latent caused poor quality
+                # use image paste (in place on the canvas, without moving the canvas)
+                enhanced_image = enhanced_image.cpu()
+                tensor_paste(image, enhanced_image.to(image.device), (seg.crop_region[0], seg.crop_region[1]), mask.to(image.device))
+                enhanced_list.append(enhanced_image)
+
+                if detailer_hook is not None:
+                    image = detailer_hook.post_paste(image)
+
+            if not (enhanced_image is None):
+                # Convert enhanced_pil_alpha to RGBA mode
+                enhanced_image_alpha = tensor_convert_rgba(enhanced_image)
+                new_seg_image = enhanced_image.numpy()  # alpha should not be applied to seg_image
+
+                # Apply the mask
+                mask = tensor_resize(mask, *tensor_get_size(enhanced_image))
+                tensor_putalpha(enhanced_image_alpha, mask)
+                enhanced_alpha_list.append(enhanced_image_alpha)
+            else:
+                new_seg_image = None
+
+            cropped_list.append(orig_cropped_image.cpu())  # NOTE: Don't use `cropped_image`
+
+            new_seg = seg._replace(cropped_image=new_seg_image)  # keeps the packed mask
+            new_segs.append(new_seg)
+
+        # Batched detailing: non-overlapping segments are queued and sampled together.
+        # The queue is flushed before an overlapping segment, so that it is cropped from the already pasted image.
+        pending = []
+
+        def flush_pending():
+            if len(pending) == 0:
+                return False
+
+            enhanced_images = core.enhance_detail_batch([x[2] for x in pending], model, clip, vae, guide_size, guide_size_for_bbox, max_size,
+                                                        [x[0].bbox for x in pending], [x[3] for x in pending], steps, cfg, sampler_name, scheduler,
+                                                        positive, negative, denoise, [x[5] for x in pending] if noise_mask else None, force_inpaint,
+                                                        refiner_ratio=refiner_ratio, refiner_model=refiner_model,
+                                                        refiner_clip=refiner_clip, refiner_positive=refiner_positive,
+                                                        refiner_negative=refiner_negative, cycle=cycle, noise_mask_feather=noise_mask_feather,
+                                                        scheduler_func=scheduler_func_opt, batch_size=detail_batch_size,
+                                                        size_plan=size_plan, plan_indices=[x[4] for x in pending])
+
+            for (x_seg, x_mask, x_cropped_image, _, _, _), enhanced_image in zip(pending, enhanced_images):
+                paste_enhanced(x_seg, x_mask, x_cropped_image, enhanced_image, None)
+
+            pending.clear()
+            return True
+
         for i, seg in enumerate(ordered_segs):
-            cropped_image = crop_ndarray4(image.cpu().numpy(), seg.crop_region)  # Never use seg.cropped_image to handle overlapping area
-            cropped_image = to_tensor(cropped_image)
-            mask = to_tensor(seg.cropped_mask)
+            # Never use seg.cropped_image to handle overlapping area
+            # Only the crop region is copied, since the canvas is modified in place by the pasting.
+            cropped_image = crop_tensor4(image, seg.crop_region).clone()
+            seg_mask = seg.cropped_mask  # decode the packed mask once
+            mask = to_tensor(seg_mask)
             mask = tensor_gaussian_blur_mask(mask, feather)
 
-            is_mask_all_zeros = (seg.cropped_mask == 0).all().item()
+            is_mask_all_zeros = (seg_mask == 0).all().item()
             if is_mask_all_zeros:
                 print(f"Detailer: segment skip [empty mask]")
                 continue
 
             if noise_mask:
-                cropped_mask = seg.cropped_mask
+                cropped_mask = seg_mask
             else:
                 cropped_mask = None
 
@@ -319,7 +389,17 @@ class DetailerForEach:
             if wildcard_item and wildcard_item.strip() == '[STOP]':
                 break
 
-            orig_cropped_image = cropped_image.clone()
+            if detail_batch_size > 1 and core.is_batchable_segment(seg, positive, negative, wildcard_item, detailer_hook, inpaint_model):
+                if any(core.is_overlapped_region(seg.crop_region, x[0].crop_region) for x in pending) and flush_pending():
+                    cropped_image = crop_tensor4(image, seg.crop_region).clone()
+
+                pending.append((seg, mask, cropped_image, seg_seed, i, cropped_mask))
+                continue
+
+            if flush_pending():
+                cropped_image = crop_tensor4(image, seg.crop_region).clone()
+
+            orig_cropped_image = cropped_image
             enhanced_image, cnet_pils = core.enhance_detail(cropped_image, model, clip, vae, guide_size, guide_size_for_bbox, max_size,
                                                             seg.bbox, seg_seed, steps, cfg, sampler_name, scheduler,
                                                             cropped_positive, cropped_negative, denoise, cropped_mask, force_inpaint,
@@ -329,38 +409,11 @@ class DetailerForEach:
                                                             refiner_clip=refiner_clip, refiner_positive=refiner_positive,
                                                             refiner_negative=refiner_negative, control_net_wrapper=seg.control_net_wrapper,
                                                             cycle=cycle, inpaint_model=inpaint_model, noise_mask_feather=noise_mask_feather,
-                                                            scheduler_func=scheduler_func_opt)
-
-            if cnet_pils is not None:
-                cnet_pil_list.extend(cnet_pils)
-
-            if not (enhanced_image is None):
-                # don't latent composite-> converting to latent caused poor quality
-                # use image paste
-                image = image.cpu()
-                enhanced_image = enhanced_image.cpu()
-                tensor_paste(image, enhanced_image, (seg.crop_region[0], seg.crop_region[1]), mask)  # this code affecting to `cropped_image`.
-                enhanced_list.append(enhanced_image)
-
-                if detailer_hook is not None:
-                    image = detailer_hook.post_paste(image)
-
-            if not (enhanced_image is None):
-                # Convert enhanced_pil_alpha to RGBA mode
-                enhanced_image_alpha = tensor_convert_rgba(enhanced_image)
-                new_seg_image = enhanced_image.numpy()  # alpha should not be applied to seg_image
-
-                # Apply the mask
-                mask = tensor_resize(mask, *tensor_get_size(enhanced_image))
-                tensor_putalpha(enhanced_image_alpha, mask)
-                enhanced_alpha_list.append(enhanced_image_alpha)
-            else:
-                new_seg_image = None
+                                                            scheduler_func=scheduler_func_opt, size_plan=size_plan, plan_index=i)
 
-            cropped_list.append(orig_cropped_image) # NOTE: Don't use `cropped_image`
+            paste_enhanced(seg, mask, orig_cropped_image, enhanced_image, cnet_pils)
 
-            new_seg = SEG(new_seg_image, seg.cropped_mask, seg.confidence, seg.crop_region, seg.bbox, seg.label, seg.control_net_wrapper)
-            new_segs.append(new_seg)
+        flush_pending()
 
         image_tensor = tensor_convert_rgb(image)
 
@@ -372,13 +425,14 @@ class DetailerForEach:
 
     def doit(self, image, segs, model, clip, vae, guide_size, guide_size_for, max_size, seed, steps, cfg, sampler_name,
              scheduler, positive, negative, denoise, feather, noise_mask, force_inpaint, wildcard, cycle=1,
-             detailer_hook=None, inpaint_model=False, noise_mask_feather=0, scheduler_func_opt=None):
+             detailer_hook=None, inpaint_model=False, noise_mask_feather=0, scheduler_func_opt=None, detail_batch_size=1):
 
         enhanced_img, *_ = \
             DetailerForEach.do_detail(image, segs, model, clip, vae, guide_size, guide_size_for, max_size, seed, steps,
                                       cfg, sampler_name, scheduler, positive, negative, denoise, feather, noise_mask,
                                       force_inpaint, wildcard, detailer_hook,
-                                      cycle=cycle, inpaint_model=inpaint_model, noise_mask_feather=noise_mask_feather, scheduler_func_opt=scheduler_func_opt)
+                                      cycle=cycle, inpaint_model=inpaint_model, noise_mask_feather=noise_mask_feather, scheduler_func_opt=scheduler_func_opt,
+                                      detail_batch_size=detail_batch_size)
 
         return (enhanced_img, )
 
@@ -413,6 +467,7 @@ class DetailerForEachPipe:
                       "inpaint_model": ("BOOLEAN", {"default": False, "label_on": "enabled", "label_off": "disabled"}),
                       "noise_mask_feather": ("INT", {"default": 20, "min": 0, "max": 100, "step": 1}),
                       "scheduler_func_opt": ("SCHEDULER_FUNC",),
+                      "detail_batch_size": DETAIL_BATCH_SIZE_INPUT,
                      }
                 }
 
@@ -426,7 +481,7 @@ class DetailerForEachPipe:
     def doit(self, image, segs, guide_size, guide_size_for, max_size, seed, steps, cfg, sampler_name, scheduler,
              denoise, feather, noise_mask, force_inpaint, basic_pipe, wildcard,
              refiner_ratio=None, detailer_hook=None, refiner_basic_pipe_opt=None,
-             cycle=1, inpaint_model=False, noise_mask_feather=0, scheduler_func_opt=None):
+             cycle=1, inpaint_model=False, noise_mask_feather=0, scheduler_func_opt=None, detail_batch_size=1):
 
         if len(image) > 1:
             raise Exception('[Impact Pack] ERROR: DetailerForEach does not allow image batches.\nPlease refer to https://github.com/ltdrdata/ComfyUI-extension-tutorials/blob/Main/ComfyUI-Impact-Pack/tutorial/batching-detailer.md for more information.')
@@ -444,7 +499,8 @@ class DetailerForEachPipe:
                                       force_inpaint, wildcard, detailer_hook,
                                       refiner_ratio=refiner_ratio, refiner_model=refiner_model,
                                       refiner_clip=refiner_clip, refiner_positive=refiner_positive, refiner_negative=refiner_negative,
-                                      cycle=cycle, inpaint_model=inpaint_model, noise_mask_feather=noise_mask_feather, scheduler_func_opt=scheduler_func_opt)
+                                      cycle=cycle, inpaint_model=inpaint_model, noise_mask_feather=noise_mask_feather, scheduler_func_opt=scheduler_func_opt,
+                                      detail_batch_size=detail_batch_size)
 
         # set fallback image
         if len(cnet_pil_list) == 0:
@@ -501,6 +557,7 @@ class FaceDetailer:
                     "inpaint_model": ("BOOLEAN", {"default": False, "label_on": "enabled", "label_off": "disabled"}),
                     "noise_mask_feather": ("INT", {"default": 20, "min": 0, "max": 100, "step": 1}),
                     "scheduler_func_opt": ("SCHEDULER_FUNC",),
+                    "detail_batch_size": DETAIL_BATCH_SIZE_INPUT,
                 }}
 
     RETURN_TYPES = ("IMAGE", "IMAGE", "IMAGE", "MASK", "DETAILER_PIPE", "IMAGE")
@@ -518,7 +575,7 @@ class FaceDetailer:
                      sam_mask_hint_use_negative, drop_size,
                      bbox_detector, segm_detector=None, sam_model_opt=None, wildcard_opt=None, detailer_hook=None,
                      refiner_ratio=None, refiner_model=None, refiner_clip=None, refiner_positive=None, refiner_negative=None, cycle=1,
-                     inpaint_model=False, noise_mask_feather=0, scheduler_func_opt=None):
+                     inpaint_model=False, noise_mask_feather=0, scheduler_func_opt=None, detail_batch_size=1):
 
         # make default prompt as 'face' if empty prompt for CLIPSeg
         bbox_detector.setAux('face')
@@ -550,7 +607,8 @@ class FaceDetailer:
                                           refiner_ratio=refiner_ratio, refiner_model=refiner_model,
                                           refiner_clip=refiner_clip, refiner_positive=refiner_positive,
                                           refiner_negative=refiner_negative,
-                                          cycle=cycle, inpaint_model=inpaint_model, noise_mask_feather=noise_mask_feather, scheduler_func_opt=scheduler_func_opt)
+                                          cycle=cycle, inpaint_model=inpaint_model, noise_mask_feather=noise_mask_feather, scheduler_func_opt=scheduler_func_opt,
+                                          detail_batch_size=detail_batch_size)
         else:
             enhanced_img = image
             cropped_enhanced = []
@@ -576,10 +634,11 @@ class FaceDetailer:
              bbox_threshold, bbox_dilation, bbox_crop_factor,
              sam_detection_hint, sam_dilation, sam_threshold, sam_bbox_expansion, sam_mask_hint_threshold,
              sam_mask_hint_use_negative, drop_size, bbox_detector, wildcard, cycle=1,
-             sam_model_opt=None, segm_detector_opt=None, detailer_hook=None, inpaint_model=False, noise_mask_feather=0, scheduler_func_opt=None):
+             sam_model_opt=None, segm_detector_opt=None, detailer_hook=None, inpaint_model=False, noise_mask_feather=0, scheduler_func_opt=None,
+             detail_batch_size=1):
 
-        result_img = None
-        result_mask = None
+        result_img = TensorBatchBuilder(len(image))
+        result_mask = TensorBatchBuilder(len(image))
         result_cropped_enhanced = []
         result_cropped_enhanced_alpha = []
         result_cnet_images = []
@@ -594,16 +653,17 @@ class FaceDetailer:
                 bbox_threshold, bbox_dilation, bbox_crop_factor,
                 sam_detection_hint, sam_dilation, sam_threshold, sam_bbox_expansion, sam_mask_hint_threshold,
                 sam_mask_hint_use_negative, drop_size, bbox_detector, segm_detector_opt, sam_model_opt, wildcard, detailer_hook,
-                cycle=cycle, inpaint_model=inpaint_model, noise_mask_feather=noise_mask_feather, scheduler_func_opt=scheduler_func_opt)
+                cycle=cycle, inpaint_model=inpaint_model, noise_mask_feather=noise_mask_feather, scheduler_func_opt=scheduler_func_opt,
+                detail_batch_size=detail_batch_size)
 
-            result_img = torch.cat((result_img, enhanced_img), dim=0) if result_img is not None else enhanced_img
-            result_mask = torch.cat((result_mask, mask), dim=0) if result_mask is not None else mask
+            result_img.concat(enhanced_img)
+            result_mask.concat(mask)
             result_cropped_enhanced.extend(cropped_enhanced)
             result_cropped_enhanced_alpha.extend(cropped_enhanced_alpha)
             result_cnet_images.extend(cnet_pil_list)
 
         pipe = (model, clip, vae, positive, negative, wildcard, bbox_detector, segm_detector_opt, sam_model_opt, detailer_hook, None, None, None, None)
-        return result_img, result_cropped_enhanced, result_cropped_enhanced_alpha, result_mask, pipe, result_cnet_images
+        return result_img.tensor, result_cropped_enhanced, result_cropped_enhanced_alpha, result_mask.tensor, pipe, result_cnet_images
 
 
 class LatentPixelScale:
@@ -1364,6 +1424,7 @@ class FaceDetailerPipe:
                     "inpaint_model": ("BOOLEAN", {"default": False, "label_on": "enabled", "label_off": "disabled"}),
                     "noise_mask_feather": ("INT", {"default": 20, "min": 0, "max": 100, "step": 1}),
                     "scheduler_func_opt": ("SCHEDULER_FUNC",),
+                    "detail_batch_size": DETAIL_BATCH_SIZE_INPUT,
                    }
                 }
 
@@ -1378,10 +1439,10 @@ class FaceDetailerPipe:
              denoise, feather, noise_mask, force_inpaint, bbox_threshold, bbox_dilation, bbox_crop_factor,
              sam_detection_hint, sam_dilation, sam_threshold, sam_bbox_expansion,
              sam_mask_hint_threshold, sam_mask_hint_use_negative, drop_size, refiner_ratio=None,
-             cycle=1, inpaint_model=False, noise_mask_feather=0, scheduler_func_opt=None):
+             cycle=1, inpaint_model=False, noise_mask_feather=0, scheduler_func_opt=None, detail_batch_size=1):
 
-        result_img = None
-        result_mask = None
+        result_img = TensorBatchBuilder(len(image))
+        result_mask = TensorBatchBuilder(len(image))
         result_cropped_enhanced = []
         result_cropped_enhanced_alpha = []
         result_cnet_images = []
@@ -1401,10 +1462,11 @@ class FaceDetailerPipe:
                 sam_mask_hint_use_negative, drop_size, bbox_detector, segm_detector, sam_model_opt, wildcard, detailer_hook,
                 refiner_ratio=refiner_ratio, refiner_model=refiner_model,
                 refiner_clip=refiner_clip, refiner_positive=refiner_positive, refiner_negative=refiner_negative,
-                cycle=cycle, inpaint_model=inpaint_model, noise_mask_feather=noise_mask_feather, scheduler_func_opt=scheduler_func_opt)
+                cycle=cycle, inpaint_model=inpaint_model, noise_mask_feather=noise_mask_feather, scheduler_func_opt=scheduler_func_opt,
+                detail_batch_size=detail_batch_size)
 
-            result_img = torch.cat((result_img, enhanced_img), dim=0) if result_img is not None else enhanced_img
-            result_mask = torch.cat((result_mask, mask), dim=0) if result_mask is not None else mask
+            result_img.concat(enhanced_img)
+            result_mask.concat(mask)
             result_cropped_enhanced.extend(cropped_enhanced)
             result_cropped_enhanced_alpha.extend(cropped_enhanced_alpha)
             result_cnet_images.extend(cnet_pil_list)
@@ -1418,7 +1480,7 @@ class FaceDetailerPipe:
         if len(result_cnet_images) == 0:
             result_cnet_images = [empty_pil_tensor()]
 
-        return result_img, result_cropped_enhanced, result_cropped_enhanced_alpha, result_mask, detailer_pipe, result_cnet_images
+        return result_img.tensor, result_cropped_enhanced, result_cropped_enhanced_alpha, result_mask.tensor, detailer_pipe, result_cnet_images
 
 
 class MaskDetailerPipe:
@@ -1490,7 +1552,7 @@ class MaskDetailerPipe:
         else:
             segs = ((image.shape[1], image.shape[2]), [])
 
-        enhanced_img_batch = None
+        enhanced_img_batch = TensorBatchBuilder(batch_size)
         cropped_enhanced_list = []
         cropped_enhanced_alpha_list = []
 
@@ -1506,10 +1568,7 @@ class MaskDetailerPipe:
             else:
                 enhanced_img, cropped_enhanced, cropped_enhanced_alpha = image, [], []
 
-            if enhanced_img_batch is None:
-                enhanced_img_batch = enhanced_img
-            else:
-                enhanced_img_batch = torch.cat((enhanced_img_batch, enhanced_img), dim=0)
+            enhanced_img_batch.concat(enhanced_img)
 
             cropped_enhanced_list += cropped_enhanced
             cropped_enhanced_alpha_list += cropped_enhanced_alpha
@@ -1521,7 +1580,7 @@ class MaskDetailerPipe:
         if len(cropped_enhanced_alpha_list) == 0:
             cropped_enhanced_alpha_list = [empty_pil_tensor()]
 
-        return enhanced_img_batch, cropped_enhanced_list, cropped_enhanced_alpha_list, basic_pipe, refiner_basic_pipe_opt
+        return enhanced_img_batch.tensor, cropped_enhanced_list, cropped_enhanced_alpha_list, basic_pipe, refiner_basic_pipe_opt
 
 
 class DetailerForEachTest(DetailerForEach):
@@ -1535,7 +1594,7 @@ class DetailerForEachTest(DetailerForEach):
 
     def doit(self, image, segs, model, clip, vae, guide_size, guide_size_for, max_size, seed, steps, cfg, sampler_name,
              scheduler, positive, negative, denoise, feather, noise_mask, force_inpaint, wildcard, detailer_hook=None,
-             cycle=1, inpaint_model=False, noise_mask_feather=0, scheduler_func_opt=None):
+             cycle=1, inpaint_model=False, noise_mask_feather=0, scheduler_func_opt=None, detail_batch_size=1):
 
         if len(image) > 1:
             raise Exception('[Impact Pack] ERROR: DetailerForEach does not allow image batches.\nPlease refer to https://github.com/ltdrdata/ComfyUI-extension-tutorials/blob/Main/ComfyUI-Impact-Pack/tutorial/batching-detailer.md for more information.')
@@ -1544,7 +1603,8 @@ class DetailerForEachTest(DetailerForEach):
             DetailerForEach.do_detail(image, segs, model, clip, vae, guide_size, guide_size_for, max_size, seed, steps,
                                       cfg, sampler_name, scheduler, positive, negative, denoise, feather, noise_mask,
                                       force_inpaint, wildcard, detailer_hook,
-                                      cycle=cycle, inpaint_model=inpaint_model, noise_mask_feather=noise_mask_feather, scheduler_func_opt=scheduler_func_opt)
+                                      cycle=cycle, inpaint_model=inpaint_model, noise_mask_feather=noise_mask_feather, scheduler_func_opt=scheduler_func_opt,
+                                      detail_batch_size=detail_batch_size)
 
         # set fallback image
         if len(cropped) == 0:
@@ -1573,7 +1633,8 @@ class DetailerForEachTestPipe(DetailerForEachPipe):
 
     def doit(self, image, segs, guide_size, guide_size_for, max_size, seed, steps, cfg, sampler_name, scheduler,
              denoise, feather, noise_mask, force_inpaint, basic_pipe, wildcard, cycle=1,
-             refiner_ratio=None, detailer_hook=None, refiner_basic_pipe_opt=None, inpaint_model=False, noise_mask_feather=0, scheduler_func_opt=None):
+             refiner_ratio=None, detailer_hook=None, refiner_basic_pipe_opt=None, inpaint_model=False, noise_mask_feather=0, scheduler_func_opt=None,
+             detail_batch_size=1):
 
         if len(image) > 1:
             raise Exception('[Impact Pack] ERROR: DetailerForEach does not allow image batches.\nPlease refer to https://github.com/ltdrdata/ComfyUI-extension-tutorials/blob/Main/ComfyUI-Impact-Pack/tutorial/batching-detailer.md for more information.')
@@ -1592,7 +1653,8 @@ class DetailerForEachTestPipe(DetailerForEachPipe):
                                       refiner_ratio=refiner_ratio, refiner_model=refiner_model,
                                       refiner_clip=refiner_clip, refiner_positive=refiner_positive,
                                       refiner_negative=refiner_negative,
-                                      cycle=cycle, inpaint_model=inpaint_model, noise_mask_feather=noise_mask_feather, scheduler_func_opt=scheduler_func_opt)
+                                      cycle=cycle, inpaint_model=inpaint_model, noise_mask_feather=noise_mask_feather, scheduler_func_opt=scheduler_func_opt,
+                                      detail_batch_size=detail_batch_size)
 
         # set fallback image
         if len(cropped) == 0:
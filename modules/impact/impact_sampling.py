@@ -6,6 +6,7 @@ import latent_preview
 import comfy
 import torch
 import math
+import inspect
 import comfy.model_management as mm
 
 
@@ -45,7 +46,39 @@ def get_noise_sampler(x, cpu, total_sigmas, **kwargs):
     return None
 
 
-def ksampler(sampler_name, total_sigmas, extra_options={}, inpaint_options={}):
+def batch_noise_sampler(x, seeds, sampler_name, sigmas, total_sigmas):
+    """
+    Noise sampler which draws the noise of each batch item from its own seed,
+    so that an item gets the same noise as when it is sampled alone with that seed.
+    """
+    brownian_cpu = not sampler_name.endswith('_gpu')
+
+    if sampler_name in ['dpmpp_sde', 'dpmpp_sde_gpu', 'dpmpp_2m_sde', 'dpmpp_2m_sde_gpu', 'dpmpp_3m_sde', 'dpmpp_3m_sde_gpu']:
+        # same as `get_noise_sampler`
+        sigma_min, sigma_max = total_sigmas[total_sigmas > 0].min(), total_sigmas.max()
+        item_samplers = [k_diffusion_sampling.BrownianTreeNoiseSampler(x[i:i+1], sigma_min, sigma_max, seed=seed, cpu=brownian_cpu)
+                         for i, seed in enumerate(seeds)]
+    elif 'sde' in sampler_name and sampler_name != 'er_sde':
+        sigma_min, sigma_max = sigmas[sigmas > 0].min(), sigmas.max()
+        item_samplers = [k_diffusion_sampling.BrownianTreeNoiseSampler(x[i:i+1], sigma_min, sigma_max, seed=seed, cpu=brownian_cpu)
+                         for i, seed in enumerate(seeds)]
+    else:
+        item_samplers = [k_diffusion_sampling.default_noise_sampler(x[i:i+1], seed=seed) for i, seed in enumerate(seeds)]
+
+    return lambda sigma, sigma_next: torch.cat([sampler(sigma, sigma_next) for sampler in item_samplers], dim=0)
+
+
+def ksampler(sampler_name, total_sigmas, extra_options={}, inpaint_options={}, batch_seeds=None):
+    if batch_seeds is not None:
+        # stochastic samplers: the noise of the sampling steps is drawn per batch item
+        sampler_function = getattr(k_diffusion_sampling, f"sample_{sampler_name}", None)
+        if sampler_function is not None and 'noise_sampler' in inspect.signature(sampler_function).parameters:
+            def sample_batch(model, x, sigmas, **kwargs):
+                kwargs['noise_sampler'] = batch_noise_sampler(x, batch_seeds, sampler_name, sigmas, total_sigmas)
+                return sampler_function(model, x, sigmas, **kwargs)
+
+            return samplers.KSAMPLER(sample_batch, extra_options, inpaint_options)
+
     if sampler_name == "dpmpp_sde":
         def sample_dpmpp_sde(model, x, sigmas, **kwargs):
             noise_sampler = get_noise_sampler(x, True, total_sigmas, **kwargs)
@@ -179,7 +212,8 @@ def sample_with_custom_noise(model, add_noise, noise_seed, cfg, positive, negati
 
 # When sampling one step at a time, it mitigates the problem. (especially for _sde series samplers)
 def separated_sample(model, add_noise, seed, steps, cfg, sampler_name, scheduler, positive, negative,
-                     latent_image, start_at_step, end_at_step, return_with_leftover_noise, sigma_ratio=1.0, sampler_opt=None, noise=None, callback=None, scheduler_func=None):
+                     latent_image, start_at_step, end_at_step, return_with_leftover_noise, sigma_ratio=1.0, sampler_opt=None, noise=None, callback=None, scheduler_func=None,
+                     batch_seeds=None):
 
     if scheduler_func is not None:
         total_sigmas = scheduler_func(model, sampler_name, steps)
@@ -206,7 +240,7 @@ def separated_sample(model, add_noise, seed, steps, cfg, sampler_name, scheduler
                 return {'samples': torch.zeros_like(noise)}
 
     if sampler_opt is None:
-        impact_sampler = ksampler(sampler_name, total_sigmas)
+        impact_sampler = ksampler(sampler_name, total_sigmas, batch_seeds=batch_seeds)
     else:
         impact_sampler = sampler_opt
 
@@ -230,7 +264,11 @@ def impact_sample(model, seed, steps, cfg, sampler_name, scheduler, positive, ne
 
 
 def ksampler_wrapper(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise,
-                     refiner_ratio=None, refiner_model=None, refiner_clip=None, refiner_positive=None, refiner_negative=None, sigma_factor=1.0, noise=None, scheduler_func=None):
+                     refiner_ratio=None, refiner_model=None, refiner_clip=None, refiner_positive=None, refiner_negative=None, sigma_factor=1.0, noise=None, scheduler_func=None,
+                     batch_seeds=None):
+    """
+    :param batch_seeds: seed per batch item for the noise of the stochastic samplers (default: `seed` for the whole batch)
+    """
 
     if refiner_ratio is None or refiner_model is None or refiner_clip is None or refiner_positive is None or refiner_negative is None:
         # Use separated_sample instead of KSampler for `AYS scheduler`
@@ -242,7 +280,7 @@ def ksampler_wrapper(model, seed, steps, cfg, sampler_name, scheduler, positive,
 
         refined_latent = separated_sample(model, True, seed, advanced_steps, cfg, sampler_name, scheduler,
                                           positive, negative, latent_image, start_at_step, end_at_step, False,
-                                          sigma_ratio=sigma_factor, noise=noise, scheduler_func=scheduler_func)
+                                          sigma_ratio=sigma_factor, noise=noise, scheduler_func=scheduler_func, batch_seeds=batch_seeds)
     else:
         advanced_steps = math.floor(steps / denoise)
         start_at_step = advanced_steps - steps
@@ -251,7 +289,7 @@ def ksampler_wrapper(model, seed, steps, cfg, sampler_name, scheduler, positive,
         # print(f"pre: {start_at_step} .. {end_at_step} / {advanced_steps}")
         temp_latent = separated_sample(model, True, seed, advanced_steps, cfg, sampler_name, scheduler,
                                        positive, negative, latent_image, start_at_step, end_at_step, True,
-                                       sigma_ratio=sigma_factor, noise=noise, scheduler_func=scheduler_func)
+                                       sigma_ratio=sigma_factor, noise=noise, scheduler_func=scheduler_func, batch_seeds=batch_seeds)
 
         if 'noise_mask' in latent_image:
             # noise_latent = \
@@ -265,7 +303,7 @@ def ksampler_wrapper(model, seed, steps, cfg, sampler_name, scheduler, positive,
         # print(f"post: {end_at_step} .. {advanced_steps + 1} / {advanced_steps}")
         refined_latent = separated_sample(refiner_model, False, seed, advanced_steps, cfg, sampler_name, scheduler,
                                           refiner_positive, refiner_negative, temp_latent, end_at_step, advanced_steps + 1, False,
-                                          sigma_ratio=sigma_factor, scheduler_func=scheduler_func)
+                                          sigma_ratio=sigma_factor, scheduler_func=scheduler_func, batch_seeds=batch_seeds)
 
     return refined_latent
 
@@ -165,8 +165,8 @@ async def sam_detect(request):
 
 @PromptServer.instance.routes.get("/impact/wildcards/refresh")
 async def wildcards_refresh(request):
-    impact.wildcards.wildcard_load()
-    return web.Response(status=200)
+    summary = impact.wildcards.wildcard_reload()
+    return web.json_response(summary)
 
 
 @PromptServer.instance.routes.get("/impact/wildcards/list")
@@ -238,10 +238,11 @@ async def view_validate(request):
     if "id" in request.rel_url.query:
         pb_id = request.rel_url.query["id"]
 
-        if pb_id not in core.preview_bridge_image_id_map:
+        entry = core.preview_bridge_image_id_map.get(pb_id)
+        if entry is None:
             return web.Response(status=400)
 
-        file = core.preview_bridge_image_id_map[pb_id]
+        file, _ = entry
         if os.path.isfile(file):
             return web.Response(status=200)
 
@@ -289,20 +290,27 @@ async def get_previewbridge_image(request):
     if "id" in request.rel_url.query:
         pb_id = request.rel_url.query["id"]
 
-        if pb_id in core.preview_bridge_image_id_map:
-            _, path_item = core.preview_bridge_image_id_map[pb_id]
+        entry = core.preview_bridge_image_id_map.get(pb_id)
+        if entry is not None:
+            _, path_item = entry
             return web.json_response(path_item)
 
     return web.Response(status=400)
 
 
+@PromptServer.instance.routes.get("/impact/preview_bridge/cache_stats")
+async def preview_bridge_cache_stats(request):
+    return web.json_response(core.get_preview_bridge_cache_stats())
+
+
 @PromptServer.instance.routes.get("/impact/view/pb_id_image")
 async def view_previewbridge_image(request):
     if "id" in request.rel_url.query:
         pb_id = request.rel_url.query["id"]
 
-        if pb_id in core.preview_bridge_image_id_map:
-            file = core.preview_bridge_image_id_map[pb_id]
+        entry = core.preview_bridge_image_id_map.get(pb_id)
+        if entry is not None:
+            file, _ = entry
 
             with Image.open(file) as img:
                 filename = os.path.basename(file)
@@ -407,6 +415,9 @@ def onprompt_for_pickers(json_data):
 def gc_preview_bridge_cache(json_data):
     prompt_keys = json_data['prompt'].keys()
 
+    # the nodes of the new prompt are pinned in the LRU caches
+    core.preview_bridge_prompt_nodes = frozenset(str(key) for key in prompt_keys)
+
     for key in list(core.preview_bridge_cache.keys()):
         if key not in prompt_keys:
             # print(f"key deleted [PB]: {key}")
@@ -0,0 +1,99 @@
+"""
+Mask algebra on torch tensors.
+
+float masks: `and` is the minimum, `or` is the maximum, `subtract`/`add` are clamped to [0, 1].
+bool masks: logical operations.
+(For binary masks both give the same result as the bitwise operations.)
+
+The operands can be tensors or `np.ndarray` (shared, not copied) and are broadcast against each other.
+The operation is done on the device of `mask1`, or of `out` if it is given.
+`out` may be one of the operands for an in-place operation. It must be a bool or floating point tensor.
+"""
+
+import torch
+
+
+def _as_dtype(mask, dtype):
+    if dtype == torch.bool and mask.dtype != torch.bool:
+        return mask > 0
+
+    return mask.to(dtype)
+
+
+def _operands(mask1, mask2, out=None):
+    mask1 = torch.as_tensor(mask1)
+    device = mask1.device if out is None else out.device
+    mask1 = mask1.to(device)
+    mask2 = torch.as_tensor(mask2).to(device)
+
+    if out is not None:
+        dtype = out.dtype
+    elif mask1.dtype == torch.bool and mask2.dtype == torch.bool:
+        dtype = torch.bool
+    elif mask1.is_floating_point():
+        dtype = mask1.dtype
+    elif mask2.is_floating_point():
+        dtype = mask2.dtype
+    else:
+        dtype = torch.float32
+
+    return _as_dtype(mask1, dtype), _as_dtype(mask2, dtype)
+
+
+def mask_and(mask1, mask2, out=None):
+    mask1, mask2 = _operands(mask1, mask2, out)
+
+    if mask1.dtype == torch.bool:
+        return torch.logical_and(mask1, mask2, out=out)
+
+    return torch.minimum(mask1, mask2, out=out)
+
+
+def mask_or(mask1, mask2, out=None):
+    mask1, mask2 = _operands(mask1, mask2, out)
+
+    if mask1.dtype == torch.bool:
+        return torch.logical_or(mask1, mask2, out=out)
+
+    return torch.maximum(mask1, mask2, out=out)
+
+
+def mask_subtract(mask1, mask2, out=None):
+    mask1, mask2 = _operands(mask1, mask2, out)
+
+    if mask1.dtype == torch.bool:
+        # a > b <=> a and not b
+        return torch.gt(mask1, mask2, out=out)
+
+    return torch.sub(mask1, mask2, out=out).clamp_(0, 1)
+
+
+def mask_add(mask1, mask2, out=None):
+    mask1, mask2 = _operands(mask1, mask2, out)
+
+    if mask1.dtype == torch.bool:
+        return torch.logical_or(mask1, mask2, out=out)
+
+    return torch.add(mask1, mask2, out=out).clamp_(0, 1)
+
+
+def mask_combine(masks, out=None):
+    """
+    `or` of the masks which have the same shape as the first mask. (the others are ignored)
+    :return: `out` (or a new tensor like the first mask), None if `masks` is empty
+    """
+    if len(masks) == 0:
+        return None
+
+    first = torch.as_tensor(masks[0])
+    if out is None:
+        out = first.clone()
+    else:
+        out.copy_(_as_dtype(first.to(out.device), out.dtype))
+
+    for mask in masks[1:]:
+        mask = torch.as_tensor(mask)
+        if mask.shape == out.shape:
+            mask_or(out, mask, out=out)
+
+    return out
@@ -41,9 +41,39 @@ def inference_segm_old(model, image, conf_threshold):
     return results
 
 
-def inference_segm(image, modelname, conf_thres, lab="A"):
-    image = image.numpy()[0] * 255
-    mmdet_results = inference_detector(modelname, image).pred_instances
+def inference_detector_batch(model, images):
+    """
+    `inference_detector` which runs the model once on the stacked frames.
+    (`inference_detector` of mmdet runs the model for each image of the list)
+    """
+    try:
+        from mmcv.transforms import Compose
+        from mmdet.utils import get_test_pipeline_cfg
+    except ImportError as e:
+        print(f"[Impact Pack] mmdet batch inference is not available, fallback to per image inference: {e}")
+        return [inference_detector(model, image) for image in images]
+
+    if not hasattr(model, 'test_step'):
+        print(f"[Impact Pack] mmdet batch inference is not available, fallback to per image inference: the model has no 'test_step'")
+        return [inference_detector(model, image) for image in images]
+
+    test_pipeline = get_test_pipeline_cfg(model.cfg.copy())
+    test_pipeline[0].type = 'mmdet.LoadImageFromNDArray'
+    test_pipeline = Compose(test_pipeline)
+
+    inputs = []
+    data_samples = []
+    for image in images:
+        data = test_pipeline(dict(img=image, img_id=0))
+        inputs.append(data['inputs'])
+        data_samples.append(data['data_samples'])
+
+    with torch.no_grad():
+        return model.test_step(dict(inputs=inputs, data_samples=data_samples))
+
+
+def segm_results(mmdet_results, conf_thres, lab="A"):
+    mmdet_results = mmdet_results.pred_instances
     bboxes = mmdet_results.bboxes.numpy()
     segms = mmdet_results.masks.numpy()
     scores = mmdet_results.scores.numpy()
@@ -65,10 +95,19 @@ def inference_segm(image, modelname, conf_thres, lab="A"):
     return results
 
 
-def inference_bbox(modelname, image, conf_threshold):
+def inference_segm(image, modelname, conf_thres, lab="A"):
     image = image.numpy()[0] * 255
+    return segm_results(inference_detector(modelname, image), conf_thres, lab)
+
+
+def inference_segm_batch(images, modelname, conf_thres, lab="A"):
+    images = [image.numpy() * 255 for image in images]
+    return [segm_results(x, conf_thres, lab) for x in inference_detector_batch(modelname, images)]
+
+
+def bbox_results(mmdet_results, image, conf_threshold):
     label = "A"
-    output = inference_detector(modelname, image).pred_instances
+    output = mmdet_results.pred_instances
     cv2_image = np.array(image)
     cv2_image = cv2_image[:, :, ::-1].copy()
     cv2_gray = cv2.cvtColor(cv2_image, cv2.COLOR_BGR2GRAY)
@@ -97,6 +136,16 @@ def inference_bbox(modelname, image, conf_threshold):
     return results
 
 
+def inference_bbox(modelname, image, conf_threshold):
+    image = image.numpy()[0] * 255
+    return bbox_results(inference_detector(modelname, image), image, conf_threshold)
+
+
+def inference_bbox_batch(modelname, images, conf_threshold):
+    images = [image.numpy() * 255 for image in images]
+    return [bbox_results(x, image, conf_threshold) for x, image in zip(inference_detector_batch(modelname, images), images)]
+
+
 class BBoxDetector:
     bbox_model = None
 
@@ -104,8 +153,16 @@ class BBoxDetector:
         self.bbox_model = bbox_model
 
     def detect(self, image, threshold, dilation, crop_factor, drop_size=1, detailer_hook=None):
-        drop_size = max(drop_size, 1)
         mmdet_results = inference_bbox(self.bbox_model, image, threshold)
+        return self.make_segs(image, mmdet_results, dilation, crop_factor, drop_size, detailer_hook)
+
+    def detect_batch(self, images, threshold, dilation, crop_factor, drop_size=1, detailer_hook=None):
+        results = inference_bbox_batch(self.bbox_model, images, threshold)
+        return [self.make_segs(image.unsqueeze(0), mmdet_results, dilation, crop_factor, drop_size, detailer_hook)
+                for image, mmdet_results in zip(images, results)]
+
+    def make_segs(self, image, mmdet_results, dilation, crop_factor, drop_size=1, detailer_hook=None):
+        drop_size = max(drop_size, 1)
         segmasks = create_segmasks(mmdet_results)
 
         if dilation > 0:
@@ -154,8 +211,16 @@ class SegmDetector(BBoxDetector):
         self.segm_model = segm_model
 
     def detect(self, image, threshold, dilation, crop_factor, drop_size=1, detailer_hook=None):
-        drop_size = max(drop_size, 1)
         mmdet_results = inference_segm(image, self.segm_model, threshold)
+        return self.make_segs(image, mmdet_results, dilation, crop_factor, drop_size, detailer_hook)
+
+    def detect_batch(self, images, threshold, dilation, crop_factor, drop_size=1, detailer_hook=None):
+        results = inference_segm_batch(images, self.segm_model, threshold)
+        return [self.make_segs(image.unsqueeze(0), mmdet_results, dilation, crop_factor, drop_size, detailer_hook)
+                for image, mmdet_results in zip(images, results)]
+
+    def make_segs(self, image, mmdet_results, dilation, crop_factor, drop_size=1, detailer_hook=None):
+        drop_size = max(drop_size, 1)
         segmasks = create_segmasks(mmdet_results)
 
         if dilation > 0:
@@ -5,34 +5,132 @@ impact.additional_dependencies.ensure_onnx_package()
 
 try:
     import onnxruntime
+    import os
+    import threading
+    from impact import config
 
-    def onnx_inference(image, onnx_model):
-        # prepare image
+    onnx_session_cache = {}
+    onnx_session_lock = threading.Lock()
+
+    graph_optimization_levels = {
+        'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+    }
+
+    def make_session_options():
+        conf = config.get_config()
+
+        options = onnxruntime.SessionOptions()
+        if conf['onnx_intra_op_threads'] > 0:
+            options.intra_op_num_threads = conf['onnx_intra_op_threads']
+        if conf['onnx_inter_op_threads'] > 0:
+            options.inter_op_num_threads = conf['onnx_inter_op_threads']
+
+        level = conf['onnx_graph_optimization_level']
+        if level not in graph_optimization_levels:
+            print(f"[Impact Pack] WARN: Unknown onnx_graph_optimization_level '{level}'. 'all' is used instead.")
+            level = 'all'
+        options.graph_optimization_level = graph_optimization_levels[level]
+
+        return options
+
+    def create_session(onnx_model, providers):
+        options = make_session_options()
+        model_path = onnx_model
+
+        if config.get_config()['onnx_save_optimized_model']:
+            optimized_path = onnx_model + ".optimized"
+
+            if os.path.exists(optimized_path) and os.path.getmtime(optimized_path) >= os.path.getmtime(onnx_model):
+                # already optimized
+                model_path = optimized_path
+                options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+            elif os.access(os.path.dirname(os.path.abspath(onnx_model)), os.W_OK):
+                options.optimized_model_filepath = optimized_path
+            else:
+                print(f"[Impact Pack] WARN: Cannot save the optimized ONNX model (no write permission): {optimized_path}")
+
+        return onnxruntime.InferenceSession(model_path, sess_options=options, providers=providers)
+
+    def get_session(onnx_model, providers=("CPUExecutionProvider",)):
+        """
+        Cached `onnxruntime.InferenceSession`.
+        The key is the model path, the providers and the modification time of the model file.
+        """
+        key = (os.path.abspath(onnx_model), tuple(providers), os.path.getmtime(onnx_model))
+
+        with onnx_session_lock:
+            session = onnx_session_cache.get(key)
+            if session is None:
+                # drop the session of the old version
+                for k in [k for k in onnx_session_cache if k[:2] == key[:2]]:
+                    del onnx_session_cache[k]
+
+                session = create_session(onnx_model, list(providers))
+                onnx_session_cache[key] = session
+
+        return session
+
+    def clear_session_cache():
+        with onnx_session_lock:
+            onnx_session_cache.clear()
+
+    max_inference_batch = 8
+
+    def preprocess(image):
         pil = tensor2pil(image)
         image = np.ascontiguousarray(pil)
         image = image[:, :, ::-1]  # to BGR image
         image = image.astype(np.float32)
         image -= [103.939, 116.779, 123.68]  # 'caffe' mode image preprocessing
+        return image
 
-        # do detection
-        onnx_model = onnxruntime.InferenceSession(onnx_model, providers=["CPUExecutionProvider"])
-        outputs = onnx_model.run(
-            [s_i.name for s_i in onnx_model.get_outputs()],
-            {onnx_model.get_inputs()[0].name: np.expand_dims(image, axis=0)},
+    def run_detection(session, inputs, count=None):
+        """:return: [(labels, scores, boxes)] of the first `count` items of `inputs` (b, h, w, c)"""
+        outputs = session.run(
+            [s_i.name for s_i in session.get_outputs()],
+            {session.get_inputs()[0].name: inputs},
         )
 
         labels = [op for op in outputs if op.dtype == "int32"][0]
         scores = [op for op in outputs if isinstance(op[0][0], np.float32)][0]
         boxes = [op for op in outputs if isinstance(op[0][0], np.ndarray)][0]
 
-        # filter-out useless item
-        idx = np.where(labels[0] == -1)[0][0]
+        res = []
+        for i in range(len(inputs) if count is None else count):
+            # filter-out useless item
+            idx = np.where(labels[i] == -1)[0][0]
+            res.append((labels[i][:idx], scores[i][:idx], boxes[i][:idx].astype(np.uint32)))
+
+        return res
+
+    def onnx_inference(image, onnx_model):
+        session = get_session(onnx_model)
+        return run_detection(session, np.expand_dims(preprocess(image), axis=0))[0]
+
+    def onnx_inference_batch(images, onnx_model):
+        """
+        `onnx_inference` for the image batch.
+        The frames are stacked up to `max_inference_batch` if the batch axis of the model is dynamic.
+        """
+        session = get_session(onnx_model)
+
+        batch_axis = session.get_inputs()[0].shape[0]
+        batch_size = max_inference_batch if not isinstance(batch_axis, int) or batch_axis <= 0 else batch_axis
 
-        labels = labels[0][:idx]
-        scores = scores[0][:idx]
-        boxes = boxes[0][:idx].astype(np.uint32)
+        res = []
+        for i in range(0, len(images), batch_size):
+            inputs = np.stack([preprocess(image.unsqueeze(0)) for image in images[i:i+batch_size]])
+            if len(inputs) < batch_size and isinstance(batch_axis, int) and batch_axis > 0:
+                # fixed batch axis: pad the last chunk
+                padding = np.zeros((batch_size - len(inputs),) + inputs.shape[1:], dtype=inputs.dtype)
+                res += run_detection(session, np.concatenate([inputs, padding]), len(inputs))
+            else:
+                res += run_detection(session, inputs)
 
-        return labels, scores, boxes
+        return res
 except Exception as e:
     print("[ERROR] ComfyUI-Impact-Pack: 'onnxruntime' package doesn't support 'python 3.11', yet.")
     print(f"\t{e}")
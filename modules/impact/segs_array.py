@@ -0,0 +1,291 @@
+"""
+Columnar SEGS container.
+
+`SEGSArray` keeps the fields of the segments in contiguous arrays instead of a list of `SEG` namedtuples,
+so that the filtering, sorting and scale matching can be done as array operations.
+It is a subclass of tuple and behaves as `((h, w), [SEG, ...])`, so it can be passed to every node which accepts SEGS.
+"""
+
+from collections.abc import Sequence
+
+import numpy as np
+import torch
+
+from impact.core import SEG, PackedSEG, get_packed_mask
+from impact.utils import tensor_resize, PackedMask
+
+
+def _values_equal(a, b):
+    if a is b:
+        return True
+
+    if isinstance(a, (np.ndarray, torch.Tensor)) or isinstance(b, (np.ndarray, torch.Tensor)):
+        if a is None or b is None:
+            return False
+        a = a.cpu().numpy() if isinstance(a, torch.Tensor) else np.asarray(a)
+        b = b.cpu().numpy() if isinstance(b, torch.Tensor) else np.asarray(b)
+        return np.array_equal(a, b)
+
+    return a == b
+
+
+def _seg_equal(a, b):
+    """Value equality of SEGs. (`==` of SEG namedtuples fails on the array fields, packed masks are compared decoded)"""
+    return len(a) == len(b) and all(_values_equal(getattr(a, field), getattr(b, field)) for field in SEG._fields)
+
+
+class SEGColumns(Sequence):
+    """List-like view of `SEGSArray`. `SEG` items are created on access."""
+
+    def __init__(self, owner):
+        self._owner = owner
+
+    def __len__(self):
+        return len(self._owner.confidences)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._owner.get_seg(i) for i in range(*idx.indices(len(self)))]
+
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("SEGS index out of range")
+
+        return self._owner.get_seg(idx)
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, SEGColumns)):
+            return len(self) == len(other) and all(_seg_equal(a, b) for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        return f"SEGColumns(len={len(self)})"
+
+
+class SEGSArray(tuple):
+    """
+    Columnar SEGS.
+
+    crop_regions, bboxes: (N, 4) arrays
+    confidences: (N,) float64 array
+    label_ids: (N,) int32 array indexing `labels`
+    masks: per item `cropped_mask` as stored in the SEG. `PackedMask` of a `PackedSEG` stays packed
+           and is decoded only when the mask of the item is accessed.
+    cropped_images, control_net_wrappers: per item object lists (mostly None)
+    """
+
+    def __new__(cls, shape, crop_regions, bboxes, confidences, label_ids, labels, masks, cropped_images, control_net_wrappers):
+        self = super().__new__(cls, (tuple(shape), None))
+        self.crop_regions = crop_regions
+        self.bboxes = bboxes
+        self.confidences = confidences
+        self.label_ids = label_ids
+        self.labels = labels
+        self.masks = masks
+        self.cropped_images = cropped_images
+        self.control_net_wrappers = control_net_wrappers
+        return self
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return tuple(self)[idx]
+        if idx == 1 or idx == -1:
+            return SEGColumns(self)
+        return super().__getitem__(idx)
+
+    def __iter__(self):
+        yield self[0]
+        yield self[1]
+
+    def __getnewargs__(self):
+        return (self[0], self.crop_regions, self.bboxes, self.confidences, self.label_ids, self.labels, self.masks,
+                self.cropped_images, self.control_net_wrappers)
+
+    def __repr__(self):
+        return f"SEGSArray(shape={self[0]}, len={len(self.confidences)})"
+
+    @staticmethod
+    def from_segs(segs):
+        """Convert SEGS into `SEGSArray`. (`SEGSArray` is returned as is)"""
+        if isinstance(segs, SEGSArray):
+            return segs
+
+        shape, items = segs[0], list(segs[1])
+
+        labels = []
+        label_index = {}
+        label_ids = np.zeros(len(items), dtype=np.int32)
+        masks = []
+
+        for i, seg in enumerate(items):
+            if seg.label not in label_index:
+                label_index[seg.label] = len(labels)
+                labels.append(seg.label)
+            label_ids[i] = label_index[seg.label]
+
+            # keep the packed mask as is (without decoding)
+            packed_mask = get_packed_mask(seg)
+            masks.append(packed_mask if packed_mask is not None else seg.cropped_mask)
+
+        return SEGSArray(shape,
+                         SEGSArray._to_region_array([seg.crop_region for seg in items]),
+                         SEGSArray._to_region_array([seg.bbox for seg in items]),
+                         np.array([float(seg.confidence) for seg in items], dtype=np.float64),
+                         label_ids, labels, masks,
+                         [seg.cropped_image for seg in items], [seg.control_net_wrapper for seg in items])
+
+    @staticmethod
+    def _to_region_array(regions):
+        if len(regions) == 0:
+            return np.zeros((0, 4), dtype=np.int64)
+
+        arr = np.array([np.asarray(x).reshape(-1)[:4] for x in regions])
+        if np.issubdtype(arr.dtype, np.integer):
+            return arr.astype(np.int64)
+        return arr.astype(np.float64)
+
+    def __len__(self):
+        return 2
+
+    def __eq__(self, other):
+        # value equality like the plain SEGS tuple
+        if self is other:
+            return True
+        if isinstance(other, tuple) and len(other) == 2:
+            return tuple(self[0]) == tuple(other[0]) and self[1] == other[1]
+        return NotImplemented
+
+    def __ne__(self, other):
+        res = self.__eq__(other)
+        return res if res is NotImplemented else not res
+
+    # unhashable like the plain SEGS tuple (it contains a list)
+    __hash__ = None
+
+    @property
+    def item_count(self):
+        return len(self.confidences)
+
+    def get_mask(self, idx):
+        """`cropped_mask` of the idx-th item. (a packed mask is decoded into a new array)"""
+        mask = self.masks[idx]
+        if isinstance(mask, PackedMask):
+            return mask.decode()
+        return mask
+
+    def get_seg(self, idx):
+        """idx-th item as `SEG`, or as `PackedSEG` if the mask is packed (it is decoded on the `cropped_mask` access)"""
+        mask = self.masks[idx]
+        seg_class = PackedSEG if isinstance(mask, PackedMask) else SEG
+        return seg_class(self.cropped_images[idx], mask, float(self.confidences[idx]),
+                         tuple(self.crop_regions[idx].tolist()), tuple(self.bboxes[idx].tolist()),
+                         self.labels[self.label_ids[idx]], self.control_net_wrappers[idx])
+
+    def take(self, indices):
+        """New `SEGSArray` with the items at `indices`. (int array or bool array, the masks are shared, not copied)"""
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.nonzero(indices)[0]
+        indices = indices.astype(np.int64)
+
+        return SEGSArray(self[0], self.crop_regions[indices], self.bboxes[indices], self.confidences[indices],
+                         self.label_ids[indices], self.labels, [self.masks[i] for i in indices],
+                         [self.cropped_images[i] for i in indices], [self.control_net_wrappers[i] for i in indices])
+
+    def split(self, selected):
+        """(selected, remained) by the bool array `selected`"""
+        selected = np.asarray(selected, dtype=bool)
+        return self.take(selected), self.take(~selected)
+
+    def widths(self):
+        return self.crop_regions[:, 2] - self.crop_regions[:, 0]
+
+    def heights(self):
+        return self.crop_regions[:, 3] - self.crop_regions[:, 1]
+
+    def crop_region_values(self, target):
+        """
+        Per item values of the crop region for the filter nodes.
+
+        :param target: one of "area(=w*h)", "width", "height", "x1", "y1", "x2", "y2", "length_percent"
+        """
+        if target == "area(=w*h)":
+            return self.heights() * self.widths()
+        elif target == "length_percent":
+            w = self.widths()
+            h = self.heights()
+            return np.maximum(h/w, w/h)*100
+        elif target == "width":
+            return self.widths()
+        elif target == "height":
+            return self.heights()
+        elif target == "x1":
+            return self.crop_regions[:, 0]
+        elif target == "y1":
+            return self.crop_regions[:, 1]
+        elif target == "x2":
+            return self.crop_regions[:, 2]
+        elif target == "y2":
+            return self.crop_regions[:, 3]
+
+        return None
+
+    def label_mask(self, labels):
+        """bool array of the items which have one of `labels`"""
+        allowed_ids = [i for i, label in enumerate(self.labels) if label in labels]
+        return np.isin(self.label_ids, allowed_ids)
+
+    def scale_match(self, target_shape):
+        """Vectorized `core.segs_scale_match`"""
+        h, w = self[0]
+
+        th = target_shape[1]
+        tw = target_shape[2]
+
+        if (h == th and w == tw) or h == 0 or w == 0:
+            return self
+
+        rh = th / h
+        rw = tw / w
+
+        # NOTE: same scaling as `core.segs_scale_match`
+        scale = np.array([rw, rw, rh, rh])
+        crop_regions = (self.crop_regions * scale).astype(np.int64)
+        bboxes = (self.bboxes * scale).astype(np.int64)
+        new_ws = crop_regions[:, 2] - crop_regions[:, 0]
+        new_hs = crop_regions[:, 3] - crop_regions[:, 1]
+
+        masks = []
+        cropped_images = []
+
+        for i in range(self.item_count):
+            new_w = int(new_ws[i])
+            new_h = int(new_hs[i])
+
+            mask = self.get_mask(i)
+            if mask is not None:
+                mask = torch.as_tensor(mask, dtype=torch.float32)
+
+                # NOTE: 3-dim masks (AnimateDiff) are returned as tensor by `core.segs_scale_match`
+                if len(mask.shape) == 3:
+                    mask = torch.nn.functional.interpolate(mask.unsqueeze(0), size=(new_h, new_w), mode='bilinear', align_corners=False).squeeze(0)
+                else:
+                    mask = torch.nn.functional.interpolate(mask.unsqueeze(0).unsqueeze(0), size=(new_h, new_w), mode='bilinear', align_corners=False).squeeze(0).squeeze(0)
+                    mask = mask.numpy()
+            masks.append(mask)
+
+            cropped_image = self.cropped_images[i]
+            if cropped_image is not None:
+                cropped_image = tensor_resize(cropped_image if isinstance(cropped_image, torch.Tensor) else torch.from_numpy(cropped_image), new_w, new_h)
+                cropped_image = cropped_image.numpy()
+            cropped_images.append(cropped_image)
+
+        return SEGSArray((th, tw), crop_regions, bboxes, self.confidences, self.label_ids, self.labels, masks,
+                         cropped_images, self.control_net_wrappers)
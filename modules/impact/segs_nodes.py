@@ -7,6 +7,7 @@ from nodes import MAX_RESOLUTION
 from impact.utils import *
 from . import core
 from .core import SEG
+from .segs_array import SEGSArray
 import impact.utils as utils
 from . import defs
 from . import segs_upscaler
@@ -76,24 +77,28 @@ class SEGSDetailer:
         new_segs = []
         cnet_pil_list = []
 
+        size_plan = core.plan_segs_detail_sizes(segs[1], guide_size, guide_size_for, max_size, force_inpaint, model)
+        print(f"SEGSDetailer: size plan - {size_plan.summary()}")
+
         if noise_mask_feather > 0 and 'denoise_mask_function' not in model.model_options:
             model = nodes_differential_diffusion.DifferentialDiffusion().apply(model)[0]
 
         for i in range(batch_size):
             seed += 1
-            for seg in segs[1]:
+            for plan_index, seg in enumerate(segs[1]):
                 cropped_image = seg.cropped_image if seg.cropped_image is not None \
                                                   else crop_ndarray4(image.numpy(), seg.crop_region)
                 cropped_image = to_tensor(cropped_image)
+                seg_mask = seg.cropped_mask  # decode the packed mask once
 
-                is_mask_all_zeros = (seg.cropped_mask == 0).all().item()
+                is_mask_all_zeros = (seg_mask == 0).all().item()
                 if is_mask_all_zeros:
                     print(f"Detailer: segment skip [empty mask]")
                     new_segs.append(seg)
                     continue
 
                 if noise_mask:
-                    cropped_mask = seg.cropped_mask
+                    cropped_mask = seg_mask
                 else:
                     cropped_mask = None
 
@@ -119,7 +124,8 @@ class SEGSDetailer:
                                                                 refiner_ratio=refiner_ratio, refiner_model=refiner_model,
                                                                 refiner_clip=refiner_clip, refiner_positive=refiner_positive, refiner_negative=refiner_negative,
                                                                 control_net_wrapper=seg.control_net_wrapper, cycle=cycle,
-                                                                inpaint_model=inpaint_model, noise_mask_feather=noise_mask_feather, scheduler_func=scheduler_func_opt)
+                                                                inpaint_model=inpaint_model, noise_mask_feather=noise_mask_feather, scheduler_func=scheduler_func_opt,
+                                                                size_plan=size_plan, plan_index=plan_index)
 
                 if cnet_pils is not None:
                     cnet_pil_list.extend(cnet_pils)
@@ -129,7 +135,7 @@ class SEGSDetailer:
                 else:
                     new_cropped_image = enhanced_image
 
-                new_seg = SEG(to_numpy(new_cropped_image), seg.cropped_mask, seg.confidence, seg.crop_region, seg.bbox, seg.label, None)
+                new_seg = seg._replace(cropped_image=to_numpy(new_cropped_image), control_net_wrapper=None)  # keeps the packed mask
                 new_segs.append(new_seg)
 
         return (segs[0], new_segs), cnet_pil_list
@@ -175,11 +181,14 @@ class SEGSPaste:
 
         segs = core.segs_scale_match(segs, image.shape)
 
-        result = None
+        # decode the packed masks once, not per frame
+        seg_masks = [seg.cropped_mask for seg in segs[1]]
+
+        result = TensorBatchBuilder(len(image))
         for i, single_image in enumerate(image):
             image_i = single_image.unsqueeze(0).clone()
 
-            for seg in segs[1]:
+            for seg, seg_mask in zip(segs[1], seg_masks):
                 ref_image = None
                 if ref_image_opt is None and seg.cropped_image is not None:
                     cropped_image = seg.cropped_image
@@ -190,19 +199,19 @@ class SEGSPaste:
                     ref_tensor = ref_image_opt[i].unsqueeze(0)
                     ref_image = crop_image(ref_tensor, seg.crop_region)
                 if ref_image is not None:
-                    if seg.cropped_mask.ndim == 3 and len(seg.cropped_mask) == len(image):
-                        mask = seg.cropped_mask[i]
-                    elif seg.cropped_mask.ndim == 3 and len(seg.cropped_mask) > 1:
-                        print(f"[Impact Pack] WARN: SEGSPaste - The number of the mask batch({len(seg.cropped_mask)}) and the image batch({len(image)}) are different. Combine the mask frames and apply.")
-                        combined_mask = (seg.cropped_mask[0] * 255).to(torch.uint8)
+                    if seg_mask.ndim == 3 and len(seg_mask) == len(image):
+                        mask = seg_mask[i]
+                    elif seg_mask.ndim == 3 and len(seg_mask) > 1:
+                        print(f"[Impact Pack] WARN: SEGSPaste - The number of the mask batch({len(seg_mask)}) and the image batch({len(image)}) are different. Combine the mask frames and apply.")
+                        combined_mask = (seg_mask[0] * 255).to(torch.uint8)
 
-                        for frame_mask in seg.cropped_mask[1:]:
+                        for frame_mask in seg_mask[1:]:
                             combined_mask |= (frame_mask * 255).to(torch.uint8)
 
                         combined_mask = (combined_mask/255.0).to(torch.float32)
                         mask = utils.to_binary_mask(combined_mask, 0.1)
                     else:  # ndim == 2
-                        mask = seg.cropped_mask
+                        mask = seg_mask
 
                     mask = tensor_gaussian_blur_mask(mask, feather) * (alpha/255)
                     x, y, *_ = seg.crop_region
@@ -213,11 +222,9 @@ class SEGSPaste:
 
                     tensor_paste(image_i, ref_image, (x, y), mask)
 
-            if result is None:
-                result = image_i
-            else:
-                result = torch.concat((result, image_i), dim=0)
+            result.concat(image_i)
 
+        result = result.tensor
         if not args.highvram and not args.gpu_only:
             result = result.cpu()
 
@@ -320,6 +327,7 @@ class SEGSPreview:
             for seg in segs[1]:
                 result_image_batch = None
                 cached_mask = None
+                seg_mask = seg.cropped_mask  # decode the packed mask once
 
                 def get_combined_mask():
                     nonlocal cached_mask
@@ -327,10 +335,10 @@ class SEGSPreview:
                     if cached_mask is not None:
                         return cached_mask
                     else:
-                        if isinstance(seg.cropped_mask, np.ndarray):
-                            masks = torch.tensor(seg.cropped_mask)
+                        if isinstance(seg_mask, np.ndarray):
+                            masks = torch.tensor(seg_mask)
                         else:
-                            masks = seg.cropped_mask
+                            masks = seg_mask
 
                         cached_mask = (masks[0] * 255).to(torch.uint8)
                         for x in masks[1:]:
@@ -373,13 +381,13 @@ class SEGSPreview:
                         cropped_pil = to_pil(cropped_image)
 
                         if alpha_mode:
-                            if isinstance(seg.cropped_mask, np.ndarray):
-                                cropped_mask = seg.cropped_mask
+                            if isinstance(seg_mask, np.ndarray):
+                                cropped_mask = seg_mask
                             else:
-                                if seg.cropped_image is not None and len(seg.cropped_image) != len(seg.cropped_mask):
+                                if seg.cropped_image is not None and len(seg.cropped_image) != len(seg_mask):
                                     cropped_mask = get_combined_mask()
                                 else:
-                                    cropped_mask = seg.cropped_mask[i].numpy()
+                                    cropped_mask = seg_mask[i].numpy()
 
                             mask_array = (cropped_mask * 255).astype(np.uint8)
 
@@ -430,23 +438,16 @@ class SEGSLabelFilter:
 
         if 'all' in labels:
             return (segs, (segs[0], []), )
-        else:
-            res_segs = []
-            remained_segs = []
-
-            for x in segs[1]:
-                if x.label in labels:
-                    res_segs.append(x)
-                elif 'eyes' in labels and x.label in ['left_eye', 'right_eye']:
-                    res_segs.append(x)
-                elif 'eyebrows' in labels and x.label in ['left_eyebrow', 'right_eyebrow']:
-                    res_segs.append(x)
-                elif 'pupils' in labels and x.label in ['left_pupil', 'right_pupil']:
-                    res_segs.append(x)
-                else:
-                    remained_segs.append(x)
 
-        return ((segs[0], res_segs), (segs[0], remained_segs), )
+        if 'eyes' in labels:
+            labels.update(['left_eye', 'right_eye'])
+        if 'eyebrows' in labels:
+            labels.update(['left_eyebrow', 'right_eyebrow'])
+        if 'pupils' in labels:
+            labels.update(['left_pupil', 'right_pupil'])
+
+        segs = SEGSArray.from_segs(segs)
+        return segs.split(segs.label_mask(labels))
 
     def doit(self, segs, preset, labels):
         labels = labels.split(',')
@@ -510,50 +511,26 @@ class SEGSOrderedFilter:
     CATEGORY = "ImpactPack/Util"
 
     def doit(self, segs, target, order, take_start, take_count):
-        segs_with_order = []
+        segs = SEGSArray.from_segs(segs)
 
-        for seg in segs[1]:
-            x1 = seg.crop_region[0]
-            y1 = seg.crop_region[1]
-            x2 = seg.crop_region[2]
-            y2 = seg.crop_region[3]
-
-            if target == "area(=w*h)":
-                value = (y2 - y1) * (x2 - x1)
-            elif target == "width":
-                value = x2 - x1
-            elif target == "height":
-                value = y2 - y1
-            elif target == "x1":
-                value = x1
-            elif target == "x2":
-                value = x2
-            elif target == "y1":
-                value = y1
-            elif target == "y2":
-                value = y2
-            elif target == "confidence":
-                value = seg.confidence
-            else:
-                raise Exception(f"[Impact Pack] SEGSOrderedFilter - Unexpected target '{target}'")
+        if target == "confidence":
+            values = segs.confidences
+        else:
+            values = segs.crop_region_values(target)
 
-            segs_with_order.append((value, seg))
+        if values is None or target == "length_percent":
+            raise Exception(f"[Impact Pack] SEGSOrderedFilter - Unexpected target '{target}'")
 
+        # stable sort, same as `sorted(..., reverse=order)`
         if order:
-            sorted_list = sorted(segs_with_order, key=lambda x: x[0], reverse=True)
+            sorted_indices = np.argsort(-values, kind='stable')
         else:
-            sorted_list = sorted(segs_with_order, key=lambda x: x[0], reverse=False)
+            sorted_indices = np.argsort(values, kind='stable')
 
-        result_list = []
-        remained_list = []
+        taken_indices = sorted_indices[take_start:take_start + take_count]
+        remained_indices = np.concatenate([sorted_indices[:take_start], sorted_indices[take_start + take_count:]])
 
-        for i, item in enumerate(sorted_list):
-            if take_start <= i < take_start + take_count:
-                result_list.append(item[1])
-            else:
-                remained_list.append(item[1])
-
-        return (segs[0], result_list), (segs[0], remained_list),
+        return segs.take(taken_indices), segs.take(remained_indices),
 
 
 class SEGSRangeFilter:
@@ -575,50 +552,22 @@ class SEGSRangeFilter:
     CATEGORY = "ImpactPack/Util"
 
     def doit(self, segs, target, mode, min_value, max_value):
-        new_segs = []
-        remained_segs = []
+        segs = SEGSArray.from_segs(segs)
 
-        for seg in segs[1]:
-            x1 = seg.crop_region[0]
-            y1 = seg.crop_region[1]
-            x2 = seg.crop_region[2]
-            y2 = seg.crop_region[3]
-
-            if target == "area(=w*h)":
-                value = (y2 - y1) * (x2 - x1)
-            elif target == "length_percent":
-                h = y2 - y1
-                w = x2 - x1
-                value = max(h/w, w/h)*100
-                print(f"value={value}")
-            elif target == "width":
-                value = x2 - x1
-            elif target == "height":
-                value = y2 - y1
-            elif target == "x1":
-                value = x1
-            elif target == "x2":
-                value = x2
-            elif target == "y1":
-                value = y1
-            elif target == "y2":
-                value = y2
-            elif target == "confidence(0-100)":
-                value = seg.confidence*100
-            else:
-                raise Exception(f"[Impact Pack] SEGSRangeFilter - Unexpected target '{target}'")
-
-            if mode and min_value <= value <= max_value:
-                print(f"[in] value={value} / {mode}, {min_value}, {max_value}")
-                new_segs.append(seg)
-            elif not mode and (value < min_value or value > max_value):
-                print(f"[out] value={value} / {mode}, {min_value}, {max_value}")
-                new_segs.append(seg)
-            else:
-                remained_segs.append(seg)
-                print(f"[filter] value={value} / {mode}, {min_value}, {max_value}")
+        if target == "confidence(0-100)":
+            values = segs.confidences*100
+        else:
+            values = segs.crop_region_values(target)
+
+        if values is None:
+            raise Exception(f"[Impact Pack] SEGSRangeFilter - Unexpected target '{target}'")
+
+        inside = (min_value <= values) & (values <= max_value)
+        selected = inside if mode else ~inside
+
+        print(f"[SEGSRangeFilter] {target}: {int(selected.sum())} selected / {len(selected)} / {mode}, {min_value}, {max_value}")
 
-        return (segs[0], new_segs), (segs[0], remained_segs),
+        return segs.split(selected)
 
 
 class SEGSToImageList:
@@ -698,9 +647,10 @@ class SEGSToMaskBatch:
     CATEGORY = "ImpactPack/Util"
 
     def doit(self, segs):
-        masks = core.segs_to_masklist(segs)
-        masks = [utils.make_3d_mask(mask) for mask in masks]
-        mask_batch = torch.concat(masks)
+        if len(segs[1]) == 0:
+            return (torch.zeros((1,) + tuple(segs[0][:2]), dtype=torch.float32, device="cpu"),)
+
+        mask_batch = core.segs_to_mask_batch(segs)
         return (mask_batch,)
 
 
@@ -1025,9 +975,10 @@ class DilateMaskInSEGS:
     CATEGORY = "ImpactPack/Util"
 
     def doit(self, segs, dilation):
+        new_masks = core.dilate_mask_list([make_2d_mask(seg.cropped_mask) for seg in segs[1]], dilation)
+
         new_segs = []
-        for seg in segs[1]:
-            mask = core.dilate_mask(seg.cropped_mask, dilation)
+        for seg, mask in zip(segs[1], new_masks):
             seg = SEG(seg.cropped_image, mask, seg.confidence, seg.crop_region, seg.bbox, seg.label, seg.control_net_wrapper)
             new_segs.append(seg)
 
@@ -1339,7 +1290,7 @@ class IPAdapterApplySEGS:
             cropped_image = crop_image(reference_image, context_crop_region)
 
             control_net_wrapper = core.IPAdapterWrapper(ipadapter_pipe, weight, noise, weight_type, start_at, end_at, unfold_batch, weight_v2, cropped_image, neg_image=neg_image, prev_control_net=seg.control_net_wrapper, combine_embeds=combine_embeds)
-            new_seg = SEG(seg.cropped_image, seg.cropped_mask, seg.confidence, seg.crop_region, seg.bbox, seg.label, control_net_wrapper)
+            new_seg = seg._replace(control_net_wrapper=control_net_wrapper)
             new_segs.append(new_seg)
 
         return ((segs[0], new_segs), )
@@ -1373,7 +1324,7 @@ class ControlNetApplySEGS:
         for seg in segs[1]:
             control_net_wrapper = core.ControlNetWrapper(control_net, strength, segs_preprocessor, seg.control_net_wrapper,
                                                          original_size=segs[0], crop_region=seg.crop_region, control_image=control_image)
-            new_seg = SEG(seg.cropped_image, seg.cropped_mask, seg.confidence, seg.crop_region, seg.bbox, seg.label, control_net_wrapper)
+            new_seg = seg._replace(control_net_wrapper=control_net_wrapper)
             new_segs.append(new_seg)
 
         return ((segs[0], new_segs), )
@@ -1409,7 +1360,7 @@ class ControlNetApplyAdvancedSEGS:
             control_net_wrapper = core.ControlNetAdvancedWrapper(control_net, strength, start_percent, end_percent, segs_preprocessor,
                                                                  seg.control_net_wrapper, original_size=segs[0], crop_region=seg.crop_region,
                                                                  control_image=control_image, vae=vae)
-            new_seg = SEG(seg.cropped_image, seg.cropped_mask, seg.confidence, seg.crop_region, seg.bbox, seg.label, control_net_wrapper)
+            new_seg = seg._replace(control_net_wrapper=control_net_wrapper)
             new_segs.append(new_seg)
 
         return ((segs[0], new_segs), )
@@ -1430,7 +1381,7 @@ class ControlNetClearSEGS:
         new_segs = []
 
         for seg in segs[1]:
-            new_seg = SEG(seg.cropped_image, seg.cropped_mask, seg.confidence, seg.crop_region, seg.bbox, seg.label, None)
+            new_seg = seg._replace(control_net_wrapper=None)
             new_segs.append(new_seg)
 
         return ((segs[0], new_segs), )
@@ -1565,7 +1516,7 @@ class DefaultImageForSEGS:
                         else:
                             cropped_image = torch.cat((cropped_image, cropped_image2), dim=0)
 
-                new_seg = SEG(cropped_image, seg.cropped_mask, seg.confidence, seg.crop_region, seg.bbox, seg.label, seg.control_net_wrapper)
+                new_seg = seg._replace(cropped_image=cropped_image)
                 results.append(new_seg)
 
             return ((segs[0], results), )
@@ -1589,7 +1540,7 @@ class RemoveImageFromSEGS:
 
         if len(segs[1]) > 0:
             for seg in segs[1]:
-                new_seg = SEG(None, seg.cropped_mask, seg.confidence, seg.crop_region, seg.bbox, seg.label, seg.control_net_wrapper)
+                new_seg = seg._replace(cropped_image=None)
                 results.append(new_seg)
 
             return ((segs[0], results), )
@@ -1836,32 +1787,30 @@ class SEGSUpscaler:
         segs = core.segs_scale_match(segs, new_image.shape)
 
         ordered_segs = segs[1]
+        size_plan = core.plan_segs_canvas_sizes(ordered_segs)
 
         for i, seg in enumerate(ordered_segs):
-            cropped_image = crop_ndarray4(new_image.numpy(), seg.crop_region)
-            cropped_image = to_tensor(cropped_image)
-            mask = to_tensor(seg.cropped_mask)
+            cropped_image = crop_tensor4(new_image, seg.crop_region).clone()
+            cropped_mask = seg.cropped_mask  # decode the packed mask once
+            mask = to_tensor(cropped_mask)
             mask = tensor_gaussian_blur_mask(mask, feather)
 
-            is_mask_all_zeros = (seg.cropped_mask == 0).all().item()
+            is_mask_all_zeros = (cropped_mask == 0).all().item()
             if is_mask_all_zeros:
                 print(f"SEGSUpscaler: segment skip [empty mask]")
                 continue
 
-            cropped_mask = seg.cropped_mask
-
             seg_seed = seed + i
 
             enhanced_image = segs_upscaler.img2img_segs(cropped_image, model, clip, vae, seg_seed, steps, cfg, sampler_name, scheduler,
                                                         positive, negative, denoise,
                                                         noise_mask=cropped_mask, control_net_wrapper=seg.control_net_wrapper,
-                                                        inpaint_model=inpaint_model, noise_mask_feather=noise_mask_feather, scheduler_func_opt=scheduler_func_opt)
+                                                        inpaint_model=inpaint_model, noise_mask_feather=noise_mask_feather, scheduler_func_opt=scheduler_func_opt,
+                                                        size_plan=size_plan, plan_index=i)
             if not (enhanced_image is None):
-                new_image = new_image.cpu()
-                enhanced_image = enhanced_image.cpu()
                 left = seg.crop_region[0]
                 top = seg.crop_region[1]
-                tensor_paste(new_image, enhanced_image, (left, top), mask)
+                tensor_paste(new_image, enhanced_image.to(new_image.device), (left, top), mask.to(new_image.device))
 
                 if upscaler_hook_opt is not None:
                     new_image = upscaler_hook_opt.post_paste(new_image)
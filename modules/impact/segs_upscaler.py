@@ -1,5 +1,6 @@
 from impact.utils import *
 from impact import impact_sampling
+from impact import core
 from comfy import model_management
 from comfy.cli_args import args
 import nodes
@@ -83,16 +84,23 @@ def upscaler(image, upscale_model, rescale_factor, resampling_method, supersampl
 
 def img2img_segs(image, model, clip, vae, seed, steps, cfg, sampler_name, scheduler,
                  positive, negative, denoise, noise_mask, control_net_wrapper=None,
-                 inpaint_model=False, noise_mask_feather=0, scheduler_func_opt=None):
+                 inpaint_model=False, noise_mask_feather=0, scheduler_func_opt=None, size_plan=None, plan_index=0):
 
     original_image_size = image.shape[1:3]
+    h, w = original_image_size
+
+    # pad to the bucketed canvas, the padding is cropped after decoding
+    if size_plan is not None:
+        canvas_w, canvas_h = size_plan.get_size(plan_index)
+    else:
+        canvas_w, canvas_h = core.get_canvas_size(w, h)
+
+    use_canvas = (canvas_w, canvas_h) != (w, h)
 
     # Match to original image size
-    if original_image_size[0] % 8 > 0 or original_image_size[1] % 8 > 0:
-        scale = 8/min(original_image_size[0], original_image_size[1]) + 1
-        w = int(original_image_size[1] * scale)
-        h = int(original_image_size[0] * scale)
-        image = tensor_resize(image, w, h)
+    if not use_canvas and (h % 8 > 0 or w % 8 > 0):
+        scale = 8/min(h, w) + 1
+        image = tensor_resize(image, int(w * scale), int(h * scale))
 
     if noise_mask is not None:
         noise_mask = tensor_gaussian_blur_mask(noise_mask, noise_mask_feather)
@@ -101,6 +109,9 @@ def img2img_segs(image, model, clip, vae, seed, steps, cfg, sampler_name, schedu
         if noise_mask_feather > 0 and 'denoise_mask_function' not in model.model_options:
             model = nodes_differential_diffusion.DifferentialDiffusion().apply(model)[0]
 
+    if use_canvas:
+        image, noise_mask = core.pad_to_canvas(image, canvas_w, canvas_h, noise_mask)
+
     if control_net_wrapper is not None:
         positive, negative, _ = control_net_wrapper.apply(positive, negative, image, noise_mask)
 
@@ -128,9 +139,13 @@ def img2img_segs(image, model, clip, vae, seed, steps, cfg, sampler_name, schedu
     # prevent mixing of device
     refined_image = refined_image.cpu()
 
+    # crop the canvas padding
+    if use_canvas:
+        refined_image = refined_image[:, :h, :w, :]
+
     # Match to original image size
     if refined_image.shape[1:3] != original_image_size:
-        refined_image = tensor_resize(refined_image, original_image_size[1], original_image_size[0])
+        refined_image = tensor_resize(refined_image, w, h)
 
     # don't convert to latent - latent break image
     # preserving pil is much better
@@ -1,4 +1,4 @@
-from impact.utils import any_typ, ByPassTypeTuple, make_3d_mask
+from impact.utils import any_typ, ByPassTypeTuple, make_3d_mask, TensorBatchBuilder
 import comfy_extras.nodes_mask
 from nodes import MAX_RESOLUTION
 import torch
@@ -376,11 +376,13 @@ class ImageListToImageBatch:
             return (images[0],)
         else:
             image1 = images[0]
+            result = TensorBatchBuilder(sum(len(image) for image in images))
+            result.concat(image1)
             for image2 in images[1:]:
                 if image1.shape[1:] != image2.shape[1:]:
                     image2 = comfy.utils.common_upscale(image2.movedim(-1, 1), image1.shape[2], image1.shape[1], "lanczos", "center").movedim(1, -1)
-                image1 = torch.cat((image1, image2), dim=0)
-            return (image1,)
+                result.concat(image2)
+            return (result.tensor,)
 
 
 class ImageBatchToImageList:
@@ -6,6 +6,12 @@ import folder_paths
 import yaml
 import numpy as np
 import threading
+import time
+import functools
+import json
+import bisect
+from collections import OrderedDict
+from collections.abc import Mapping
 from impact import utils
 from impact import config
 
@@ -16,6 +22,21 @@ RE_WildCardQuantifier = re.compile(r"(?P<quantifier>\d+)#__(?P<keyword>[\w.\-+/*
 wildcard_lock = threading.Lock()
 wildcard_dict = {}
 
+# libyaml based loader is much faster than the pure python loader.
+# The wildcard files are plain mappings/lists of strings, so the safe loader is used with or without libyaml.
+# (the python specific tags such as `!!python/tuple` of the former FullLoader are not supported)
+yaml_loader = getattr(yaml, 'CSafeLoader', None) or yaml.SafeLoader
+
+wildcard_snapshot_version = 2
+
+
+def get_wildcard_snapshot_path():
+    # ComfyUI's user directory is kept across the restarts (the temp directory is cleared at startup)
+    if hasattr(folder_paths, 'get_user_directory'):
+        return os.path.join(folder_paths.get_user_directory(), "impact-pack", "wildcards.snapshot.json")
+
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "wildcards.snapshot.json"))
+
 
 def get_wildcard_list():
     with wildcard_lock:
@@ -32,53 +53,360 @@ def wildcard_normalize(x):
     return x.replace("\\", "/").replace(' ', '-').lower()
 
 
-def read_wildcard(k, v):
+def read_wildcard(k, v, target=None):
+    target = wildcard_dict if target is None else target
+
     if isinstance(v, list):
         k = wildcard_normalize(k)
-        wildcard_dict[k] = v
+        target[k] = v
     elif isinstance(v, dict):
         for k2, v2 in v.items():
             new_key = f"{k}/{k2}"
             new_key = wildcard_normalize(new_key)
-            read_wildcard(new_key, v2)
+            read_wildcard(new_key, v2, target)
     elif isinstance(v, str):
         k = wildcard_normalize(k)
-        wildcard_dict[k] = [v]
+        target[k] = [v]
+
+
+def read_wildcard_txt(file_path):
+    try:
+        with open(file_path, 'r', encoding="ISO-8859-1") as f:
+            lines = f.read().splitlines()
+    except yaml.reader.ReaderError:
+        with open(file_path, 'r', encoding="UTF-8", errors="ignore") as f:
+            lines = f.read().splitlines()
+
+    return [x for x in lines if not x.strip().startswith('#')]
+
+
+def read_wildcard_yaml(file_path):
+    """:return: {key: options} of the yaml file"""
+    try:
+        with open(file_path, 'r', encoding="ISO-8859-1") as f:
+            yaml_data = yaml.load(f, Loader=yaml_loader)
+    except yaml.reader.ReaderError as e:
+        with open(file_path, 'r', encoding="UTF-8", errors="ignore") as f:
+            yaml_data = yaml.load(f, Loader=yaml_loader)
+
+    res = {}
+    for k, v in yaml_data.items():
+        read_wildcard(k, v, res)
+
+    return res
+
+
+def _skip_yaml_node(event, events):
+    """consume the events of the node which starts with `event`"""
+    depth = 1 if isinstance(event, (yaml.SequenceStartEvent, yaml.MappingStartEvent)) else 0
+    while depth > 0:
+        event = next(events)
+        if isinstance(event, (yaml.SequenceStartEvent, yaml.MappingStartEvent)):
+            depth += 1
+        elif isinstance(event, (yaml.SequenceEndEvent, yaml.MappingEndEvent)):
+            depth -= 1
+
+
+def _index_yaml_mapping(events, path, keys, resolver):
+    """collect the keys of the mapping whose MappingStartEvent is consumed, in the same way as `read_wildcard`"""
+    while True:
+        event = next(events)
+        if isinstance(event, yaml.MappingEndEvent):
+            return
+
+        if not isinstance(event, yaml.ScalarEvent) or event.value == '<<':
+            # complex keys and merge keys are not wildcards
+            _skip_yaml_node(event, events)
+            _skip_yaml_node(next(events), events)
+            continue
 
+        key_path = path + [event.value]
+        event = next(events)
 
-def read_wildcard_dict(wildcard_path):
-    global wildcard_dict
+        if isinstance(event, yaml.MappingStartEvent):
+            _index_yaml_mapping(events, key_path, keys, resolver)
+            continue
+
+        if isinstance(event, yaml.ScalarEvent):
+            # only the string values are options. (same as `read_wildcard`)
+            tag = event.tag if event.tag not in (None, '!') else resolver.resolve(yaml.ScalarNode, event.value, event.implicit)
+            if tag != resolver.DEFAULT_SCALAR_TAG:
+                continue
+        else:
+            _skip_yaml_node(event, events)
+
+        keys.append(wildcard_normalize("/".join(key_path)))
+
+
+def index_wildcard_yaml(file_path):
+    """
+    :return: keys of the yaml file in the order of `read_wildcard_yaml`.
+             Only the parser events are scanned, the options are not constructed. (for the lazy loading mode)
+    """
+    keys = []
+    resolver = yaml.resolver.Resolver()
+
+    with open(file_path, 'r', encoding="ISO-8859-1") as f:
+        events = iter(yaml.parse(f, Loader=yaml_loader))
+        for event in events:
+            if isinstance(event, yaml.MappingStartEvent):
+                _index_yaml_mapping(events, [], keys, resolver)
+            elif isinstance(event, (yaml.SequenceStartEvent, yaml.ScalarEvent, yaml.AliasEvent)):
+                raise Exception(f"[Impact Pack] The wildcard yaml file must be a mapping: {file_path}")
+
+    return list(dict.fromkeys(keys))
+
+
+def iterate_wildcard_files(wildcard_path):
+    """:return: (key, file_path, is_yaml) of the wildcard files. `key` is None for the yaml files."""
     for root, directories, files in os.walk(wildcard_path, followlinks=True):
         for file in files:
             if file.endswith('.txt'):
                 file_path = os.path.join(root, file)
                 rel_path = os.path.relpath(file_path, wildcard_path)
                 key = wildcard_normalize(os.path.splitext(rel_path)[0])
-
-                try:
-                    with open(file_path, 'r', encoding="ISO-8859-1") as f:
-                        lines = f.read().splitlines()
-                        wildcard_dict[key] = [x for x in lines if not x.strip().startswith('#')]
-                except yaml.reader.ReaderError:
-                    with open(file_path, 'r', encoding="UTF-8", errors="ignore") as f:
-                        lines = f.read().splitlines()
-                        wildcard_dict[key] = [x for x in lines if not x.strip().startswith('#')]
+                yield key, file_path, False
             elif file.endswith('.yaml'):
-                file_path = os.path.join(root, file)
+                yield None, os.path.join(root, file), True
 
-                try:
-                    with open(file_path, 'r', encoding="ISO-8859-1") as f:
-                        yaml_data = yaml.load(f, Loader=yaml.FullLoader)
-                except yaml.reader.ReaderError as e:
-                    with open(file_path, 'r', encoding="UTF-8", errors="ignore") as f:
-                        yaml_data = yaml.load(f, Loader=yaml.FullLoader)
 
-                for k, v in yaml_data.items():
-                    read_wildcard(k, v)
+def read_wildcard_dict(wildcard_path, target=None):
+    target = wildcard_dict if target is None else target
+
+    for key, file_path, is_yaml in iterate_wildcard_files(wildcard_path):
+        if is_yaml:
+            target.update(read_wildcard_yaml(file_path))
+        else:
+            target[key] = read_wildcard_txt(file_path)
+
+    return target
+
+
+class LazyWildcardDict(Mapping):
+    """
+    Read-only wildcard dict for the lazy loading mode (`wildcard_lazy_load`).
+
+    Only the keys and their source files are indexed by `index_dir`. The options of a file are read when one of its keys
+    is accessed, and at most `max_loaded_files` files are kept in memory. (LRU)
+    The key order is the same as the eagerly loaded dict, so the glob lookups return the same options.
+    """
+
+    def __init__(self, max_loaded_files):
+        self.sources = {}   # key -> (file_path, is_yaml)
+        self.loaded = OrderedDict()   # file_path -> options (txt) or {key: options} (yaml)
+        self.max_loaded_files = max(1, max_loaded_files)
+        self.lock = threading.Lock()
+
+    def add_source(self, key, file_path, is_yaml):
+        self.sources[key] = file_path, is_yaml
+
+    def inherit_loaded(self, other, invalid_files):
+        """Take over the loaded files of `other` except `invalid_files`."""
+        with other.lock:
+            for file_path, data in other.loaded.items():
+                if file_path not in invalid_files:
+                    self.loaded[file_path] = data
+
+        while len(self.loaded) > self.max_loaded_files:
+            self.loaded.popitem(last=False)
+
+    def load_file(self, file_path, is_yaml):
+        with self.lock:
+            if file_path in self.loaded:
+                self.loaded.move_to_end(file_path)
+                return self.loaded[file_path]
+
+        try:
+            data = read_wildcard_yaml(file_path) if is_yaml else read_wildcard_txt(file_path)
+        except Exception as e:
+            print(f"[Impact Pack] Failed to load wildcard file '{file_path}': {e}")
+            data = {} if is_yaml else []
+
+        with self.lock:
+            self.loaded[file_path] = data
+            while len(self.loaded) > self.max_loaded_files:
+                self.loaded.popitem(last=False)
+
+        return data
+
+    def __getitem__(self, key):
+        file_path, is_yaml = self.sources[key]
+        data = self.load_file(file_path, is_yaml)
+
+        if is_yaml:
+            return data.get(key, [])
+
+        return data
+
+    def __contains__(self, key):
+        return key in self.sources
+
+    def __iter__(self):
+        return iter(self.sources)
 
-    return wildcard_dict
+    def __len__(self):
+        return len(self.sources)
 
+    def keys(self):
+        return self.sources.keys()
 
+
+class WildcardKeyIndex:
+    """
+    Index of the wildcard keys for the glob keywords such as `__*/foo__` and `__animal/c*__`.
+
+    * path trie of the `/`-separated keys: narrows the candidates by the literal prefix of the glob
+    * sorted (segment, key) list of the non-first path segments: narrows the candidates of `*/foo...`
+    * memoized glob -> option list
+
+    The candidates are verified with the same regex as before, and the options are concatenated in the order of
+    `wildcard_dict`, so the result is identical to the full scan.
+    """
+
+    max_cached_globs = 4096
+
+    def __init__(self, wildcard_dict):
+        self.source = wildcard_dict
+        self.source_size = len(wildcard_dict)
+        self.order = {}
+        self.trie = {}
+        segments = []
+
+        for i, key in enumerate(wildcard_dict.keys()):
+            self.order[key] = i
+
+            node = self.trie
+            parts = key.split('/')
+            for part in parts:
+                node = node.setdefault(part, {})
+            node.setdefault(None, []).append(key)
+
+            for part in parts[1:]:
+                segments.append((part, key))
+
+        segments.sort()
+        self.segment_names = [x[0] for x in segments]
+        self.segment_keys = [x[1] for x in segments]
+
+        self.glob_cache = {}
+        self.lock = threading.Lock()
+
+    def is_valid_for(self, wildcard_dict):
+        return self.source is wildcard_dict and self.source_size == len(wildcard_dict)
+
+    @staticmethod
+    def literal_prefix(pattern):
+        for i, c in enumerate(pattern):
+            if c in '*.+':
+                return pattern[:i]
+        return pattern
+
+    @staticmethod
+    def collect(node, res):
+        for name, child in node.items():
+            if name is None:
+                res.extend(child)
+            else:
+                WildcardKeyIndex.collect(child, res)
+
+    def prefix_candidates(self, prefix):
+        parts = prefix.split('/')
+        node = self.trie
+        for part in parts[:-1]:
+            node = node.get(part)
+            if node is None:
+                return []
+
+        res = []
+        last = parts[-1]
+        for name, child in node.items():
+            if name is None:
+                if last == '':
+                    res.extend(child)
+            elif name.startswith(last):
+                WildcardKeyIndex.collect(child, res)
+
+        return res
+
+    def segment_candidates(self, segment_prefix):
+        lo = bisect.bisect_left(self.segment_names, segment_prefix)
+        hi = bisect.bisect_left(self.segment_names, segment_prefix + '\uffff')
+        return set(self.segment_keys[lo:hi])
+
+    def candidates(self, keyword):
+        if any(c in keyword for c in '?[](){}|^$\\'):
+            # other regex syntax: no narrowing
+            return self.source.keys()
+
+        prefix = WildcardKeyIndex.literal_prefix(keyword)
+        if prefix != '':
+            return self.prefix_candidates(prefix)
+
+        if keyword.startswith('*/'):
+            segment_prefix = WildcardKeyIndex.literal_prefix(keyword[2:]).split('/')[0]
+            if segment_prefix != '':
+                return self.segment_candidates(segment_prefix)
+
+        return self.source.keys()
+
+    def match_keys(self, keyword):
+        subpattern = re.compile(keyword.replace('*', '.*').replace('+', '\\+'))
+        keys = [k for k in self.candidates(keyword) if subpattern.match(k) is not None or subpattern.match(k+'/') is not None]
+        keys.sort(key=self.order.__getitem__)
+        return keys
+
+    def get_options(self, keyword):
+        """:return: options of the every key matched to the glob `keyword`, or None if nothing is matched"""
+        with self.lock:
+            cached = self.glob_cache.get(keyword)
+
+        if cached is None:
+            keys = self.match_keys(keyword)
+            options = None
+            if len(keys) > 0:
+                options = []
+                for k in keys:
+                    options += self.source[k]
+
+            # the lazy dict keeps only the matched keys, so that the options don't outlive its LRU
+            cached = (keys, options if isinstance(self.source, dict) else None)
+
+            with self.lock:
+                if len(self.glob_cache) >= WildcardKeyIndex.max_cached_globs:
+                    self.glob_cache.clear()
+                self.glob_cache[keyword] = cached
+
+            return options
+
+        keys, options = cached
+        if options is None and len(keys) > 0:
+            options = []
+            for k in keys:
+                options += self.source[k]
+
+        return options
+
+
+wildcard_key_index = None
+
+
+def get_wildcard_key_index(local_wildcard_dict):
+    global wildcard_key_index
+
+    index = wildcard_key_index
+    if index is None or not index.is_valid_for(local_wildcard_dict):
+        index = WildcardKeyIndex(local_wildcard_dict)
+        wildcard_key_index = index
+
+    return index
+
+
+def invalidate_wildcard_key_index():
+    global wildcard_key_index
+    wildcard_key_index = None
+
+
+@functools.lru_cache(maxsize=1024)
 def process_comment_out(text):
     lines = text.split('\n')
 
@@ -100,6 +428,244 @@ def process_comment_out(text):
     return '\n'.join(lines0)
 
 
+RE_Option = re.compile(r'{([^{}]*?)}')
+RE_Wildcard = re.compile(r"__([\w.\-+/*\\]+?)__")
+RE_SelectRange = re.compile(r'(\d+)(-(\d+))?')
+RE_SelectRange2 = re.compile(r'-(\d+)')
+RE_OptionWeight = re.compile(r'^\s*[0-9.]+::')
+
+
+def expand_quantifiers(text):
+    option_quantifier = [e.groupdict() for e in RE_WildCardQuantifier.finditer(text)]
+    for match in option_quantifier:
+        keyword = match['keyword'].lower()
+        quantifier = int(match['quantifier']) if match['quantifier'] else 1
+        replacement = '__|__'.join([keyword,] * quantifier)
+        wilder_keyword = keyword.replace('*', '\\*')
+        RE_TEMP = re.compile(fr"(?P<quantifier>\d+)#__(?P<keyword>{wilder_keyword})__", re.IGNORECASE)
+        text = RE_TEMP.sub(f"__{replacement}__", text)
+
+    return text
+
+
+def option_weights(options):
+    adjusted_probabilities = []
+
+    total_prob = 0
+
+    for option in options:
+        parts = option.split('::', 1)
+        if len(parts) == 2 and is_numeric_string(parts[0].strip()):
+            config_value = float(parts[0].strip())
+        else:
+            config_value = 1  # Default value if no configuration is provided
+
+        adjusted_probabilities.append(config_value)
+        total_prob += config_value
+
+    return [prob / total_prob for prob in adjusted_probabilities]
+
+
+class OptionGroup:
+    """
+    Parsed content of an option group `{...}`.
+
+    `{count$$__wildcard__}` keeps `wildcard_text`, since its options depend on the wildcard dictionary.
+    """
+
+    def __init__(self, options, select_range, select_sep, wildcard_text):
+        self.options = options
+        self.select_range = select_range
+        self.select_sep = select_sep
+        self.wildcard_text = wildcard_text
+
+        if wildcard_text is None:
+            self.probabilities = option_weights(options)
+            self.stripped_options = [RE_OptionWeight.sub('', x, 1) for x in options]
+
+    def select(self, random_gen, get_wildcard_options):
+        if self.wildcard_text is not None:
+            options = get_wildcard_options(self.wildcard_text)
+            probabilities = option_weights(options)
+            stripped_options = [RE_OptionWeight.sub('', x, 1) for x in options]
+        else:
+            options = self.options
+            probabilities = self.probabilities
+            stripped_options = self.stripped_options
+
+        if self.select_range is None:
+            select_count = 1
+        else:
+            select_count = random_gen.integers(low=self.select_range[0], high=self.select_range[1]+1, size=1)
+
+        # NOTE: the indices consume the random generator in the same way as the option list
+        indices = list(range(len(options)))
+        if select_count > len(options):
+            random_gen.shuffle(indices)
+            selected_indices = indices
+        else:
+            selected_indices = random_gen.choice(len(options), p=probabilities, size=select_count, replace=False)
+
+        return self.select_sep.join([stripped_options[i] for i in selected_indices])
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_option_group(content):
+    options = content.split('|')
+
+    multi_select_pattern = options[0].split('$$')
+    select_range = None
+    select_sep = ' '
+    wildcard_text = None
+
+    if len(multi_select_pattern) > 1:
+        r = RE_SelectRange.match(options[0])
+
+        if r is None:
+            r = RE_SelectRange2.match(options[0])
+            a = '1'
+            b = r.group(1).strip()
+        else:
+            a = r.group(1).strip()
+            b = r.group(3)
+            if b is not None:
+                b = b.strip()
+
+        if r is not None:
+            if b is not None and is_numeric_string(a) and is_numeric_string(b):
+                # PATTERN: num1-num2
+                select_range = int(a), int(b)
+            elif is_numeric_string(a):
+                # PATTERN: num
+                x = int(a)
+                select_range = (x, x)
+
+            if select_range is not None and len(multi_select_pattern) == 2:
+                # PATTERN: count$$
+                matches = RE_Wildcard.findall(multi_select_pattern[1])
+                if len(options) == 1 and matches:
+                    # count$$<single wildcard>
+                    wildcard_text = multi_select_pattern[1]
+                else:
+                    # count$$opt1|opt2|...
+                    options[0] = multi_select_pattern[1]
+            elif select_range is not None and len(multi_select_pattern) == 3:
+                # PATTERN: count$$ sep $$
+                select_sep = multi_select_pattern[1]
+                options[0] = multi_select_pattern[2]
+
+    return OptionGroup(options, select_range, select_sep, wildcard_text)
+
+
+class TemplateGroup:
+    __slots__ = ('pieces', 'start', 'height')
+
+    def __init__(self, start):
+        self.pieces = []
+        self.start = start
+        self.height = 1
+
+
+def render_pieces(pieces, results):
+    """:param results: evaluated text of the groups (by id). The groups which are not evaluated yet are rendered as is."""
+    texts = []
+    for x in pieces:
+        if isinstance(x, str):
+            texts.append(x)
+        elif id(x) in results:
+            texts.append(results[id(x)])
+        else:
+            texts.append('{' + render_pieces(x.pieces, results) + '}')
+
+    return ''.join(texts)
+
+
+class WildcardTemplate:
+    """
+    Compiled wildcard prompt: the nesting tree of the option groups.
+
+    The option groups are evaluated in the order of (nesting height, position), which is the same order as
+    the repeated innermost `{...}` substitution, so the result is the same for the same seed.
+    """
+
+    def __init__(self, text):
+        self.text = expand_quantifiers(text)
+        self.pieces, self.levels = WildcardTemplate.parse(self.text)
+
+    @staticmethod
+    def parse(text):
+        root = []
+        stack = []
+        groups = []
+        literal_start = 0
+
+        def current_pieces():
+            return stack[-1].pieces if stack else root
+
+        for i, c in enumerate(text):
+            if c == '{':
+                if literal_start < i:
+                    current_pieces().append(text[literal_start:i])
+                stack.append(TemplateGroup(i))
+                literal_start = i + 1
+            elif c == '}' and stack:
+                if literal_start < i:
+                    current_pieces().append(text[literal_start:i])
+                group = stack.pop()
+                groups.append(group)
+                current_pieces().append(group)
+                if stack:
+                    stack[-1].height = max(stack[-1].height, group.height + 1)
+                literal_start = i + 1
+
+        if literal_start < len(text):
+            current_pieces().append(text[literal_start:])
+
+        # unmatched '{' is a literal
+        while stack:
+            group = stack.pop()
+            parent = current_pieces()
+            parent.append('{')
+            parent.extend(group.pieces)
+            for x in group.pieces:
+                if not isinstance(x, str) and stack:
+                    stack[-1].height = max(stack[-1].height, x.height + 1)
+
+        levels = {}
+        for group in groups:
+            levels.setdefault(group.height, []).append(group)
+
+        return root, [sorted(levels[h], key=lambda x: x.start) for h in sorted(levels.keys())]
+
+    def evaluate_options(self, random_gen, get_wildcard_options):
+        """
+        :return: (evaluated text, True if the selected options inserted new braces)
+                 If the braces are inserted, the evaluation stops after the current level and the rest has to be
+                 processed by the string substitution.
+        """
+        if len(self.levels) == 0:
+            return self.text, False
+
+        results = {}
+        for level in self.levels:
+            inserted = False
+            for group in level:
+                result = parse_option_group(render_pieces(group.pieces, results)).select(random_gen, get_wildcard_options)
+                results[id(group)] = result
+                if '{' in result or '}' in result:
+                    inserted = True
+
+            if inserted:
+                return render_pieces(self.pieces, results), True
+
+        return render_pieces(self.pieces, results), False
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_wildcard_template(text):
+    return WildcardTemplate(text)
+
+
 def process(text, seed=None):
     text = process_comment_out(text)
 
@@ -114,94 +680,15 @@ def process(text, seed=None):
 
         def replace_option(match):
             nonlocal replacements_found
-            options = match.group(1).split('|')
-
-            multi_select_pattern = options[0].split('$$')
-            select_range = None
-            select_sep = ' '
-            range_pattern = r'(\d+)(-(\d+))?'
-            range_pattern2 = r'-(\d+)'
-            wildcard_pattern = r"__([\w.\-+/*\\]+?)__"
-
-            if len(multi_select_pattern) > 1:
-                r = re.match(range_pattern, options[0])
-
-                if r is None:
-                    r = re.match(range_pattern2, options[0])
-                    a = '1'
-                    b = r.group(1).strip()
-                else:
-                    a = r.group(1).strip()
-                    b = r.group(3)
-                    if b is not None:
-                        b = b.strip()
-                        
-                if r is not None:
-                    if b is not None and is_numeric_string(a) and is_numeric_string(b):
-                        # PATTERN: num1-num2
-                        select_range = int(a), int(b)
-                    elif is_numeric_string(a):
-                        # PATTERN: num
-                        x = int(a)
-                        select_range = (x, x)
-
-                    if select_range is not None and len(multi_select_pattern) == 2:
-                        # PATTERN: count$$
-                        matches = re.findall(wildcard_pattern, multi_select_pattern[1])
-                        if len(options) == 1 and matches:
-                            # count$$<single wildcard>
-                            options = get_wildcard_options(multi_select_pattern[1])
-                        else:
-                            # count$$opt1|opt2|...
-                            options[0] = multi_select_pattern[1]
-                    elif select_range is not None and len(multi_select_pattern) == 3:
-                        # PATTERN: count$$ sep $$
-                        select_sep = multi_select_pattern[1]
-                        options[0] = multi_select_pattern[2]
-
-            adjusted_probabilities = []
-
-            total_prob = 0
-
-            for option in options:
-                parts = option.split('::', 1)
-                if len(parts) == 2 and is_numeric_string(parts[0].strip()):
-                    config_value = float(parts[0].strip())
-                else:
-                    config_value = 1  # Default value if no configuration is provided
-
-                adjusted_probabilities.append(config_value)
-                total_prob += config_value
-
-            normalized_probabilities = [prob / total_prob for prob in adjusted_probabilities]
-
-            if select_range is None:
-                select_count = 1
-            else:
-                select_count = random_gen.integers(low=select_range[0], high=select_range[1]+1, size=1)
-
-            if select_count > len(options):
-                random_gen.shuffle(options)
-                selected_items = options
-            else:
-                selected_items = random_gen.choice(options, p=normalized_probabilities, size=select_count, replace=False)
-
-            selected_items2 = [re.sub(r'^\s*[0-9.]+::', '', x, 1) for x in selected_items]
-            replacement = select_sep.join(selected_items2)
-            if '::' in replacement:
-                pass
-
             replacements_found = True
-            return replacement
+            return parse_option_group(match.group(1)).select(random_gen, get_wildcard_options)
 
-        pattern = r'{([^{}]*?)}'
-        replaced_string = re.sub(pattern, replace_option, string)
+        replaced_string = RE_Option.sub(replace_option, string)
 
         return replaced_string, replacements_found
 
     def get_wildcard_options(string):
-        pattern = r"__([\w.\-+/*\\]+?)__"
-        matches = re.findall(pattern, string)
+        matches = RE_Wildcard.findall(string)
 
         options = []
 
@@ -211,15 +698,9 @@ def process(text, seed=None):
             if keyword in local_wildcard_dict:
                 options.extend(local_wildcard_dict[keyword])
             elif '*' in keyword:
-                subpattern = keyword.replace('*', '.*').replace('+', '\\+')
-                total_patterns = []
-                found = False
-                for k, v in local_wildcard_dict.items():
-                    if re.match(subpattern, k) is not None or re.match(subpattern, k+'/') is not None:
-                        total_patterns += v
-                        found = True
-
-                if found:
+                total_patterns = get_wildcard_key_index(local_wildcard_dict).get_options(keyword)
+
+                if total_patterns is not None:
                     options.extend(total_patterns)
             elif '/' not in keyword:
                 string_fallback = string.replace(f"__{match}__", f"__*/{match}__", 1)
@@ -228,8 +709,7 @@ def process(text, seed=None):
         return options
 
     def replace_wildcard(string):
-        pattern = r"__([\w.\-+/*\\]+?)__"
-        matches = re.findall(pattern, string)
+        matches = RE_Wildcard.findall(string)
 
         replacements_found = False
 
@@ -237,19 +717,20 @@ def process(text, seed=None):
             keyword = match.lower()
             keyword = wildcard_normalize(keyword)
             if keyword in local_wildcard_dict:
-                replacement = random_gen.choice(local_wildcard_dict[keyword])
+                options = local_wildcard_dict[keyword]
+                if len(options) == 0:
+                    print(f"[Impact Pack] WARN: wildcard '__{match}__' has no options. (skipped)")
+                    continue
+
+                replacement = random_gen.choice(options)
                 replacements_found = True
                 string = string.replace(f"__{match}__", replacement, 1)
             elif '*' in keyword:
-                subpattern = keyword.replace('*', '.*').replace('+', '\\+')
-                total_patterns = []
-                found = False
-                for k, v in local_wildcard_dict.items():
-                    if re.match(subpattern, k) is not None or re.match(subpattern, k+'/') is not None:
-                        total_patterns += v
-                        found = True
-
-                if found:
+                total_patterns = get_wildcard_key_index(local_wildcard_dict).get_options(keyword)
+
+                if total_patterns is not None and len(total_patterns) == 0:
+                    print(f"[Impact Pack] WARN: wildcard '__{match}__' has no options. (skipped)")
+                elif total_patterns is not None:
                     replacement = random_gen.choice(total_patterns)
                     replacements_found = True
                     string = string.replace(f"__{match}__", replacement, 1)
@@ -263,19 +744,11 @@ def process(text, seed=None):
     stop_unwrap = False
     while not stop_unwrap and replace_depth > 1:
         replace_depth -= 1  # prevent infinite loop
-        
-        option_quantifier = [e.groupdict() for e in RE_WildCardQuantifier.finditer(text)]
-        for match in option_quantifier:
-            keyword = match['keyword'].lower()
-            quantifier = int(match['quantifier']) if match['quantifier'] else 1
-            replacement = '__|__'.join([keyword,] * quantifier)
-            wilder_keyword = keyword.replace('*', '\\*')
-            RE_TEMP = re.compile(fr"(?P<quantifier>\d+)#__(?P<keyword>{wilder_keyword})__", re.IGNORECASE)
-            text = RE_TEMP.sub(f"__{replacement}__", text)
-
-        # pass1: replace options
-        pass1, is_replaced1 = replace_options(text)
 
+        # pass1: replace options (compiled template)
+        pass1, is_replaced1 = compile_wildcard_template(text).evaluate_options(random_gen, get_wildcard_options)
+
+        # the selected options inserted new braces: fallback to the string substitution
         while is_replaced1:
             pass1, is_replaced1 = replace_options(pass1)
 
@@ -552,16 +1025,228 @@ def process_wildcard_for_segs(wildcard):
             return None, WildcardChooser([(None, wildcard)], False)
 
 
+wildcard_reload_lock = threading.Lock()
+wildcard_file_cache = {}   # file_path -> ((mtime_ns, size), {key: options}) or ((mtime_ns, size), [key]) for lazy mode
+wildcard_watcher = None
+
+
+def scan_wildcard_files():
+    """:return: [(key, file_path, is_yaml, (mtime_ns, size))] of the wildcard directories in the loading order"""
+    wildcard_paths = [wildcards_path]
+
+    try:
+        wildcard_paths.append(config.get_config()['custom_wildcards'])
+    except Exception as e:
+        print(f"[Impact Pack] Failed to load custom wildcards directory.")
+
+    res = []
+    for wildcard_path in wildcard_paths:
+        for key, file_path, is_yaml in iterate_wildcard_files(wildcard_path):
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                continue  # removed while scanning
+
+            res.append((key, file_path, is_yaml, (st.st_mtime_ns, st.st_size)))
+
+    return res
+
+
+def read_wildcard_file(key, file_path, is_yaml, lazy):
+    try:
+        if lazy:
+            # the options of the txt file are read on demand
+            return index_wildcard_yaml(file_path) if is_yaml else [key]
+
+        if is_yaml:
+            return read_wildcard_yaml(file_path)
+
+        return {key: read_wildcard_txt(file_path)}
+    except Exception as e:
+        print(f"[Impact Pack] Failed to load wildcard file '{file_path}': {e}")
+        return [] if lazy else {}
+
+
+def build_wildcard_dict(entries, lazy, old_dict, invalid_files):
+    if lazy:
+        res = LazyWildcardDict(config.get_config()['wildcard_lazy_cache_files'])
+        for key, file_path, is_yaml, _ in entries:
+            for k in wildcard_file_cache[file_path][1]:
+                res.add_source(k, file_path, is_yaml)
+
+        if isinstance(old_dict, LazyWildcardDict):
+            res.inherit_loaded(old_dict, invalid_files)
+    else:
+        res = {}
+        for key, file_path, is_yaml, _ in entries:
+            res.update(wildcard_file_cache[file_path][1])
+
+    return res
+
+
+def reload_wildcard_files(old_dict, force=False):
+    """
+    Read only the added/changed files (by mtime and size) and rebuild the wildcard dict from the cached files.
+
+    :return: (new wildcard dict or None if nothing is changed and not `force`, diff summary)
+    """
+    lazy = config.get_config()['wildcard_lazy_load']
+    entries = scan_wildcard_files()
+
+    added = []
+    changed = []
+    seen = set()
+    for key, file_path, is_yaml, stat_key in entries:
+        if file_path in seen:
+            continue
+        seen.add(file_path)
+
+        cached = wildcard_file_cache.get(file_path)
+        if cached is not None and cached[0] == stat_key:
+            continue
+
+        if cached is None:
+            added.append(file_path)
+        else:
+            changed.append(file_path)
+
+        wildcard_file_cache[file_path] = stat_key, read_wildcard_file(key, file_path, is_yaml, lazy)
+
+    removed = [x for x in wildcard_file_cache.keys() if x not in seen]
+    for x in removed:
+        del wildcard_file_cache[x]
+
+    summary = {'added': added, 'changed': changed, 'removed': removed, 'keys_added': 0, 'keys_removed': 0, 'keys_updated': 0}
+
+    if len(added) == 0 and len(changed) == 0 and len(removed) == 0 and not force:
+        return None, summary
+
+    new_dict = build_wildcard_dict(entries, lazy, old_dict, set(changed + removed))
+
+    old_keys = set(old_dict.keys())
+    new_keys = set(new_dict.keys())
+    updated_keys = set()
+    for file_path in changed:
+        updated_keys.update(wildcard_file_cache[file_path][1])
+
+    summary['keys_added'] = len(new_keys - old_keys)
+    summary['keys_removed'] = len(old_keys - new_keys)
+    summary['keys_updated'] = len(updated_keys & old_keys & new_keys)
+
+    return new_dict, summary
+
+
+def load_wildcard_snapshot():
+    """
+    Restore `wildcard_file_cache` from the snapshot of the parsed wildcard files. (`wildcard_snapshot`)
+    The files whose mtime or size is changed since the snapshot are read again by `reload_wildcard_files`.
+    """
+    snapshot_path = get_wildcard_snapshot_path()
+    if not config.get_config()['wildcard_snapshot'] or not os.path.exists(snapshot_path):
+        return
+
+    try:
+        with open(snapshot_path, 'r', encoding="UTF-8") as f:
+            snapshot = json.load(f)
+
+        if snapshot.get('version') == wildcard_snapshot_version and snapshot.get('lazy') == config.get_config()['wildcard_lazy_load']:
+            for file_path, (stat_key, data) in snapshot['files'].items():
+                wildcard_file_cache[file_path] = tuple(stat_key), data
+    except Exception as e:
+        print(f"[Impact Pack] Failed to load the wildcard snapshot (ignored): {e}")
+
+
+def save_wildcard_snapshot():
+    if not config.get_config()['wildcard_snapshot']:
+        return
+
+    snapshot = {
+        'version': wildcard_snapshot_version,
+        'lazy': config.get_config()['wildcard_lazy_load'],
+        'files': wildcard_file_cache,
+    }
+
+    snapshot_path = get_wildcard_snapshot_path()
+    tmp_path = snapshot_path + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+        with open(tmp_path, 'w', encoding="UTF-8") as f:
+            # the non-string yaml scalars (e.g. dates) are stored as strings
+            json.dump(snapshot, f, ensure_ascii=False, default=str)
+        os.replace(tmp_path, snapshot_path)
+    except Exception as e:
+        print(f"[Impact Pack] Failed to save the wildcard snapshot: {e}")
+
+
 def wildcard_load():
+    """Full load of the wildcard directories. (only the changed files since the snapshot are read)"""
     global wildcard_dict
-    wildcard_dict = {}
 
-    with wildcard_lock:
-        read_wildcard_dict(wildcards_path)
+    with wildcard_reload_lock:
+        invalidate_wildcard_key_index()
+
+        with wildcard_lock:
+            wildcard_file_cache.clear()
+            wildcard_dict = {}
+
+            load_wildcard_snapshot()
+
+            wildcard_dict, summary = reload_wildcard_files(wildcard_dict, force=True)
+
+            if len(summary['added']) + len(summary['changed']) + len(summary['removed']) > 0:
+                save_wildcard_snapshot()
+
+            get_wildcard_key_index(wildcard_dict)
+
+            print(f"[Impact Pack] Wildcards loading done.")
+
+    interval = config.get_config()['wildcard_watch_interval']
+    if interval > 0:
+        start_wildcard_watcher(interval)
+
+
+def wildcard_reload():
+    """
+    Incremental reload of the wildcard directories. Only the added, changed and removed files are read.
+
+    :return: diff summary {'added': [file], 'changed': [file], 'removed': [file], 'keys_added': n, 'keys_removed': n, 'keys_updated': n}
+    """
+    global wildcard_dict, wildcard_key_index
+
+    with wildcard_reload_lock:
+        # NOTE: the scan is done without `wildcard_lock`, so that `process` isn't blocked by the slow filesystems.
+        new_dict, summary = reload_wildcard_files(wildcard_dict)
+
+        if new_dict is not None:
+            index = WildcardKeyIndex(new_dict)
+
+            with wildcard_lock:
+                wildcard_dict = new_dict
+                wildcard_key_index = index
+
+            save_wildcard_snapshot()
+
+    return summary
+
+
+def wildcard_watch(interval):
+    while True:
+        time.sleep(interval)
 
         try:
-            read_wildcard_dict(config.get_config()['custom_wildcards'])
+            summary = wildcard_reload()
+            if len(summary['added']) + len(summary['changed']) + len(summary['removed']) > 0:
+                print(f"[Impact Pack] Wildcards reloaded: {len(summary['added'])} added, {len(summary['changed'])} changed, {len(summary['removed'])} removed files")
         except Exception as e:
-            print(f"[Impact Pack] Failed to load custom wildcards directory.")
+            print(f"[Impact Pack] Failed to reload wildcards: {e}")
+
+
+def start_wildcard_watcher(interval):
+    """Start the polling thread which keeps the wildcards up to date. (`wildcard_watch_interval` seconds)"""
+    global wildcard_watcher
+
+    if wildcard_watcher is not None:
+        return
 
-        print(f"[Impact Pack] Wildcards loading done.")
+    wildcard_watcher = threading.Thread(target=wildcard_watch, args=(interval,), daemon=True)
+    wildcard_watcher.start()
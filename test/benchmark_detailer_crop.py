@@ -0,0 +1,105 @@
+"""
+Benchmark of the per segment crop/paste of `DetailerForEach`:
+the numpy round-trip of the whole frame it replaced against the tensor view crop and the in-place paste.
+
+The sampling is replaced by a cheap stand-in, so the times are the overhead of the crop and paste only.
+
+Run with the python of ComfyUI:
+    python custom_nodes/ComfyUI-Impact-Pack/test/benchmark_detailer_crop.py [--segs 100] [--device cpu]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+impact_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+comfy_path = os.path.dirname(os.path.dirname(impact_path))
+sys.path.append(comfy_path)
+sys.path.append(os.path.join(impact_path, "modules"))
+
+import torch
+from impact.utils import crop_ndarray4, crop_tensor4, to_tensor, tensor_paste
+
+
+def fake_enhance(cropped_image):
+    return 1 - cropped_image
+
+
+def numpy_round_trip(image, regions, masks):
+    for region, mask in zip(regions, masks):
+        cropped_image = to_tensor(crop_ndarray4(image.cpu().numpy(), region))
+        orig_cropped_image = cropped_image.clone()
+        enhanced_image = fake_enhance(orig_cropped_image)
+
+        image = image.cpu()
+        enhanced_image = enhanced_image.cpu()
+        tensor_paste(image, enhanced_image, (region[0], region[1]), mask.cpu())
+
+    return image
+
+
+def tensor_view(image, regions, masks):
+    for region, mask in zip(regions, masks):
+        cropped_image = crop_tensor4(image, region).clone()
+        enhanced_image = fake_enhance(cropped_image)
+
+        tensor_paste(image, enhanced_image.to(image.device), (region[0], region[1]), mask.to(image.device))
+
+    return image
+
+
+def make_regions(size, segs, seg_size, generator):
+    regions = []
+    for _ in range(segs):
+        x1, y1 = torch.randint(0, size - seg_size, (2,), generator=generator).tolist()
+        regions.append((x1, y1, x1 + seg_size, y1 + seg_size))
+    return regions
+
+
+def measure(func, image, repeat, device):
+    times = []
+    for _ in range(repeat):
+        canvas = image.clone()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        func(canvas)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 2048, 4096], help="frame width and height")
+    parser.add_argument("--segs", type=int, default=100, help="number of segments")
+    parser.add_argument("--seg-size", type=int, default=256, help="crop region width and height")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    generator = torch.Generator().manual_seed(0)
+
+    print(f"{args.segs} segments of {args.seg_size}x{args.seg_size}, device: {device}, best of {args.repeat}")
+    print(f"{'frame':>10} {'numpy':>12} {'tensor':>12} {'numpy/seg':>12} {'tensor/seg':>12} {'speedup':>8}")
+
+    for size in args.sizes:
+        image = torch.rand((1, size, size, 3), generator=generator).to(device)
+        regions = make_regions(size, args.segs, args.seg_size, generator)
+        masks = [torch.rand((1, args.seg_size, args.seg_size, 1), generator=generator).to(device) for _ in regions]
+
+        # the two must paste the same result
+        assert torch.allclose(numpy_round_trip(image.clone(), regions, masks).cpu(), tensor_view(image.clone(), regions, masks).cpu())
+
+        t_numpy = measure(lambda canvas: numpy_round_trip(canvas, regions, masks), image, args.repeat, device)
+        t_tensor = measure(lambda canvas: tensor_view(canvas, regions, masks), image, args.repeat, device)
+
+        print(f"{f'{size}x{size}':>10} {t_numpy:>11.3f}s {t_tensor:>11.3f}s "
+              f"{t_numpy / args.segs * 1000:>10.2f}ms {t_tensor / args.segs * 1000:>10.2f}ms {t_numpy / t_tensor:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Benchmark of `core.segs_to_combined_mask`/`core.segs_to_masklist` against the uint8 implementations they replaced.
+
+The old and new functions must give the same binary masks.
+`segs_to_masklist` returns one full frame mask per seg (200 segs of 4096x4096 float32 are 13 GB),
+so it is measured on `--masklist-size` frames.
+
+Run with the python of ComfyUI:
+    python custom_nodes/ComfyUI-Impact-Pack/test/benchmark_segs_to_mask.py [--segs 1 200] [--size 4096]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+impact_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+comfy_path = os.path.dirname(os.path.dirname(impact_path))
+sys.path.append(comfy_path)
+sys.path.append(os.path.join(impact_path, "modules"))
+
+import numpy as np
+import torch
+from impact import core
+from impact.core import SEG, get_packed_mask, pack_seg
+
+
+def old_segs_to_combined_mask(segs):
+    shape = segs[0]
+    h = shape[0]
+    w = shape[1]
+
+    mask = np.zeros((h, w), dtype=np.uint8)
+
+    for seg in segs[1]:
+        crop_region = seg.crop_region
+        packed_mask = get_packed_mask(seg)
+        if packed_mask is not None:
+            mask[crop_region[1]:crop_region[3], crop_region[0]:crop_region[2]][packed_mask.to_bool()] = 255
+        else:
+            cropped_mask = seg.cropped_mask
+            mask[crop_region[1]:crop_region[3], crop_region[0]:crop_region[2]] |= (cropped_mask * 255).astype(np.uint8)
+
+    return torch.from_numpy(mask.astype(np.float32) / 255.0)
+
+
+def old_segs_to_masklist(segs):
+    shape = segs[0]
+    h = shape[0]
+    w = shape[1]
+
+    masks = []
+    for seg in segs[1]:
+        if isinstance(seg.cropped_mask, np.ndarray):
+            cropped_mask = torch.from_numpy(seg.cropped_mask)
+        else:
+            cropped_mask = seg.cropped_mask
+
+        if cropped_mask.ndim == 2:
+            cropped_mask = cropped_mask.unsqueeze(0)
+
+        n = len(cropped_mask)
+
+        mask = torch.zeros((n, h, w), dtype=torch.uint8)
+        crop_region = seg.crop_region
+        mask[:, crop_region[1]:crop_region[3], crop_region[0]:crop_region[2]] |= (cropped_mask * 255).to(torch.uint8)
+        mask = (mask / 255.0).to(torch.float32)
+
+        for x in mask:
+            masks.append(x)
+
+    if len(masks) == 0:
+        empty_mask = torch.zeros((h, w), dtype=torch.float32, device="cpu")
+        masks = [empty_mask]
+
+    return masks
+
+
+def make_segs(size, count, max_seg_size, rng):
+    items = []
+    for _ in range(count):
+        seg_w, seg_h = rng.integers(64, max_seg_size, size=2)
+        x1 = int(rng.integers(0, size - seg_w))
+        y1 = int(rng.integers(0, size - seg_h))
+        cropped_mask = (rng.random((seg_h, seg_w)) > 0.5).astype(np.float32)
+        crop_region = (x1, y1, x1 + int(seg_w), y1 + int(seg_h))
+        items.append(SEG(None, cropped_mask, 0.9, crop_region, crop_region, 'A', None))
+
+    return (size, size), items
+
+
+def measure(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--segs", type=int, nargs="+", default=[1, 200])
+    parser.add_argument("--size", type=int, default=4096, help="frame width and height")
+    parser.add_argument("--masklist-size", type=int, default=1024, help="frame width and height for segs_to_masklist")
+    parser.add_argument("--max-seg-size", type=int, default=768, help="maximum crop region width and height")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+
+    print(f"segs_to_combined_mask: {args.size}x{args.size}, segs_to_masklist: {args.masklist_size}x{args.masklist_size}, best of {args.repeat}")
+    print(f"{'segs':>6} {'masks':>7} {'combined(old)':>14} {'combined(new)':>14} {'masklist(old)':>14} {'masklist(new)':>14}")
+
+    for count in args.segs:
+        dense_segs = make_segs(args.size, count, args.max_seg_size, rng)
+        dense_list_segs = make_segs(args.masklist_size, count, min(args.max_seg_size, args.masklist_size // 2), rng)
+
+        for name in ("dense", "packed"):
+            if name == "packed":
+                # packed with `seg_mask_packing` enabled (default)
+                segs = dense_segs[0], [pack_seg(seg) for seg in dense_segs[1]]
+                list_segs = dense_list_segs[0], [pack_seg(seg) for seg in dense_list_segs[1]]
+            else:
+                segs = dense_segs
+                list_segs = dense_list_segs
+
+            # the old and new must give the same binary masks
+            assert torch.equal(old_segs_to_combined_mask(segs), core.segs_to_combined_mask(segs))
+            old_masks = old_segs_to_masklist(list_segs)
+            new_masks = core.segs_to_masklist(list_segs)
+            assert len(old_masks) == len(new_masks)
+            assert all(torch.equal(old_mask, new_mask) for old_mask, new_mask in zip(old_masks, new_masks))
+            del old_masks, new_masks
+
+            t_old_combined = measure(lambda: old_segs_to_combined_mask(segs), args.repeat)
+            t_new_combined = measure(lambda: core.segs_to_combined_mask(segs), args.repeat)
+            t_old_list = measure(lambda: old_segs_to_masklist(list_segs), args.repeat)
+            t_new_list = measure(lambda: core.segs_to_masklist(list_segs), args.repeat)
+
+            print(f"{count:>6} {name:>7} {t_old_combined:>13.3f}s {t_new_combined:>13.3f}s {t_old_list:>13.3f}s {t_new_list:>13.3f}s")
+
+
+if __name__ == "__main__":
+    main()
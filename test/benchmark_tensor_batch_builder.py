@@ -0,0 +1,79 @@
+"""
+Benchmark of `TensorBatchBuilder` against the repeated `torch.cat` it replaced.
+
+Run with the python of ComfyUI:
+    python custom_nodes/ComfyUI-Impact-Pack/test/benchmark_tensor_batch_builder.py [--size 512] [--device cpu]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+impact_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+comfy_path = os.path.dirname(os.path.dirname(impact_path))
+sys.path.append(comfy_path)
+sys.path.append(os.path.join(impact_path, "modules"))
+
+import torch
+from impact.utils import TensorBatchBuilder
+
+
+def repeated_cat(frames):
+    result = None
+    for frame in frames:
+        result = frame if result is None else torch.cat((result, frame), dim=0)
+    return result
+
+
+def builder(frames, capacity):
+    batch = TensorBatchBuilder(capacity)
+    for frame in frames:
+        batch.concat(frame)
+    return batch.tensor
+
+
+def measure(func, repeat, device):
+    times = []
+    for _ in range(repeat):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        func()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, nargs="+", default=[100, 500])
+    parser.add_argument("--size", type=int, default=512, help="frame width and height")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+
+    print(f"frame: {args.size}x{args.size}x3 float32, device: {device}, best of {args.repeat}")
+    print(f"{'frames':>8} {'torch.cat':>12} {'builder':>12} {'builder(n)':>12} {'speedup':>8}")
+
+    for n in args.frames:
+        frames = [torch.rand((1, args.size, args.size, 3), device=device) for _ in range(n)]
+
+        # the three must build the same batch
+        expected = repeated_cat(frames)
+        assert torch.equal(builder(frames, None), expected)
+        assert torch.equal(builder(frames, n), expected)
+        del expected
+
+        t_cat = measure(lambda: repeated_cat(frames), args.repeat, device)
+        t_grow = measure(lambda: builder(frames, None), args.repeat, device)
+        t_reserved = measure(lambda: builder(frames, n), args.repeat, device)
+
+        print(f"{n:>8} {t_cat:>11.3f}s {t_grow:>11.3f}s {t_reserved:>11.3f}s {t_cat / t_reserved:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()